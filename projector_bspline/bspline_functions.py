@@ -1,3 +1,6 @@
+import os
+import math
+import hashlib
 import numpy as np
 from scipy import misc
 from scipy import signal
@@ -10,6 +13,13 @@ from scipy import ndimage
 eps = 1e-8
 
 
+####  DEFAULT CACHE FOLDER OF THE LOOK-UP-TABLES
+##  It can be changed with the environment variable TOMO_LUT_CACHE
+lut_cache_dir = os.environ.get( 'TOMO_LUT_CACHE' ,
+                                os.path.join( os.path.expanduser( '~' ) , '.cache' ,
+                                              'tomographic_projectors' , 'lut' ) )
+
+
 
 
 ##########################################################
@@ -113,10 +123,104 @@ def radon_n_bspline_general( y , theta , m , n ):
 ##      ( (m+1)/2 - k2 )sin(theta) )_{+}^{2m-n+1} / [( 2m-n+1 )! * cos(theta)^{m+1} *
 ##      * sin(theta)^{m+1}]
 
-def init_lut_bspline( nsamples_y , angles , bspline_degree , rt_degree , proj_support_y ):
+##  Integer power of an array by repeated squaring, much faster than
+##  np.power with a generic exponent
+def int_power( x , p ):
+    result = np.ones_like( x )
+
+    while p > 0:
+        if p & 1:
+            result *= x
+        p >>= 1
+        if p > 0:
+            x = x * x
+
+    return result
+
+
+##  Row of the look-up-table for the special angles 0 , pi/2 , pi, where
+##  formula n. 28 degenerates: the closed form of radon_n_bspline_general,
+##  i.e. the centered ( m+1 )-fold finite difference of y_{+}^{m-n} / ( m-n )!,
+##  which is the same for the three angles
+def radon_bspline_special_row( yarray , m , n ):
+    p   = m - n
+    row = np.zeros( len( yarray ) )
+
+    for k in range( m + 1 + 1 ):
+        t    = yarray + ( m + 1 ) / 2.0 - k
+        row += ( -1 )**k * comb( m + 1 , k ) * int_power( np.maximum( t , 0.0 ) , p ) * ( t > 0.0 )
+
+    return row / math.factorial( p )
+
+
+##  Binomial coefficient as a float
+def comb( n , k ):
+    return math.factorial( n ) / float( math.factorial( k ) * math.factorial( n - k ) )
+
+
+##  Rows R^{n}{beta}( yarray , theta ) of formula n. 28 for all the angles,
+##  returned in float32 ( nang x len( yarray ) ); they are computed by blocks
+##  of chunk_size angles, so that the temporaries stay small for any number
+##  of angles. Each block is accumulated in float64 and then stored: the
+##  alternating sum of formula n. 28 is divided by ( cos(theta) sin(theta) )^{m+1},
+##  which close to the special angles leaves no significant digit in single
+##  precision
+def radon_bspline_rows( yarray , angles , m , n , chunk_size=256 ):
+    exponent = 2*m - n + 1
+    yarray   = np.asarray( yarray , dtype=np.float64 )
+
+
+    ##  Coefficients (-1)^{k1+k2} * comb( m+1 , k1 ) * comb( m+1 , k2 ) of the
+    ##  double sum and the shifts ( m+1 )/2 - k of cos(theta) and sin(theta)
+    terms = [ ( ( -1.0 )**( k_1 + k_2 ) * comb( m + 1 , k_1 ) * comb( m + 1 , k_2 ) ,
+                ( m + 1 ) / 2.0 - k_1 , ( m + 1 ) / 2.0 - k_2 )
+              for k_1 in range( m + 1 + 1 ) for k_2 in range( m + 1 + 1 ) ]
+    
+
+    ##  Special angles 0 , pi/2 , pi, handled apart
+    angles  = np.asarray( angles )
+    nang    = len( angles )
+    special = ( np.abs( angles ) < eps ) | ( np.abs( angles - np.pi/2.0 ) < eps ) | \
+              ( np.abs( angles - np.pi ) < eps )
+
+    result = np.zeros( ( nang , len( yarray ) ) , dtype=np.float32 )
+
+
+    ##  Formula n. 28 by blocks of angles
+    for i0 in range( 0 , nang , chunk_size ):
+        theta = angles[i0:i0+chunk_size].astype( np.float64 ).reshape( -1 , 1 )
+        cos_theta = np.cos( theta )
+        sin_theta = np.sin( theta )
+
+        block = np.zeros( ( len( theta ) , len( yarray ) ) )
+
+        for coeff , shift_cos , shift_sin in terms:
+            num = yarray + ( shift_cos * cos_theta + shift_sin * sin_theta )
+            np.maximum( num , 0.0 , out=num )
+            block += coeff * int_power( num , exponent )
+
+        ##  Denominator: fact( 2m-n+1 ) * cos(theta)^{m+1} * sin(theta)^{m+1},
+        ##  set to 1 for the special angles to avoid the division by 0
+        divisor = math.factorial( exponent ) * ( sin_theta * cos_theta )**( m + 1 )
+        divisor[ special[i0:i0+chunk_size] ] = 1.0
+
+        result[i0:i0+chunk_size] = block / divisor
+
+
+    ##  Correcting for the general values 0 , pi/2 , pi with the closed form
+    if np.any( special ):
+        result[special] = radon_bspline_special_row( yarray , m , n )
+
+    return result
+
+
+##  Dense look-up-table ( nang x nsamples_y ) in float32, sampled on the
+##  whole support [ -proj_support_y/2 , proj_support_y/2 ) and read by the
+##  projectors at the nearest sample
+def init_lut_bspline( nsamples_y , angles , bspline_degree , rt_degree , proj_support_y ,
+                      chunk_size=256 ):
     m = bspline_degree
     n = rt_degree    
-    exponent = 2*m - n + 1
 
     
     ##  Define y-range as equally spaced points between -(m+1)/2, ... ,(m+1)/1 .
@@ -128,77 +232,109 @@ def init_lut_bspline( nsamples_y , angles , bspline_degree , rt_degree , proj_su
     yarray -= nsamples_y / 2.0 
     yarray /= np.float32( nsamples_y )
     yarray *= yrange
-    yarray_tile = yarray.reshape( 1 , yarray.shape[0] )
-    
-    
-    ##  Define the theta-range as equally spaced points between 0 ... pi
-    nsamples_theta = len( angles )
-    theta_array_tile = angles.reshape( len( angles ) , 1 )
-    
-    
-    ##  Repeat the tile yarray_tile vertically for nsamples_theta times
-    y_matrix = np.tile( yarray_tile , ( nsamples_theta , 1 ) )
 
+    return radon_bspline_rows( yarray , angles , m , n , chunk_size )
 
-    ##  Repeat the tile theta_array_tile for nsamples_y times
-    theta_matrix = np.tile( theta_array_tile , ( 1 , nsamples_y ) )
 
+##  Compact look-up-table, exploiting the symmetries of the tensor B-spline:
+##  R^{n}( y , theta ) depends on theta only through the unordered pair
+##  ( |cos(theta)| , |sin(theta)| ), i.e. on the angle in [ 0 , pi/4 ]
+##  equivalent under theta <-> pi - theta and theta <-> pi/2 - theta, and
+##  R^{n}( -y , theta ) = (-1)^n R^{n}( y , theta ). Only one row per
+##  equivalent angle is stored, sampled on y in [ 0 , proj_support_y/2 ]
+##  with nsamples_y samples including both ends, and the projectors read
+##  it with linear interpolation, so a few hundred samples are enough.
+##  Returns the table ( nrows x nsamples_y ) in float32 and the int32
+##  array rows giving the row of each angle
+def init_lut_bspline_compact( nsamples_y , angles , bspline_degree , rt_degree , proj_support_y ,
+                              chunk_size=256 ):
+    angles  = np.asarray( angles , dtype=np.float64 )
+    abs_cos = np.abs( np.cos( angles ) )
+    abs_sin = np.abs( np.sin( angles ) )
+    phi     = np.arctan2( np.minimum( abs_cos , abs_sin ) , np.maximum( abs_cos , abs_sin ) )
 
-    ##  Precalculate sin and cos of all the angles
-    sin_theta_matrix = np.sin( theta_matrix )
-    cos_theta_matrix = np.cos( theta_matrix ) 
+    phi_rows , rows = np.unique( np.round( phi , 9 ) , return_inverse=True )
 
-    
-    ##  Prepare denominator matrix: fact( 2m-n+1 ) * cos(theta)^{m+1} * sin(theta)^{m+1}
-    ##  Take care to reassign to angles 0 , pi/2 , pi values different from 0
-    power_matrix = np.power( sin_theta_matrix * cos_theta_matrix , m+1 )
-    divisor = np.float32( misc.factorial( exponent ) ) * power_matrix
+    yarray = np.linspace( 0.0 , 0.5 * proj_support_y , nsamples_y )
+    lut    = radon_bspline_rows( yarray , phi_rows , bspline_degree , rt_degree , chunk_size )
 
-    ind_0 = np.argwhere( np.abs( angles ) < eps )
-    ind_90 = np.argwhere( np.abs( angles - np.pi/2.0 ) < eps )
-    ind_180 = np.argwhere( np.abs( angles - np.pi ) < eps ) 
+    return lut , rows.astype( np.int32 )
 
-    if len( ind_0 ) !=0:
-        divisor[ind_0, :] = 1.0
 
-    if len( ind_90 ) != 0:
-        divisor[ind_90, :] = 1.0
-    
-    if len( ind_180 ) != 0:
-        divisor[ind_180, :] = 1.0
 
-    
-    ##  Allocate memory for the radon transform coefficients
-    ##  of the B-splines functions
-    result = np.zeros( ( nsamples_theta , nsamples_y ) )
-
-
-    ##  Compute numerator matrix
-    for k_1 in  range( 0,  m+1+1 ):
-        for k_2 in  range(0, m+1+1 ):
-            num = y_matrix + ( m/2.0 + 0.5 - k_1 ) * cos_theta_matrix + \
-                  ( m/2.0 + 0.5 - k_2 ) * sin_theta_matrix
-            num[ num < 0.0] = 0.0
-            num_power = np.power( num , exponent )
-            num_power *= np.power( -1.0 , k_1 + k_2 ) * misc.comb( m + 1 , k_1 ) * misc.comb( m + 1 , k_2 )
-            result += num_power
-    
-    
-    ##  Divide for the divisor which is indipendent from the sums on k_1 and k_2 
-    result /= divisor
 
+##########################################################
+##########################################################
+####                                                  ####
+####        DISK CACHE OF THE LOOK-UP-TABLES          ####
+####                                                  ####
+##########################################################
+##########################################################
 
-    ##  Correcting for the general values 0 , pi/2 , pi with slow general formula
-    if len( ind_0 ) != 0 or len( ind_90 ) != 0 or len( ind_180 ) != 0:  
-        for y in range( nsamples_y ):
-            if len( ind_0 ) != 0:
-                result[ ind_0 , y ] = radon_n_bspline_general( yarray[y] , 0.0 , m , n )
-            if len( ind_90 ) != 0: 
-                result[ ind_90 , y ] = radon_n_bspline_general( yarray[y] , np.pi/2.0 , m , n )
-            if len( ind_180 ) != 0: 
-                result[ ind_180 , y ] = radon_n_bspline_general( yarray[y] , np.pi , m , n )
+##  The look-up-table is identified by all the arguments of init_lut_bspline,
+##  the angles through a hash of their values, and by its layout
+def lut_key( nsamples_y , angles , bspline_degree , rt_degree , proj_support_y , compact=False ):
+    digest = hashlib.sha1()
+    digest.update( np.ascontiguousarray( angles , dtype=np.float64 ).tobytes() )
 
-    return result
+    if compact is True:
+        prefix = 'lut_bspline_compact'
+    else:
+        prefix = 'lut_bspline'
+
+    return '%s_nsamples%d_m%d_n%d_support%g_%s' % ( prefix , nsamples_y , bspline_degree ,
+                                                    rt_degree , proj_support_y ,
+                                                    digest.hexdigest() )
+
+
+##  Save an array under a temporary name and rename it, so that concurrent
+##  processes never read a partially written file
+def save_atomic( folder , name , arr ):
+    filetmp = os.path.join( folder , name + '.' + str( os.getpid() ) + '.tmp.npy' )
+    with open( filetmp , 'wb' ) as fp:
+        np.save( fp , arr )
+    os.rename( filetmp , os.path.join( folder , name + '.npy' ) )
+
+
+##  Same as init_lut_bspline, or init_lut_bspline_compact when compact is
+##  True, but the table is computed only the first time and stored in the
+##  cache folder; afterwards it is memory-mapped from there ( mmap_mode as
+##  in numpy.load , None to read it in memory ). The compact table is
+##  returned together with its array of rows, saved before the table so
+##  that the table is never found without it
+def get_lut_bspline( nsamples_y , angles , bspline_degree , rt_degree , proj_support_y ,
+                     folder=None , mmap_mode='r' , compact=False ):
+    if folder is None:
+        folder = lut_cache_dir
+
+    key      = lut_key( nsamples_y , angles , bspline_degree , rt_degree , proj_support_y ,
+                        compact )
+    filename = os.path.join( folder , key + '.npy' )
+    filerows = os.path.join( folder , key + '_rows.npy' )
+
+    if not os.path.isfile( filename ):
+        if compact is True:
+            lut , rows = init_lut_bspline_compact( nsamples_y , angles , bspline_degree ,
+                                                   rt_degree , proj_support_y )
+        else:
+            lut = init_lut_bspline( nsamples_y , angles , bspline_degree , rt_degree ,
+                                    proj_support_y )
+
+        if not os.path.isdir( folder ):
+            try:
+                os.makedirs( folder )
+            except OSError:
+                if not os.path.isdir( folder ):
+                    raise
+
+        if compact is True:
+            save_atomic( folder , key + '_rows' , rows )
+        save_atomic( folder , key , lut )
+
+    if compact is True:
+        return np.load( filename , mmap_mode=mmap_mode ) , np.load( filerows )
+    else:
+        return np.load( filename , mmap_mode=mmap_mode )
 
 
 
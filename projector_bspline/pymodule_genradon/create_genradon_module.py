@@ -8,9 +8,9 @@ setup(
     cmdclass = {'build_ext': build_ext},
     ext_modules = [Extension("genradon",
                              sources=[ "genradon.pyx" ,
-                                       "gen_forwproj.c" ,
-                                       "gen_backproj.c"
+                                       "gen_forwproj_omp.c" ,
+                                       "gen_backproj_omp.c"
                                        ],
                              include_dirs=[numpy.get_include()],libraries=['gcov'],
-    extra_compile_args=['-O3','-march=native','-ffast-math','-fprofile-generate','-fopenmp'],extra_link_args=['-fprofile-generate'])],
+    extra_compile_args=['-O3','-march=native','-ffast-math','-fprofile-generate','-fopenmp'],extra_link_args=['-fprofile-generate','-fopenmp'])],
 )
@@ -0,0 +1,275 @@
+//This is the adjoint of the matrix form of the Radon Transform implemented in
+//gen_forwproj_omp.c. Input is a sinogram in the 'canonical' basis, output is the image
+//in B-spline space.
+//
+//The images of the stack are decomposed in blocks of rows and blocks of slices, every
+//thread owns a (row,slice block) pair and gathers the contributions of all the angles for
+//its pixels, so no accumulation is ever shared among the threads. The contributions of
+//each pixel are summed in the order of the angles, whatever the number of threads.
+//
+// Remember:
+// lut_size     --->   is supposed to be even
+// half_pixel   --->   it may be set to 0.5, but for npix even, 0 is better
+
+
+
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <omp.h>
+
+#define pi 3.141592653589793
+
+// Number of slices sharing the footprints computed for one angle
+#define SLICE_BLOCK 8
+
+
+
+// Weight of the look-up-table for the angle theta_index at the distance
+// lut_arg_y from the projected center of a B-spline, 0 outside the table.
+// Dense tables ( lut_rows == NULL ) hold the whole profile of every angle on
+// lut_size samples and are read at the nearest sample; compact tables hold
+// the profile for lut_arg_y >= 0 only, on lut_size samples over
+// [ 0 , support_bspline / 2 ], one row lut_rows[theta_index] shared by all
+// the symmetric angles, and are read with linear interpolation, the profile
+// for lut_arg_y < 0 being lut_parity times the mirrored one
+static inline float lut_weight( float *lut , int lut_size , float lut_step , int *lut_rows ,
+                                float lut_parity , int theta_index , float lut_arg_y )
+{
+    int i;
+    float u , *row;
+
+    if( lut_rows == NULL )
+    {
+        i = (int)( lut_arg_y * lut_step ) + lut_size / 2;
+
+        if( i >= lut_size - 1 || i < 0 ) return 0.0;
+
+        return lut[ theta_index * lut_size + i ];
+    }
+
+    u = fabs( lut_arg_y ) * lut_step;
+    i = (int)u;
+
+    if( i >= lut_size - 1 ) return 0.0;
+
+    row = lut + (long)lut_rows[theta_index] * lut_size;
+    u   = row[i] + ( u - i ) * ( row[i+1] - row[i] );
+
+    return ( lut_arg_y < 0 ) ? lut_parity * u : u;
+}
+
+
+
+// Samples per unit length of a dense or of a compact look-up-table
+static inline float lut_step_of( int lut_size , float support_bspline , int *lut_rows )
+{
+    if( lut_rows == NULL )
+        return ( lut_size * 0.5 ) / ( support_bspline * 0.5 );
+    else
+        return ( lut_size - 1 ) / ( support_bspline * 0.5 );
+}
+
+
+
+// Backprojection of a stack of nslices sinograms ( nslices x nang x npix ) into
+// nslices images ( nslices x npix x npix ); only the sinogram rows of the nsub
+// angles listed in subset are read, all of them when subset is NULL; -1 is
+// returned when the tables of the angles cannot be allocated, 0 otherwise
+int gen_backproj( float* sino , int nslices , int npix , float *angles , int nang , float *lut ,
+                   int lut_size , float support_bspline , int *lut_rows , float lut_parity ,
+                   int *subset , int nsub , int num_cores , float *image )
+{
+    const float lut_step = lut_step_of( lut_size , support_bspline , lut_rows );
+    const double half_pixel = 0.0;
+    const double middle_right_det = 0.5 * npix + half_pixel;
+    const double middle_left_det  = 0.5 * npix - half_pixel;
+    const int delta_s_plus = (int)( 0.5 * support_bspline + 0.5 );
+    const int nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+    const long image_stride = (long)npix * npix;
+    const long sino_stride = (long)nang * npix;
+
+    int image_index , sino_index;
+
+    float theta , kx , ky , proj_shift , y , lut_arg_y , weight;
+    float acc[SLICE_BLOCK];
+    int pair_index , angle_index , theta_index , kx_index , ky_index , s , y_index;
+    int z , z0 , nz;
+
+    float *COS = ( float * )malloc( nang * sizeof( float ) );
+    float *SIN = ( float * )malloc( nang * sizeof( float ) );
+
+    if( COS == NULL || SIN == NULL ){
+        free( COS );
+        free( SIN );
+        return -1;
+    }
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( subset == NULL )
+        nsub = nang;
+
+    for( theta_index = 0 ; theta_index < nang ; theta_index++ )
+    {
+        theta = angles[theta_index] * pi / 180.0;
+        COS[theta_index] = cos(theta);
+        SIN[theta_index] = sin(theta);
+    }
+
+    #pragma omp parallel num_threads( num_cores ) \
+                        shared( sino , npix , nang , subset , nsub , lut , lut_size , lut_rows , \
+                                lut_parity , COS , SIN , image , middle_left_det , delta_s_plus , \
+                                middle_right_det , lut_step , half_pixel , nslices , nblocks , \
+                                image_stride , sino_stride ) \
+                        private( pair_index , angle_index , theta_index , ky_index , ky , kx_index , kx , \
+                                 proj_shift , image_index , s , y_index , y , lut_arg_y , \
+                                 sino_index , weight , acc , z , z0 , nz )
+    {
+        #pragma omp for schedule( runtime )
+        for( pair_index = 0 ; pair_index < npix * nblocks ; pair_index++ )
+        {
+            ky_index = pair_index / nblocks;
+            z0 = ( pair_index % nblocks ) * SLICE_BLOCK;
+            nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+            ky = -ky_index + middle_left_det;
+
+            for ( kx_index = 0 ; kx_index < npix ; kx_index++ )
+            {
+                kx = kx_index - middle_left_det;
+                image_index = ky_index * npix + kx_index;
+
+                for( z = 0 ; z < nz ; z++ )
+                    acc[z] = image[(z0 + z) * image_stride + image_index];
+
+                for( angle_index = 0 ; angle_index < nsub ; angle_index++ )
+                {
+                    theta_index = ( subset == NULL ) ? angle_index : subset[angle_index];
+                    proj_shift = COS[theta_index] * kx + SIN[theta_index] * ky;
+
+                    for ( s = -delta_s_plus ; s <= delta_s_plus ; s++ )
+                    {
+                        y_index = (int)( proj_shift + s + middle_right_det );
+
+                        if (y_index >= npix || y_index < 0) continue;
+
+                        y = y_index - middle_left_det;
+
+                        lut_arg_y = y - proj_shift;
+                        weight = lut_weight( lut , lut_size , lut_step , lut_rows , lut_parity ,
+                                             theta_index , lut_arg_y );
+
+                        if (weight == 0) continue;
+
+                        sino_index = theta_index * npix + y_index;
+
+                        for( z = 0 ; z < nz ; z++ )
+                            acc[z] += sino[(z0 + z) * sino_stride + sino_index] * weight;
+                    }
+                }
+
+                for( z = 0 ; z < nz ; z++ )
+                    image[(z0 + z) * image_stride + image_index] = acc[z];
+            }
+        }
+    }
+
+    free( COS );
+    free( SIN );
+
+    return 0;
+}
+
+
+
+
+//  Copy of the slices [ z0 , z0 + nz ) of a strided input into the C-contiguous
+//  float32 buffer buf ( nz x nrows x ncols ); the element ( z , i , j ) of the
+//  input lies at the byte offset z * sz + ( i - row0 ) * sr + j * sc from data and
+//  is stored as float32 ( dtype 0 ) or float64 ( dtype 1 ); only the rows of
+//  the nsub angles listed in subset are copied, all the rows when subset is
+//  NULL, and the other rows of buf are left as they are
+static void gather_slices( char *data , long sz , long sr , long sc , int dtype , int z0 ,
+                           int nz , int nrows , int ncols , int row0 , int *subset , int nsub ,
+                           int num_cores , float *buf )
+{
+    long r;
+    int i, j;
+    char *row;
+    float *dst;
+
+    if( subset == NULL )
+        nsub = nrows;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) \
+                         private( i , j , row , dst )
+    for( r=0 ; r<(long)nz*nsub ; r++ ){
+        i   = ( subset == NULL ) ? r % nsub : subset[ r % nsub ];
+        row = data + ( z0 + r / nsub ) * sz + ( i - row0 ) * sr;
+        dst = buf + ( ( r / nsub ) * nrows + i ) * ncols;
+
+        if( dtype == 0 )
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = *( float * )( row + j * sc );
+        else
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = (float)*( double * )( row + j * sc );
+    }
+}
+
+
+
+
+//  Backprojection of a stack of nslices sinograms ( nslices x nang x npix )
+//  given as a strided view ( see gather_slices ): a C-contiguous float32 input
+//  is projected in place, any other layout is converted on the fly by blocks
+//  of SLICE_BLOCK slices.  The sinograms may also be blocks of consecutive
+//  rows, row0 being the sinogram row of their first row: only the rows of
+//  the nsub angles listed in subset are then read, and the contiguous path
+//  is only taken for row0 = 0; -1 is returned when the memory cannot be
+//  allocated, 0 otherwise
+int gen_backproj_strided( char *data , long sz , long sr , long sc , int dtype , int nslices ,
+                          int npix , float *angles , int nang , float *lut , int lut_size ,
+                          float support_bspline , int *lut_rows , float lut_parity , int row0 ,
+                          int *subset , int nsub , int num_cores , float *image )
+{
+    int nrows, nbuf, z0, nz, err = 0;
+    long nin, nout;
+    float *buf;
+
+    nrows = nang;
+    nin   = (long)nrows * npix;
+    nout  = (long)npix * npix;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( dtype == 0 && row0 == 0 && sc == sizeof( float ) && sr == npix * sizeof( float ) &&
+        ( nslices == 1 || sz == nin * sizeof( float ) ) ){
+        return gen_backproj( ( float * )data , nslices , npix , angles , nang , lut , lut_size ,
+                             support_bspline , lut_rows , lut_parity , subset , nsub ,
+                             num_cores , image );
+    }
+
+    nbuf = ( nslices < SLICE_BLOCK ) ? nslices : SLICE_BLOCK;
+    buf  = ( float * )malloc( nbuf * nin * sizeof( float ) );
+
+    if( buf == NULL )
+        return -1;
+
+    for( z0=0 ; z0<nslices && err==0 ; z0+=SLICE_BLOCK ){
+        nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+
+        gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , row0 , subset ,
+                       nsub , num_cores , buf );
+
+        err = gen_backproj( buf , nz , npix , angles , nang , lut , lut_size , support_bspline ,
+                            lut_rows , lut_parity , subset , nsub , num_cores ,
+                            image + z0 * nout );
+    }
+
+    free( buf );
+
+    return err;
+}
@@ -13,42 +13,111 @@
 
 #include <math.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <omp.h>
 
 #define pi 3.141592653589793
 
+// Number of slices sharing the footprints computed for one angle
+#define SLICE_BLOCK 8
 
 
-void gen_forwproj( float* image , int npix , float *angles , int nang , float *lut ,
-                   int lut_size , float support_bspline , int num_cores , float *sino )
+
+// Weight of the look-up-table for the angle theta_index at the distance
+// lut_arg_y from the projected center of a B-spline, 0 outside the table.
+// Dense tables ( lut_rows == NULL ) hold the whole profile of every angle on
+// lut_size samples and are read at the nearest sample; compact tables hold
+// the profile for lut_arg_y >= 0 only, on lut_size samples over
+// [ 0 , support_bspline / 2 ], one row lut_rows[theta_index] shared by all
+// the symmetric angles, and are read with linear interpolation, the profile
+// for lut_arg_y < 0 being lut_parity times the mirrored one
+static inline float lut_weight( float *lut , int lut_size , float lut_step , int *lut_rows ,
+                                float lut_parity , int theta_index , float lut_arg_y )
+{
+    int i;
+    float u , *row;
+
+    if( lut_rows == NULL )
+    {
+        i = (int)( lut_arg_y * lut_step ) + lut_size / 2;
+
+        if( i >= lut_size - 1 || i < 0 ) return 0.0;
+
+        return lut[ theta_index * lut_size + i ];
+    }
+
+    u = fabs( lut_arg_y ) * lut_step;
+    i = (int)u;
+
+    if( i >= lut_size - 1 ) return 0.0;
+
+    row = lut + (long)lut_rows[theta_index] * lut_size;
+    u   = row[i] + ( u - i ) * ( row[i+1] - row[i] );
+
+    return ( lut_arg_y < 0 ) ? lut_parity * u : u;
+}
+
+
+
+// Samples per unit length of a dense or of a compact look-up-table
+static inline float lut_step_of( int lut_size , float support_bspline , int *lut_rows )
+{
+    if( lut_rows == NULL )
+        return ( lut_size * 0.5 ) / ( support_bspline * 0.5 );
+    else
+        return ( lut_size - 1 ) / ( support_bspline * 0.5 );
+}
+
+
+
+// Forward projection of a stack of nslices images ( nslices x npix x npix ) into
+// nslices sinograms ( nslices x nang x npix ); the (angle,slice block) pairs are
+// distributed among the threads and the footprint of each pixel is computed once
+// for all the slices of the block; subset lists the nsub angles to project, NULL
+// for all of them, and the other sinogram rows are left untouched
+void gen_forwproj( float* image , int nslices , int npix , float *angles , int nang , float *lut ,
+                   int lut_size , float support_bspline , int *lut_rows , float lut_parity ,
+                   int *subset , int nsub , int num_cores , float *sino )
 {
-    float lut_step = ( lut_size * 0.5 ) / ( support_bspline * 0.5 );
-    int lut_max_index = lut_size - 1;
-    int lut_half_size = lut_size/2; 
+    float lut_step = lut_step_of( lut_size , support_bspline , lut_rows );
     double half_pixel = 0.0; 
     double middle_right_det = 0.5 * npix + half_pixel; 
     double middle_left_det  = 0.5 * npix - half_pixel; 
     int delta_s_plus = (int)( 0.5 * support_bspline + 0.5 );
+    int nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+    long image_stride = (long)npix * npix;
+    long sino_stride = (long)nang * npix;
 
-    int image_index , sino_index , lut_arg_index_c;
+    int image_index , sino_index;
     
-    float theta , COS , SIN , kx , ky , proj_shift , y , lut_arg_y;
-    int theta_index , kx_index , ky_index , s , y_index, lut_arg_index;
+    float theta , COS , SIN , kx , ky , proj_shift , y , lut_arg_y , weight;
+    int pair_index , theta_index , kx_index , ky_index , s , y_index;
+    int z , z0 , nz;
+
+    if( num_cores < 1 )
+        num_cores = 1;
 
-    int chunk = ( int ) floor( nang / ( num_cores * 1.0 ) );
+    if( subset == NULL )
+        nsub = nang;
 
-    #pragma omp parallel shared( image , npix , angles , nang , lut , lut_size , \
-                                 support_bspline , sino , chunk , middle_left_det , \
+    #pragma omp parallel num_threads( num_cores ) \
+                        shared( image , npix , angles , nang , subset , nsub , lut , lut_size , \
+                                 lut_rows , lut_parity , support_bspline , sino , middle_left_det , \
                                  delta_s_plus , middle_right_det , lut_step , \
-                                 half_pixel , lut_half_size ) \
-                        private( theta_index , theta , COS , SIN , ky_index , ky , \
+                                 half_pixel , nslices , nblocks , \
+                                 image_stride , sino_stride ) \
+                        private( pair_index , theta_index , theta , COS , SIN , ky_index , ky , \
                                  kx_index , kx , proj_shift , image_index , s , \
-                                 y_index , lut_arg_y , lut_arg_index , sino_index , \
-                                 lut_arg_index_c )
+                                 y_index , lut_arg_y , sino_index , \
+                                 weight , z , z0 , nz )
     {
-        #pragma omp for schedule( dynamic , chunk )
-        for( theta_index = 0 ; theta_index < nang ; theta_index++ )
+        #pragma omp for schedule( runtime )
+        for( pair_index = 0 ; pair_index < nsub * nblocks ; pair_index++ )
         {
+            theta_index = ( subset == NULL ) ? pair_index / nblocks : subset[pair_index / nblocks];
+            z0 = ( pair_index % nblocks ) * SLICE_BLOCK;
+            nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+
             theta = angles[theta_index] * pi / 180.0;
             COS = cos(theta);
             SIN = sin(theta);
@@ -72,14 +141,15 @@ void gen_forwproj( float* image , int npix , float *angles , int nang , float *l
                         y = y_index - middle_left_det;
 
                         lut_arg_y = y - proj_shift;
-                        lut_arg_index = (int)( lut_arg_y * lut_step + half_pixel ) + lut_half_size;
+                        weight = lut_weight( lut , lut_size , lut_step , lut_rows , lut_parity ,
+                                             theta_index , lut_arg_y );
 
-                        if (lut_arg_index >= lut_max_index || lut_arg_index < 0) continue;
+                        if (weight == 0) continue;
 
                         sino_index = theta_index * npix + y_index;
-                        lut_arg_index_c = theta_index * lut_size + lut_arg_index;
 
-                        sino[sino_index] += image[image_index] * lut[lut_arg_index_c]; 
+                        for( z = z0 ; z < z0 + nz ; z++ )
+                            sino[z * sino_stride + sino_index] += image[z * image_stride + image_index] * weight; 
                     }
                 }
             }
@@ -87,3 +157,205 @@ void gen_forwproj( float* image , int npix , float *angles , int nang , float *l
     }
 }
 
+
+
+
+//  Copy of the slices [ z0 , z0 + nz ) of a strided input into the C-contiguous
+//  float32 buffer buf ( nz x nrows x ncols ); the element ( z , i , j ) of the
+//  input lies at the byte offset z * sz + i * sr + j * sc from data and is
+//  stored as float32 ( dtype 0 ) or float64 ( dtype 1 )
+static void gather_slices( char *data , long sz , long sr , long sc , int dtype , int z0 ,
+                           int nz , int nrows , int ncols , int num_cores , float *buf )
+{
+    long r;
+    int j;
+    char *row;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) private( j , row )
+    for( r=0 ; r<(long)nz*nrows ; r++ ){
+        row = data + ( z0 + r / nrows ) * sz + ( r % nrows ) * sr;
+
+        if( dtype == 0 )
+            for( j=0 ; j<ncols ; j++ )
+                buf[ r * ncols + j ] = *( float * )( row + j * sc );
+        else
+            for( j=0 ; j<ncols ; j++ )
+                buf[ r * ncols + j ] = (float)*( double * )( row + j * sc );
+    }
+}
+
+
+
+
+//  Forward projection of a stack of nslices images ( nslices x npix x npix )
+//  given as a strided view ( see gather_slices ): a C-contiguous float32 input
+//  is projected in place, any other layout is converted on the fly by blocks
+//  of SLICE_BLOCK slices; -1 is returned when the buffer of the blocks
+//  cannot be allocated, 0 otherwise
+int gen_forwproj_strided( char *data , long sz , long sr , long sc , int dtype , int nslices ,
+                          int npix , float *angles , int nang , float *lut , int lut_size ,
+                          float support_bspline , int *lut_rows , float lut_parity ,
+                          int *subset , int nsub , int num_cores , float *sino )
+{
+    int nrows, z0, nz;
+    long nin, nout;
+    float *buf;
+
+    nrows = npix;
+    nin   = (long)nrows * npix;
+    nout  = (long)nang * npix;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( dtype == 0 && sc == sizeof( float ) && sr == npix * sizeof( float ) &&
+        ( nslices == 1 || sz == nin * sizeof( float ) ) ){
+        gen_forwproj( ( float * )data , nslices , npix , angles , nang , lut , lut_size ,
+                      support_bspline , lut_rows , lut_parity , subset , nsub , num_cores ,
+                      sino );
+        return 0;
+    }
+
+    buf = ( float * )malloc( SLICE_BLOCK * nin * sizeof( float ) );
+
+    if( buf == NULL )
+        return -1;
+
+    for( z0=0 ; z0<nslices ; z0+=SLICE_BLOCK ){
+        nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+
+        gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , num_cores , buf );
+
+        gen_forwproj( buf , nz , npix , angles , nang , lut , lut_size , support_bspline ,
+                      lut_rows , lut_parity , subset , nsub , num_cores , sino + z0 * nout );
+    }
+
+    free( buf );
+
+    return 0;
+}
+
+
+
+
+// Triplets ( row , col , val ) of the system matrix; while row is NULL
+// the triplets are only counted
+typedef struct{
+    int   *row, *col;
+    float *val;
+    long  n;
+    int   last_row, last_col;
+} Triplets;
+
+
+
+static inline void add_triplet( Triplets *tr , int row , int col , float val )
+{
+    if( val == 0 )
+        return;
+
+    // Consecutive contributions to the same element are merged
+    if( tr->n > 0 && row == tr->last_row && col == tr->last_col ){
+        if( tr->row != NULL )
+            tr->val[ tr->n - 1 ] += val;
+        return;
+    }
+
+    if( tr->row != NULL ){
+        tr->row[ tr->n ] = row;
+        tr->col[ tr->n ] = col;
+        tr->val[ tr->n ] = val;
+    }
+    tr->last_row = row;
+    tr->last_col = col;
+    tr->n++;
+}
+
+
+
+// Triplets of the sinogram row theta_index, following gen_forwproj step by step
+static void gen_triplets( int npix , float *angles , int theta_index , float *lut ,
+                          int lut_size , float support_bspline , int *lut_rows ,
+                          float lut_parity , Triplets *tr )
+{
+    float lut_step = lut_step_of( lut_size , support_bspline , lut_rows );
+    double half_pixel = 0.0; 
+    double middle_right_det = 0.5 * npix + half_pixel; 
+    double middle_left_det  = 0.5 * npix - half_pixel; 
+    int delta_s_plus = (int)( 0.5 * support_bspline + 0.5 );
+
+    float theta , COS , SIN , kx , ky , proj_shift , y , lut_arg_y;
+    int kx_index , ky_index , s , y_index , image_index;
+
+    theta = angles[theta_index] * pi / 180.0;
+    COS = cos(theta);
+    SIN = sin(theta);
+
+    for( ky_index = 0 ; ky_index < npix ; ky_index++ )
+    {
+        ky = -ky_index + middle_left_det;
+
+        for ( kx_index = 0 ; kx_index < npix ; kx_index++ )
+        {
+            kx = kx_index - middle_left_det;
+            proj_shift = COS * kx + SIN * ky;
+            image_index = ky_index * npix + kx_index;
+
+            for ( s = -delta_s_plus ; s <= delta_s_plus ; s++ )
+            {
+                y_index = (int)( proj_shift + s + middle_right_det );
+
+                if (y_index >= npix || y_index < 0) continue;
+
+                y = y_index - middle_left_det;
+
+                lut_arg_y = y - proj_shift;
+
+                add_triplet( tr , theta_index * npix + y_index , image_index ,
+                             lut_weight( lut , lut_size , lut_step , lut_rows , lut_parity ,
+                                         theta_index , lut_arg_y ) );
+            }
+        }
+    }
+}
+
+
+
+// System matrix of the forward projector in coordinate format, built
+// angle by angle in parallel, in two calls:
+// rows == NULL  --->  count[theta_index] receives the number of triplets of the angle
+// otherwise     --->  the triplets of the angle are written from the offset
+//                     count[theta_index] of rows, cols and vals
+// Repeated ( row , col ) pairs are meant to be summed
+void gen_matrix( int npix , float *angles , int nang , float *lut , int lut_size ,
+                 float support_bspline , int *lut_rows , float lut_parity , int num_cores ,
+                 long *count , int *rows , int *cols , float *vals )
+{
+    int theta_index;
+    Triplets tr;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) private( tr )
+    for( theta_index = 0 ; theta_index < nang ; theta_index++ )
+    {
+        tr.n = 0;
+
+        if( rows == NULL )
+        {
+            tr.row = NULL;  tr.col = NULL;  tr.val = NULL;
+            gen_triplets( npix , angles , theta_index , lut , lut_size , support_bspline ,
+                          lut_rows , lut_parity , &tr );
+            count[theta_index] = tr.n;
+        }
+        else
+        {
+            tr.row = rows + count[theta_index];
+            tr.col = cols + count[theta_index];
+            tr.val = vals + count[theta_index];
+            gen_triplets( npix , angles , theta_index , lut , lut_size , support_bspline ,
+                          lut_rows , lut_parity , &tr );
+        }
+    }
+}
@@ -12,5 +12,5 @@ setup(
                                        ],
                              include_dirs=[numpy.get_include()],libraries=['gcov'],
                              extra_compile_args=['-w','-O3','-march=native','-ffast-math','-fprofile-generate','-fopenmp'],
-                             extra_link_args=['-fprofile-generate'])],
+                             extra_link_args=['-fprofile-generate','-fopenmp'])],
 )
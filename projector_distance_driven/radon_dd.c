@@ -1,5 +1,5 @@
 /*
- *  IMPLEMENTATION OF THE PIXEL-DRIVEN TOMOGRAPHIC PROJECTORS 
+ *  IMPLEMENTATION OF THE DISTANCE-DRIVEN TOMOGRAPHIC PROJECTORS
  */
 
 
@@ -13,273 +13,728 @@
 #define pi 3.141592653589793
 #define eps 1.0e-7
 
+//  Number of slices sharing the geometry computed for one angle
+#define SLICE_BLOCK 8
+
 
 typedef struct{
         float xcoor;
         short int label;
-        short int index;      
+        short int index;
 } Proj;
 
 
 
 
-void quick_sort( Proj *a , int n ) {
-    int i, j;
-    float p;
-    Proj t;
+//  Triplets ( row , col , val ) of the system matrix; while row is NULL
+//  the triplets are only counted; r and c are the offsets of the row
+//  and of the column of the sinogram row and image line being swept
+typedef struct{
+    int   *row, *col;
+    float *val;
+    long  n;
+    int   last_row, last_col;
+    int   r, c;
+} Triplets;
+
+
+
 
-    if ( n < 2 )
+static inline void add_triplet( Triplets *tr , int row , int col , float val )
+{
+    if( val == 0 )
         return;
 
-    p = a[n/2].xcoor;
+    //  Consecutive contributions to the same element are merged
+    if( tr->n > 0 && row == tr->last_row && col == tr->last_col ){
+        if( tr->row != NULL )
+            tr->val[ tr->n - 1 ] += val;
+        return;
+    }
 
-    for( i = 0 , j=n-1;; i++ , j-- ){
-        while( a[i].xcoor < p )
-            i++;
-        while( p < a[j].xcoor )
-            j--;
-        if( i >= j )
-            break;
-        t = a[i];
-        a[i] = a[j];
-        a[j] = t;
+    if( tr->row != NULL ){
+        tr->row[ tr->n ] = row;
+        tr->col[ tr->n ] = col;
+        tr->val[ tr->n ] = val;
     }
-    quick_sort( a , i );
-    quick_sort( a + i , n - i );
+    tr->last_row = row;
+    tr->last_col = col;
+    tr->n++;
 }
 
 
 
 
-void radon_dd( float* image , int npix , float *angles , int nang , int oper , float *sino )
+//  Merge in increasing order the pixel boundaries ( label 0 ) and the
+//  detector boundaries ( label 1 ) of one image row:
+//      pixel boundary j     --->  ( j - nh ) - u * p / q
+//      detector boundary j  --->  ( j - nh ) / q
+//  Both sequences are monotone in j, hence a two-pointer merge gives
+//  the sorted sequence in linear time
+void merge_boundaries( Proj *proj , int npix , float u , float p , float q )
 {
-    int v, i, j, k, nh, nt, flag1, flag2, i_d, i_p;
-    float s, c, x, y, theta, xi, xd, diff;
-    float *xcoor;
-    int *label, *index;
+    int k, jp, jd, jd_step, jd_end, nh, nt;
+    float x, xp, xd;
 
-    
     nh = ( int )( npix * 0.5 );
     nt = 2 * ( npix + 1 );
 
-    
-    Proj *proj = ( Proj * )malloc( nt * sizeof( Proj ) ); 
+    //  For q < 0 the detector boundaries decrease with j
+    if( q > 0 ){
+        jd = 0;  jd_step = 1;  jd_end = npix + 1;
+    }
+    else{
+        jd = npix;  jd_step = -1;  jd_end = -1;
+    }
+
+    jp = 0;
+    x  = jp - nh;
+    xp = x - u * p / q;
+    x  = jd - nh;
+    xd = x / q;
+
+    for( k=0 ; k<nt ; k++ ){
+        if( jd == jd_end || ( jp <= npix && xp <= xd ) ){
+            proj[k].xcoor = xp;
+            proj[k].label = 0;
+            proj[k].index = jp;
+            jp++;
+            x  = jp - nh;
+            xp = x - u * p / q;
+        }
+        else{
+            proj[k].xcoor = xd;
+            proj[k].label = 1;
+            proj[k].index = jd;
+            jd += jd_step;
+            x  = jd - nh;
+            xd = x / q;
+        }
+    }
+}
+
+
+
+
+//  Distance-driven weights of one image row ( or column ) along the merged
+//  boundaries, applied to nz slices; the pixel i_p of the slice z lives at
+//  img[ z * is + i_p * stride ], the detector bin i_d at sino_row[ z * ss + i_d ];
+//  for oper = 2 the weights are recorded in tr instead of being applied
+void sweep_boundaries( Proj *proj , int npix , float *img , int stride , float *sino_row ,
+                       int nz , long is , long ss , int oper , Triplets *tr )
+{
+    int j, z, nt, flag1, flag2, i_d, i_p, last_p, last_d;
+    float diff;
+
+    nt = 2 * ( npix + 1 );
+
+    flag1  = 0;
+    flag2  = 0;
+    i_p    = -1;
+    i_d    = -1;
+    diff   = -1;
+
+    //  Last pixel and detector boundaries met so far, which replaces the
+    //  backward search over the merged sequence
+    last_p = -1;
+    last_d = -1;
+    if( proj[0].index != npix ){
+        if( proj[0].label == 0 )
+            last_p = proj[0].index;
+        else
+            last_d = proj[0].index;
+    }
+
+    for( j=1 ; j<nt ; j++ ){
+        if( proj[j].label == 1 && proj[j-1].label == 0 ){
+            if( flag1 == 0 )
+                flag1 = 1;
+            else{
+                i_d = proj[j].index - 1;
+                i_p = proj[j-1].index;
+                diff = fabs( proj[j].xcoor - proj[j-1].xcoor );
+                flag2 = 1;
+            }
+        }
+
+        else if( proj[j].label == 0 && proj[j-1].label == 1 ){
+            if( flag1 == 0 )
+                flag1 = 1;
+            else{
+                i_p = proj[j].index - 1;
+                i_d = proj[j-1].index;
+                diff = fabs( proj[j].xcoor - proj[j-1].xcoor );
+                flag2 = 1;
+            }
+        }
+
+        else if( proj[j].label == 0 && proj[j-1].label == 0 ){
+            if( last_d != -1 ){
+                flag2 = 1;
+                i_p = proj[j-1].index;
+                i_d = last_d;
+                diff = fabs( proj[j].xcoor - proj[j-1].xcoor );
+            }
+        }
+
+        else if( proj[j].label == 1 && proj[j-1].label == 1 ){
+            if( last_p != -1 ){
+                flag2 = 1;
+                i_d = proj[j-1].index;
+                i_p = last_p;
+                diff = fabs( proj[j].xcoor - proj[j-1].xcoor );
+            }
+        }
+
+        if( proj[j].index == npix )
+            break;
+
+        if( proj[j].label == 0 )
+            last_p = proj[j].index;
+        else
+            last_d = proj[j].index;
+
+        if( flag2 ){
+            if( oper == 0 )
+                for( z=0 ; z<nz ; z++ )
+                    sino_row[ z * ss + i_d ] += diff * img[ z * is + i_p * stride ];
+            else if( oper == 1 )
+                for( z=0 ; z<nz ; z++ )
+                    img[ z * is + i_p * stride ] += diff * sino_row[ z * ss + i_d ];
+            else
+                add_triplet( tr , tr->r + i_d , tr->c + i_p * stride , diff );
+            flag2 = 0;
+            i_d   = -1;
+            i_p   = -1;
+            diff  = -1;
+        }
+    }
+}
+
+
+
+
+//  Branch of the distance-driven projector used for one angle:
+//      0  --->  theta = 0 , pi      ( image rows summed along the columns )
+//      1  --->  theta = pi/2        ( image columns )
+//      2  --->  pi/2 < theta < pi   ( boundaries swept along the image rows )
+//      3  --->  0 < theta < pi/2    ( boundaries swept along the image columns )
+int dd_branch( float theta , float s , float c )
+{
+    if( fabs( s ) < eps )
+        return 0;
+    else if( fabs( c ) < eps )
+        return 1;
+    else if( theta > pi/2 )
+        return 2;
+    else if( theta < pi/2.0 && theta != 0.0 )
+        return 3;
+    else
+        return -1;
+}
+
+
+
+
+//  Plan of the projectors for a given geometry: the trigonometric tables
+//  and the branch of every angle are computed once and reused by every call
+typedef struct{
+    int   npix, nang;
+    float *sin_tab, *cos_tab;
+    int   *branch;
+} Plan_dd;
+
+
+
+
+void plan_dd_destroy( Plan_dd *plan );
+
+
+
+
+//  NULL is returned when the tables cannot be allocated
+Plan_dd *plan_dd_create( int npix , float *angles , int nang )
+{
+    int v;
+    Plan_dd *plan = ( Plan_dd * )malloc( sizeof( Plan_dd ) );
+
+    if( plan == NULL )
+        return NULL;
+
+    plan->npix    = npix;
+    plan->nang    = nang;
+    plan->sin_tab = ( float * )malloc( nang * sizeof( float ) );
+    plan->cos_tab = ( float * )malloc( nang * sizeof( float ) );
+    plan->branch  = ( int * )malloc( nang * sizeof( int ) );
+
+    if( plan->sin_tab == NULL || plan->cos_tab == NULL || plan->branch == NULL ){
+        plan_dd_destroy( plan );
+        return NULL;
+    }
 
-    
     for( v=0 ; v<nang ; v++ ){
-        theta = angles[v];
-        s     = sin( theta );
-        c     = cos( theta );
+        plan->sin_tab[v] = sin( angles[v] );
+        plan->cos_tab[v] = cos( angles[v] );
+        plan->branch[v]  = dd_branch( angles[v] , plan->sin_tab[v] , plan->cos_tab[v] );
+    }
 
-        
-        if( fabs( s ) < eps  ){
-            for( i=0 ; i<npix ; i++ ){
-                for( j=0 ; j<npix ; j++ ){
-                    if( oper == 0 )
-                        sino[ ( nang - 1 - v ) * npix + i ] += image[ i * npix + j ];
-                    else
-                        image[ i * npix + j ] += sino[ ( nang - 1 - v ) * npix + i ]; 
-                }
-            }    
+    return plan;
+}
+
+
+
+
+void plan_dd_destroy( Plan_dd *plan )
+{
+    free( plan->sin_tab );
+    free( plan->cos_tab );
+    free( plan->branch );
+    free( plan );
+}
+
+
+
+
+//  Forward projector: the (angle,slice block) pairs are distributed among
+//  the threads, every pair writes only its own sinogram rows; the merged
+//  boundaries of each image line are applied to all the slices of the block;
+//  subset lists the nsub angles of the plan to project, NULL for all of
+//  them, and the other sinogram rows are left untouched; -1 is returned
+//  when a private buffer cannot be allocated, 0 otherwise
+int forwproj_dd( Plan_dd *plan , float* image , int nslices , int *subset , int nsub ,
+                 int num_cores , float *sino )
+{
+    int failed = 0;
+    int npix = plan->npix , nang = plan->nang;
+    int nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+    long is = (long)npix * npix;
+    long ss = (long)nang * npix;
+
+    if( subset == NULL )
+        nsub = nang;
+
+    #pragma omp parallel num_threads( num_cores )
+    {
+        int r, v, i, j, z, z0, nz, nh;
+        float s, c, x, y;
+        float *sino_row, *img;
+        Proj *proj = ( Proj * )malloc( 2 * ( npix + 1 ) * sizeof( Proj ) );
+
+        //  A thread without its buffer still meets the loop, doing nothing
+        if( proj == NULL ){
+            #pragma omp atomic write
+            failed = 1;
         }
-        
-        
-        else if( fabs( c ) < eps ){
-            for( i=0 ; i<npix ; i++ ){
-                for( j=0 ; j<npix ; j++ ){
-                    if( oper == 0 )
-                        sino[ ( nang - 1 - v ) * npix + i ] += image[ j * npix + i ];
-                    else
-                        image[ j * npix + i ] += sino[ ( nang - 1 - v ) * npix + i ]; 
-                }
-            }    
-        }              
-         
-        
-        else if( theta > pi/2 ){ 
-            for( i=0 ; i<npix ; i++ ){
-                y  = i - nh + 0.5;
-
-                for( j=0 ; j<npix+1 ; j++ ){
-                    x  = j - nh;
-
-                    proj[2*j].xcoor   = x - y * c / s;
-                    proj[2*j].label   = 0;
-                    proj[2*j].index   = j;
-                    if( theta < pi/2 )
-                        proj[2*j+1].xcoor = - x / s;
-                    else
-                        proj[2*j+1].xcoor = x / s; 
-                    proj[2*j+1].label = 1;
-                    proj[2*j+1].index = j;
-                }
 
-                quick_sort( proj , nt );
-                
-                flag1 = 0;
-                flag2 = 0;
-                i_p   = -1;
-                i_d   = -1;
-                diff  = -1;
-
-                for( j=1 ; j<nt ; j++ ){
-                    if( proj[j].label == 1 && proj[j-1].label == 0 ){
-                        if( flag1 == 0 )
-                            flag1 = 1;
-                        else{
-                            i_d = proj[j].index - 1;
-                            i_p = proj[j-1].index;
-                            diff = fabs( proj[j].xcoor - proj[j-1].xcoor );
-                            flag2 = 1;
-                        }
+        nh = ( int )( npix * 0.5 );
+
+        #pragma omp for schedule( runtime )
+        for( r=0 ; r<nsub*nblocks ; r++ ){
+            if( proj == NULL )
+                continue;
+
+            v        = ( subset == NULL ) ? r / nblocks : subset[ r / nblocks ];
+            z0       = ( r % nblocks ) * SLICE_BLOCK;
+            nz       = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+            s        = plan->sin_tab[v];
+            c        = plan->cos_tab[v];
+            sino_row = sino + z0 * ss + ( nang - 1 - v ) * npix;
+            img      = image + z0 * is;
+
+            switch( plan->branch[v] ){
+                case 0:
+                    for( z=0 ; z<nz ; z++ )
+                        for( i=0 ; i<npix ; i++ )
+                            for( j=0 ; j<npix ; j++ )
+                                sino_row[ z * ss + i ] += img[ z * is + i * npix + j ];
+                    break;
+
+                case 1:
+                    for( z=0 ; z<nz ; z++ )
+                        for( i=0 ; i<npix ; i++ )
+                            for( j=0 ; j<npix ; j++ )
+                                sino_row[ z * ss + i ] += img[ z * is + j * npix + i ];
+                    break;
+
+                case 2:
+                    for( i=0 ; i<npix ; i++ ){
+                        y = i - nh + 0.5;
+                        merge_boundaries( proj , npix , y , c , s );
+                        sweep_boundaries( proj , npix , img + i * npix , 1 , sino_row ,
+                                          nz , is , ss , 0 , NULL );
                     }
-
-                    else if( proj[j].label == 0 && proj[j-1].label == 1 ){
-                        if( flag1 == 0 )
-                            flag1 = 1;
-                        else{                         
-                            i_p = proj[j].index - 1;
-                            i_d = proj[j-1].index;
-                            diff = fabs( proj[j].xcoor - proj[j-1].xcoor );
-                            flag2 = 1;
-                        }
+                    break;
+
+                case 3:
+                    for( i=0 ; i<npix ; i++ ){
+                        x = i - nh + 0.5;
+                        merge_boundaries( proj , npix , x , s , c );
+                        sweep_boundaries( proj , npix , img + i , npix , sino_row ,
+                                          nz , is , ss , 0 , NULL );
                     }
+                    break;
+            }
+        }
 
-                    else if( proj[j].label == 0 && proj[j-1].label == 0 ){
-                        for( k=j-1 ; k>=0 ; k-- ){
-                            if( proj[k].label == 1 && proj[k].index != npix ){
-                                flag2 = 1;
-                                break;
-                            }
-                        }
-                        if( flag2 ){                        
-                            i_p = proj[j-1].index;
-                            i_d = proj[k].index;
-                            diff = fabs( proj[j].xcoor - proj[j-1].xcoor );                         
-                        }
-                    }
+        free( proj );
+    }
 
-                    else if( proj[j].label == 1 && proj[j-1].label == 1 ){
-                        for( k=j-1 ; k>=0 ; k-- ){
-                            if( proj[k].label == 0 && proj[k].index != npix ){
-                                flag2 = 1;
-                                break;
-                            }
-                        }
-                        if( flag2 ){                        
-                            i_d = proj[j-1].index;
-                            i_p = proj[k].index;
-                            diff = fabs( proj[j].xcoor - proj[j-1].xcoor );                         
-                        }
-                    }
+    return failed ? -1 : 0;
+}
 
-                    if( proj[j].index == npix )
-                        break;                      
-
-                    if( flag2 ){ 
-                        if( oper == 0 )
-                            sino[ ( nang -1 - v ) * npix + i_d ] += diff * image[ i * npix + i_p ];
-                        else
-                            image[ i * npix + i_p ] += diff * sino[ ( nang -1 - v ) * npix + i_d ];
-                        flag2 = 0;
-                        i_d   = -1;
-                        i_p   = -1;
-                        diff  = -1;
-                    }
+
+
+
+//  Backprojector: the angles of branches 0 and 2 only write image row i
+//  when processing row i, the angles of branches 1 and 3 only write image
+//  column i; the image is therefore backprojected in two passes, first
+//  distributing the (row,slice block) pairs and then the (column,slice
+//  block) pairs among the threads, with the loop over the angles innermost;
+//  only the sinogram rows of the nsub angles listed in subset are read, all
+//  of them when subset is NULL; -1 is returned when a private buffer
+//  cannot be allocated, 0 otherwise
+int backproj_dd( Plan_dd *plan , float* image , int nslices , int *subset , int nsub ,
+                 int num_cores , float *sino )
+{
+    int nblocks, failed = 0;
+    int npix = plan->npix , nang = plan->nang;
+    long is, ss;
+
+    nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+    is      = (long)npix * npix;
+    ss      = (long)nang * npix;
+
+    if( subset == NULL )
+        nsub = nang;
+
+    #pragma omp parallel num_threads( num_cores )
+    {
+        int r, a, v, i, j, z, z0, nz, nh;
+        float s, c, x, y;
+        float *sino_row, *img;
+        Proj *proj = ( Proj * )malloc( 2 * ( npix + 1 ) * sizeof( Proj ) );
+
+        if( proj == NULL ){
+            #pragma omp atomic write
+            failed = 1;
+        }
+
+        nh = ( int )( npix * 0.5 );
+
+        #pragma omp for schedule( runtime )
+        for( r=0 ; r<npix*nblocks ; r++ ){
+            if( proj == NULL )
+                continue;
+
+            i   = r / nblocks;
+            z0  = ( r % nblocks ) * SLICE_BLOCK;
+            nz  = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+            img = image + z0 * is;
+            y   = i - nh + 0.5;
+
+            for( a=0 ; a<nsub ; a++ ){
+                v        = ( subset == NULL ) ? a : subset[a];
+                s        = plan->sin_tab[v];
+                c        = plan->cos_tab[v];
+                sino_row = sino + z0 * ss + ( nang - 1 - v ) * npix;
+
+                switch( plan->branch[v] ){
+                    case 0:
+                        for( z=0 ; z<nz ; z++ )
+                            for( j=0 ; j<npix ; j++ )
+                                img[ z * is + i * npix + j ] += sino_row[ z * ss + i ];
+                        break;
+
+                    case 2:
+                        merge_boundaries( proj , npix , y , c , s );
+                        sweep_boundaries( proj , npix , img + i * npix , 1 , sino_row ,
+                                          nz , is , ss , 1 , NULL );
+                        break;
+                }
+            }
+        }
+
+        #pragma omp for schedule( runtime )
+        for( r=0 ; r<npix*nblocks ; r++ ){
+            if( proj == NULL )
+                continue;
+
+            i   = r / nblocks;
+            z0  = ( r % nblocks ) * SLICE_BLOCK;
+            nz  = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+            img = image + z0 * is;
+            x   = i - nh + 0.5;
+
+            for( a=0 ; a<nsub ; a++ ){
+                v        = ( subset == NULL ) ? a : subset[a];
+                s        = plan->sin_tab[v];
+                c        = plan->cos_tab[v];
+                sino_row = sino + z0 * ss + ( nang - 1 - v ) * npix;
+
+                switch( plan->branch[v] ){
+                    case 1:
+                        for( z=0 ; z<nz ; z++ )
+                            for( j=0 ; j<npix ; j++ )
+                                img[ z * is + j * npix + i ] += sino_row[ z * ss + i ];
+                        break;
+
+                    case 3:
+                        merge_boundaries( proj , npix , x , s , c );
+                        sweep_boundaries( proj , npix , img + i , npix , sino_row ,
+                                          nz , is , ss , 1 , NULL );
+                        break;
                 }
             }
-        } 
-        
-        
-        else if( theta < pi/2.0 && theta != 0.0 ){ 
+        }
+
+        free( proj );
+    }
+
+    return failed ? -1 : 0;
+}
+
+
+
+
+//  Triplets of the sinogram row v, following forwproj_dd step by step
+static void triplets_dd( Proj *proj , int npix , float theta , int v , int nang , Triplets *tr )
+{
+    int i, j, nh;
+    float s, c, x, y;
+
+    nh = ( int )( npix * 0.5 );
+    s  = sin( theta );
+    c  = cos( theta );
+
+    tr->r = ( nang - 1 - v ) * npix;
+
+    switch( dd_branch( theta , s , c ) ){
+        case 0:
+            for( i=0 ; i<npix ; i++ )
+                for( j=0 ; j<npix ; j++ )
+                    add_triplet( tr , tr->r + i , i * npix + j , 1.0 );
+            break;
+
+        case 1:
+            for( i=0 ; i<npix ; i++ )
+                for( j=0 ; j<npix ; j++ )
+                    add_triplet( tr , tr->r + i , j * npix + i , 1.0 );
+            break;
+
+        case 2:
             for( i=0 ; i<npix ; i++ ){
-                x  = i - nh + 0.5;
+                y = i - nh + 0.5;
+                tr->c = i * npix;
+                merge_boundaries( proj , npix , y , c , s );
+                sweep_boundaries( proj , npix , NULL , 1 , NULL , 1 , 0 , 0 , 2 , tr );
+            }
+            break;
 
-                for( j=0 ; j<npix+1 ; j++ ){
-                    y  = j - nh;
+        case 3:
+            for( i=0 ; i<npix ; i++ ){
+                x = i - nh + 0.5;
+                tr->c = i;
+                merge_boundaries( proj , npix , x , s , c );
+                sweep_boundaries( proj , npix , NULL , npix , NULL , 1 , 0 , 0 , 2 , tr );
+            }
+            break;
+    }
+}
 
-                    proj[2*j].xcoor   = y - x * s / c;
-                    proj[2*j].label   = 0;
-                    proj[2*j].index   = j;
-                    proj[2*j+1].xcoor = y / c;
-                    proj[2*j+1].label = 1;
-                    proj[2*j+1].index = j;
-                }
 
-                quick_sort( proj , nt );
-                
-                flag1 = 0;
-                flag2 = 0;
-                i_p   = -1;
-                i_d   = -1;
-                diff  = -1;
-
-                for( j=1 ; j<nt ; j++ ){
-                    if( proj[j].label == 1 && proj[j-1].label == 0 ){
-                        if( flag1 == 0 )
-                            flag1 = 1;
-                        else{
-                            i_d = proj[j].index - 1;
-                            i_p = proj[j-1].index;
-                            diff = fabs( proj[j].xcoor - proj[j-1].xcoor );
-                            flag2 = 1;
-                        }
-                    }
 
-                    else if( proj[j].label == 0 && proj[j-1].label == 1 ){
-                        if( flag1 == 0 )
-                            flag1 = 1;
-                        else{                         
-                            i_p = proj[j].index - 1;
-                            i_d = proj[j-1].index;
-                            diff = fabs( proj[j].xcoor - proj[j-1].xcoor );
-                            flag2 = 1;
-                        }
-                    }
 
-                    else if( proj[j].label == 0 && proj[j-1].label == 0 ){
-                        for( k=j-1 ; k>=0 ; k-- ){
-                            if( proj[k].label == 1 && proj[k].index != npix ){
-                                flag2 = 1;
-                                break;
-                            }
-                        }
-                        if( flag2 ){                        
-                            i_p = proj[j-1].index;
-                            i_d = proj[k].index;
-                            diff = fabs( proj[j].xcoor - proj[j-1].xcoor );                         
-                        }
-                    }
+//  System matrix of the forward projector in coordinate format, built
+//  angle by angle in parallel, in two calls:
+//  rows == NULL  --->  count[v] receives the number of triplets of angle v
+//  otherwise     --->  the triplets of angle v are written from the
+//                      offset count[v] of rows, cols and vals
+//  Repeated ( row , col ) pairs are meant to be summed; -1 is returned
+//  when a private buffer cannot be allocated, 0 otherwise
+int matrix_dd( int npix , float *angles , int nang , int num_cores ,
+               long *count , int *rows , int *cols , float *vals )
+{
+    int failed = 0;
 
-                    else if( proj[j].label == 1 && proj[j-1].label == 1 ){
-                        for( k=j-1 ; k>=0 ; k-- ){
-                            if( proj[k].label == 0 && proj[k].index != npix ){
-                                flag2 = 1;
-                                break;
-                            }
-                        }
-                        if( flag2 ){                        
-                            i_d = proj[j-1].index;
-                            i_p = proj[k].index;
-                            diff = fabs( proj[j].xcoor - proj[j-1].xcoor );                         
-                        }
-                    }
+    if( num_cores < 1 )
+        num_cores = 1;
 
-                    if( proj[j].index == npix )
-                        break;                      
-
-                    if( flag2 ){ 
-                        if( oper == 0 )
-                            sino[ ( nang -1 - v ) * npix + i_d ] += diff * image[ i_p * npix + i ];
-                        else
-                            image[ i_p * npix + i ] += diff * sino[ ( nang -1 - v ) * npix + i_d ];
-                        flag2 = 0;
-                        i_d   = -1;
-                        i_p   = -1;
-                        diff  = -1;
-                    }
-                }
-            }          
+    #pragma omp parallel num_threads( num_cores )
+    {
+        int v;
+        Triplets tr;
+        Proj *proj = ( Proj * )malloc( 2 * ( npix + 1 ) * sizeof( Proj ) );
+
+        if( proj == NULL ){
+            #pragma omp atomic write
+            failed = 1;
         }
+
+        #pragma omp for schedule( runtime )
+        for( v=0 ; v<nang ; v++ ){
+            if( proj == NULL )
+                continue;
+
+            tr.n = 0;
+
+            if( rows == NULL ){
+                tr.row = NULL;  tr.col = NULL;  tr.val = NULL;
+                triplets_dd( proj , npix , angles[v] , v , nang , &tr );
+                count[v] = tr.n;
+            }
+            else{
+                tr.row = rows + count[v];  tr.col = cols + count[v];  tr.val = vals + count[v];
+                triplets_dd( proj , npix , angles[v] , v , nang , &tr );
+            }
+        }
+
+        free( proj );
+    }
+
+    return failed ? -1 : 0;
+}
+
+
+
+
+//  Copy of the slices [ z0 , z0 + nz ) of a strided input into the C-contiguous
+//  float32 buffer buf ( nz x nrows x ncols ); the element ( z , i , j ) of the
+//  input lies at the byte offset z * sz + ( i - row0 ) * sr + j * sc from data and
+//  is stored as float32 ( dtype 0 ) or float64 ( dtype 1 ); only the rows
+//  nrows - 1 - v of the nsub angles v listed in subset are copied, all the
+//  rows when subset is NULL, and the other rows of buf are left as they are
+static void gather_slices( char *data , long sz , long sr , long sc , int dtype , int z0 ,
+                           int nz , int nrows , int ncols , int row0 , int *subset , int nsub ,
+                           int num_cores , float *buf )
+{
+    long r;
+    int i, j;
+    char *row;
+    float *dst;
+
+    if( subset == NULL )
+        nsub = nrows;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) \
+                         private( i , j , row , dst )
+    for( r=0 ; r<(long)nz*nsub ; r++ ){
+        i   = ( subset == NULL ) ? r % nsub : nrows - 1 - subset[ r % nsub ];
+        row = data + ( z0 + r / nsub ) * sz + ( i - row0 ) * sr;
+        dst = buf + ( ( r / nsub ) * nrows + i ) * ncols;
+
+        if( dtype == 0 )
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = *( float * )( row + j * sc );
+        else
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = (float)*( double * )( row + j * sc );
+    }
+}
+
+
+
+
+//  Projectors of a stack of nslices images ( nslices x npix x npix ) and
+//  sinograms ( nslices x nang x npix ), both C-contiguous, with a plan;
+//  only the nsub angles listed in subset are projected, all of them when
+//  subset is NULL; -1 is returned when the memory of the projectors
+//  cannot be allocated, 0 otherwise
+int plan_dd_execute( Plan_dd *plan , float* image , int nslices , int oper , int *subset ,
+                     int nsub , int num_cores , float *sino )
+{
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( oper == 0 )
+        return forwproj_dd( plan , image , nslices , subset , nsub , num_cores , sino );
+    else
+        return backproj_dd( plan , image , nslices , subset , nsub , num_cores , sino );
+}
+
+
+
+
+//  Projectors of a stack of nslices inputs given as a strided view ( see
+//  gather_slices ) into a C-contiguous float32 output: a C-contiguous
+//  float32 input is projected in place, any other layout is converted on
+//  the fly by blocks of SLICE_BLOCK slices, without ever holding a copy
+//  of the whole stack.  The sinograms given to the adjoint ( oper 1 ) may
+//  also be blocks of consecutive rows, row0 being the sinogram row of
+//  their first row: only the rows of the nsub angles listed in subset
+//  are then read, and the contiguous path is only taken for row0 = 0;
+//  -1 is returned when the memory cannot be
+//  allocated, 0 otherwise
+int plan_dd_execute_strided( Plan_dd *plan , char *data , long sz , long sr , long sc ,
+                             int dtype , int nslices , int oper , int row0 , int *subset ,
+                             int nsub , int num_cores , float *out )
+{
+    int npix, nrows, nbuf, z0, nz, err = 0;
+    long nin, nout;
+    float *buf;
+
+    npix  = plan->npix;
+    nrows = ( oper == 0 ) ? npix : plan->nang;
+    nin   = (long)nrows * npix;
+    nout  = ( oper == 0 ) ? (long)plan->nang * npix : (long)npix * npix;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( dtype == 0 && row0 == 0 && sc == sizeof( float ) && sr == npix * sizeof( float ) &&
+        ( nslices == 1 || sz == nin * sizeof( float ) ) ){
+        if( oper == 0 )
+            return plan_dd_execute( plan , ( float * )data , nslices , 0 , subset , nsub ,
+                                    num_cores , out );
+        else
+            return plan_dd_execute( plan , out , nslices , 1 , subset , nsub , num_cores ,
+                                    ( float * )data );
+    }
+
+    nbuf = ( nslices < SLICE_BLOCK ) ? nslices : SLICE_BLOCK;
+    buf  = ( float * )malloc( nbuf * nin * sizeof( float ) );
+
+    if( buf == NULL )
+        return -1;
+
+    for( z0=0 ; z0<nslices && err==0 ; z0+=SLICE_BLOCK ){
+        nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+
+        if( oper == 0 )
+            gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , 0 , NULL , 0 ,
+                           num_cores , buf );
+        else
+            gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , row0 , subset ,
+                           nsub , num_cores , buf );
+
+        if( oper == 0 )
+            err = plan_dd_execute( plan , buf , nz , 0 , subset , nsub , num_cores ,
+                                   out + z0 * nout );
+        else
+            err = plan_dd_execute( plan , out + z0 * nout , nz , 1 , subset , nsub , num_cores ,
+                                   buf );
     }
+
+    free( buf );
+
+    return err;
+}
+
+
+
+
+//  Same as above for a single call, with a plan used once; -1 is returned
+//  when the memory cannot be allocated, 0 otherwise
+int radon_dd( float* image , int nslices , int npix , float *angles , int nang , int oper ,
+              int num_cores , float *sino )
+{
+    int err;
+    Plan_dd *plan = plan_dd_create( npix , angles , nang );
+
+    if( plan == NULL )
+        return -1;
+
+    err = plan_dd_execute( plan , image , nslices , oper , NULL , 0 , num_cores , sino );
+    plan_dd_destroy( plan );
+
+    return err;
 }
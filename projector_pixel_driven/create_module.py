@@ -11,5 +11,5 @@ setup(
                                        "radon_pd.c" 
                                        ],
                              include_dirs=[numpy.get_include()],libraries=['gcov'],
-    extra_compile_args=['-w','-O3','-march=native','-ffast-math','-fprofile-generate','-fopenmp'],extra_link_args=['-fprofile-generate'])],
+    extra_compile_args=['-w','-O3','-march=native','-ffast-math','-fprofile-generate','-fopenmp'],extra_link_args=['-fprofile-generate','-fopenmp'])],
 )
@@ -1,66 +1,197 @@
 /*
- *  IMPLEMENTATION OF THE PIXEL-DRIVEN TOMOGRAPHIC PROJECTORS 
+ *  IMPLEMENTATION OF THE PIXEL-DRIVEN TOMOGRAPHIC PROJECTORS
  */
 
 
 #include <math.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <omp.h>
 
 #define pi 3.141592653589793
 
-float delta[ 8 ] = { 
-                     -0.25 , -0.25 , 0.25 , -0.25 ,
-                     -0.25 , 0.25 , 0.25 , 0.25  
-                    };
+//  Number of slices sharing the geometry computed for one angle
+#define SLICE_BLOCK 8
 
+//  Offsets of the sub-pixels: a read-only table with internal linkage, so
+//  that concurrent calls from different threads share no writable state
+static const float delta[ 8 ] = {
+                                  -0.25 , -0.25 , 0.25 , -0.25 ,
+                                  -0.25 , 0.25 , 0.25 , 0.25
+                                 };
 
 
 
-void radon_pd( float* image , int npix , float *angles , int nang , int oper , int method , float *sino )
+
+//  Triplets ( row , col , val ) of the system matrix; while row is NULL
+//  the triplets are only counted
+typedef struct{
+    int   *row, *col;
+    float *val;
+    long  n;
+    int   last_row, last_col;
+} Triplets;
+
+
+
+
+static inline void add_triplet( Triplets *tr , int row , int col , float val )
 {
-    int v, i, j, k, l, u, nh;
-    float x0, y0, x, y, theta, s, c, t, uf, lf;
+    if( val == 0 )
+        return;
 
-    nh = (int)( npix * 0.5 );
+    //  Consecutive contributions to the same element are merged
+    if( tr->n > 0 && row == tr->last_row && col == tr->last_col ){
+        if( tr->row != NULL )
+            tr->val[ tr->n - 1 ] += val;
+        return;
+    }
+
+    if( tr->row != NULL ){
+        tr->row[ tr->n ] = row;
+        tr->col[ tr->n ] = col;
+        tr->val[ tr->n ] = val;
+    }
+    tr->last_row = row;
+    tr->last_col = col;
+    tr->n++;
+}
+
+
+
+
+//  Signed detector coordinate of the sub-pixel (x,y) for the angle theta
+static inline float pd_coord( float x , float y , float theta , float s , float c )
+{
+    float t = fabs( x * s - y * c );
+
+    if( theta < pi/2 && y > x*s/c )
+        return t;
+    else if( theta > pi/2 && y > x*s/c )
+        return t;
+    else if( theta == 0 && y > 0 )
+        return t;
+    else if( theta == pi/2 && x < 0 )
+        return t;
+    else
+        return -t;
+}
+
+
+
+
+//  Plan of the projectors for a given geometry: the angles and their
+//  trigonometric tables are computed once and reused by every call
+typedef struct{
+    int   npix, nang, method;
+    float *angles, *sin_tab, *cos_tab;
+} Plan_pd;
 
-    int counter = 0;
+
+
+
+void plan_pd_destroy( Plan_pd *plan );
+
+
+
+
+//  NULL is returned when the tables cannot be allocated
+Plan_pd *plan_pd_create( int npix , float *angles , int nang , int method )
+{
+    int v;
+    Plan_pd *plan = ( Plan_pd * )malloc( sizeof( Plan_pd ) );
+
+    if( plan == NULL )
+        return NULL;
+
+    plan->npix    = npix;
+    plan->nang    = nang;
+    plan->method  = method;
+    plan->angles  = ( float * )malloc( nang * sizeof( float ) );
+    plan->sin_tab = ( float * )malloc( nang * sizeof( float ) );
+    plan->cos_tab = ( float * )malloc( nang * sizeof( float ) );
+
+    if( plan->angles == NULL || plan->sin_tab == NULL || plan->cos_tab == NULL ){
+        plan_pd_destroy( plan );
+        return NULL;
+    }
 
     for( v=0 ; v<nang ; v++ ){
-        theta = angles[v];
-        s     = sin( theta );
-        c     = cos( theta );
+        plan->angles[v]  = angles[v];
+        plan->sin_tab[v] = sin( angles[v] );
+        plan->cos_tab[v] = cos( angles[v] );
+    }
+
+    return plan;
+}
+
+
+
+
+void plan_pd_destroy( Plan_pd *plan )
+{
+    free( plan->angles );
+    free( plan->sin_tab );
+    free( plan->cos_tab );
+    free( plan );
+}
+
+
+
+
+//  Forward projector: every (slice block,angle) pair writes only its own
+//  sinogram rows, hence the pairs are distributed among the threads; the
+//  detector coordinates of each sub-pixel are computed once and applied
+//  to all the slices of the block; subset lists the nsub angles of the
+//  plan to project, NULL for all of them, and the other sinogram rows are
+//  left untouched
+void forwproj_pd( Plan_pd *plan , float* image , int nslices , int *subset , int nsub ,
+                  int num_cores , float *sino )
+{
+    int r, v, b, z, z0, nz, nblocks, i, j, k, l, u, nh, p;
+    int npix = plan->npix , nang = plan->nang , method = plan->method;
+    long is, ss;
+    float x0, y0, x, y, theta, s, c, t, uf, lf, wl, wu;
+
+    nh      = (int)( npix * 0.5 );
+    is      = (long)npix * npix;
+    ss      = (long)nang * npix;
+    nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+
+    if( subset == NULL )
+        nsub = nang;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) \
+                         private( v , b , z , z0 , nz , theta , s , c , i , j , k , l , u , p , \
+                                  x0 , y0 , x , y , t , uf , lf , wl , wu )
+    for( r=0 ; r<nsub*nblocks ; r++ ){
+        v     = ( subset == NULL ) ? r / nblocks : subset[ r / nblocks ];
+        b     = r % nblocks;
+        z0    = b * SLICE_BLOCK;
+        nz    = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+        theta = plan->angles[v];
+        s     = plan->sin_tab[v];
+        c     = plan->cos_tab[v];
 
         for( i=0 ; i<npix ; i++ ){
 
             for( j=0 ; j<npix ; j++ ){
-            
+
                 x0 = j - (float)nh + 0.5;
                 y0 = i - (float)nh + 0.5;
+                p  = (npix-1-i)*npix + j;
 
                 for( k=0 ; k<4 ; k++ ){
                     x = x0 + delta[ 2*k + 1 ];
                     y = y0 + delta[ 2*k + 1 ];
-                    t = fabs( x * s - y * c );
-
-                    if( theta < pi/2 && y > x*s/c )
-                        t = t;
-                    else if( theta > pi/2 && y > x*s/c )
-                        t = t;
-                    else if( theta == 0 && y > 0 )
-                        t = t;
-                    else if( theta == pi/2 && x < 0 )
-                        t = t;
-                    else
-                        t = -t;
+                    t = pd_coord( x , y , theta , s , c );
 
                     if( method == 0 ){
                         l = (int)round( nh - 0.5 - t );
-                        
-                        if( oper == 0 )
-                            sino[v*npix + l] += 0.25 * image[(npix-1-i)*npix + j];
-                        else
-                            image[(npix-1-i)*npix + j] += 0.25 * sino[v*npix + l];
+
+                        if( l >= 0 && l < npix )
+                            for( z=z0 ; z<z0+nz ; z++ )
+                                sino[z*ss + v*npix + l] += 0.25 * image[z*is + p];
                     }
 
                     else{
@@ -69,22 +200,327 @@ void radon_pd( float* image , int npix , float *angles , int nang , int oper , i
                         uf = (float)ceil( t );
                         l  = (int)round( lf - 0.5 );
                         u  = (int)round( uf - 0.5 );
-                        
-                        if( oper == 0 ){
-                            if( l > 0 && l < npix )
-                                sino[v*npix + l] += 0.25 * image[(npix-1-i)*npix + j] * fabs( uf - t );
-                            if( u > 0 && u < npix )                             
-                                sino[v*npix + u] += 0.25 * image[(npix-1-i)*npix + j] * fabs( t - lf );
-                        }
-                        else{
-                            if( l > 0 && l < npix )
-                                image[(npix-1-i)*npix + j] += 0.25 * sino[v*npix + l] * fabs( uf - t );
-                            if( u > 0 && u < npix )
-                                image[(npix-1-i)*npix + j] += 0.25 * sino[v*npix + u] * fabs( t - lf );
-                        }                        
+                        wl = fabs( uf - t );
+                        wu = fabs( t - lf );
+
+                        if( l > 0 && l < npix )
+                            for( z=z0 ; z<z0+nz ; z++ )
+                                sino[z*ss + v*npix + l] += 0.25 * image[z*is + p] * wl;
+                        if( u > 0 && u < npix )
+                            for( z=z0 ; z<z0+nz ; z++ )
+                                sino[z*ss + v*npix + u] += 0.25 * image[z*is + p] * wu;
                     }
-                }        
-            }        
+                }
+            }
         }
     }
 }
+
+
+
+
+//  Backprojector in gather form: the loop over the angles is the
+//  innermost one, so that every thread owns a block of image rows of a
+//  block of slices and no two threads ever write the same pixel; only the
+//  sinogram rows of the nsub angles listed in subset are read, all of them
+//  when subset is NULL
+void backproj_pd( Plan_pd *plan , float* image , int nslices , int *subset , int nsub ,
+                  int num_cores , float *sino )
+{
+    int r, a, v, b, z, z0, nz, nblocks, i, j, k, l, u, nh;
+    int npix = plan->npix , nang = plan->nang , method = plan->method;
+    long is, ss;
+    float x0, y0, x, y, t, uf, lf, wl, wu;
+    float acc[ SLICE_BLOCK ];
+    float *angles = plan->angles , *sin_tab = plan->sin_tab , *cos_tab = plan->cos_tab;
+
+    nh      = (int)( npix * 0.5 );
+    is      = (long)npix * npix;
+    ss      = (long)nang * npix;
+    nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+
+    if( subset == NULL )
+        nsub = nang;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) \
+                         private( i , b , z , z0 , nz , a , v , j , k , l , u , x0 , y0 , x , y , \
+                                  t , uf , lf , wl , wu , acc )
+    for( r=0 ; r<npix*nblocks ; r++ ){
+        i  = r / nblocks;
+        b  = r % nblocks;
+        z0 = b * SLICE_BLOCK;
+        nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+        y0 = i - (float)nh + 0.5;
+
+        for( j=0 ; j<npix ; j++ ){
+            x0 = j - (float)nh + 0.5;
+
+            for( z=0 ; z<nz ; z++ )
+                acc[z] = 0.0;
+
+            for( a=0 ; a<nsub ; a++ ){
+                v = ( subset == NULL ) ? a : subset[a];
+
+                for( k=0 ; k<4 ; k++ ){
+                    x = x0 + delta[ 2*k + 1 ];
+                    y = y0 + delta[ 2*k + 1 ];
+                    t = pd_coord( x , y , angles[v] , sin_tab[v] , cos_tab[v] );
+
+                    if( method == 0 ){
+                        l = (int)round( nh - 0.5 - t );
+
+                        if( l >= 0 && l < npix )
+                            for( z=0 ; z<nz ; z++ )
+                                acc[z] += 0.25 * sino[(z0+z)*ss + v*npix + l];
+                    }
+
+                    else{
+                        t  = nh - t;
+                        lf = (float)floor( t );
+                        uf = (float)ceil( t );
+                        l  = (int)round( lf - 0.5 );
+                        u  = (int)round( uf - 0.5 );
+                        wl = fabs( uf - t );
+                        wu = fabs( t - lf );
+
+                        if( l > 0 && l < npix )
+                            for( z=0 ; z<nz ; z++ )
+                                acc[z] += 0.25 * sino[(z0+z)*ss + v*npix + l] * wl;
+                        if( u > 0 && u < npix )
+                            for( z=0 ; z<nz ; z++ )
+                                acc[z] += 0.25 * sino[(z0+z)*ss + v*npix + u] * wu;
+                    }
+                }
+            }
+
+            for( z=0 ; z<nz ; z++ )
+                image[(z0+z)*is + (npix-1-i)*npix + j] += acc[z];
+        }
+    }
+}
+
+
+
+
+//  Triplets of the sinogram row v, following forwproj_pd step by step
+static void triplets_pd( int npix , float theta , int v , int method , Triplets *tr )
+{
+    int i, j, k, l, u, nh, col;
+    float x0, y0, x, y, s, c, t, uf, lf;
+
+    nh = (int)( npix * 0.5 );
+    s  = sin( theta );
+    c  = cos( theta );
+
+    for( i=0 ; i<npix ; i++ ){
+
+        for( j=0 ; j<npix ; j++ ){
+
+            x0  = j - (float)nh + 0.5;
+            y0  = i - (float)nh + 0.5;
+            col = (npix-1-i)*npix + j;
+
+            for( k=0 ; k<4 ; k++ ){
+                x = x0 + delta[ 2*k + 1 ];
+                y = y0 + delta[ 2*k + 1 ];
+                t = pd_coord( x , y , theta , s , c );
+
+                if( method == 0 ){
+                    l = (int)round( nh - 0.5 - t );
+
+                    if( l >= 0 && l < npix )
+                        add_triplet( tr , v*npix + l , col , 0.25 );
+                }
+
+                else{
+                    t  = nh - t;
+                    lf = (float)floor( t );
+                    uf = (float)ceil( t );
+                    l  = (int)round( lf - 0.5 );
+                    u  = (int)round( uf - 0.5 );
+
+                    if( l > 0 && l < npix )
+                        add_triplet( tr , v*npix + l , col , 0.25 * fabs( uf - t ) );
+                    if( u > 0 && u < npix )
+                        add_triplet( tr , v*npix + u , col , 0.25 * fabs( t - lf ) );
+                }
+            }
+        }
+    }
+}
+
+
+
+
+//  System matrix of the forward projector in coordinate format, built
+//  angle by angle in parallel, in two calls:
+//  rows == NULL  --->  count[v] receives the number of triplets of angle v
+//  otherwise     --->  the triplets of angle v are written from the
+//                      offset count[v] of rows, cols and vals
+//  Repeated ( row , col ) pairs are meant to be summed
+void matrix_pd( int npix , float *angles , int nang , int method , int num_cores ,
+                long *count , int *rows , int *cols , float *vals )
+{
+    int v;
+    Triplets tr;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) private( tr )
+    for( v=0 ; v<nang ; v++ ){
+        tr.n = 0;
+
+        if( rows == NULL ){
+            tr.row = NULL;  tr.col = NULL;  tr.val = NULL;
+            triplets_pd( npix , angles[v] , v , method , &tr );
+            count[v] = tr.n;
+        }
+        else{
+            tr.row = rows + count[v];  tr.col = cols + count[v];  tr.val = vals + count[v];
+            triplets_pd( npix , angles[v] , v , method , &tr );
+        }
+    }
+}
+
+
+
+
+//  Copy of the slices [ z0 , z0 + nz ) of a strided input into the C-contiguous
+//  float32 buffer buf ( nz x nrows x ncols ); the element ( z , i , j ) of the
+//  input lies at the byte offset z * sz + ( i - row0 ) * sr + j * sc from data and
+//  is stored as float32 ( dtype 0 ) or float64 ( dtype 1 ); only the rows of
+//  the nsub angles listed in subset are copied, all the rows when subset is
+//  NULL, and the other rows of buf are left as they are
+static void gather_slices( char *data , long sz , long sr , long sc , int dtype , int z0 ,
+                           int nz , int nrows , int ncols , int row0 , int *subset , int nsub ,
+                           int num_cores , float *buf )
+{
+    long r;
+    int i, j;
+    char *row;
+    float *dst;
+
+    if( subset == NULL )
+        nsub = nrows;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) \
+                         private( i , j , row , dst )
+    for( r=0 ; r<(long)nz*nsub ; r++ ){
+        i   = ( subset == NULL ) ? r % nsub : subset[ r % nsub ];
+        row = data + ( z0 + r / nsub ) * sz + ( i - row0 ) * sr;
+        dst = buf + ( ( r / nsub ) * nrows + i ) * ncols;
+
+        if( dtype == 0 )
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = *( float * )( row + j * sc );
+        else
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = (float)*( double * )( row + j * sc );
+    }
+}
+
+
+
+
+//  Projectors of a stack of nslices images ( nslices x npix x npix ) and
+//  sinograms ( nslices x nang x npix ), both C-contiguous, with a plan;
+//  only the nsub angles listed in subset are projected, all of them when
+//  subset is NULL
+void plan_pd_execute( Plan_pd *plan , float* image , int nslices , int oper , int *subset ,
+                      int nsub , int num_cores , float *sino )
+{
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( oper == 0 )
+        forwproj_pd( plan , image , nslices , subset , nsub , num_cores , sino );
+    else
+        backproj_pd( plan , image , nslices , subset , nsub , num_cores , sino );
+}
+
+
+
+
+//  Projectors of a stack of nslices inputs given as a strided view ( see
+//  gather_slices ) into a C-contiguous float32 output: a C-contiguous
+//  float32 input is projected in place, any other layout is converted on
+//  the fly by blocks of SLICE_BLOCK slices, without ever holding a copy
+//  of the whole stack.  The sinograms given to the adjoint ( oper 1 ) may
+//  also be blocks of consecutive rows, row0 being the sinogram row of
+//  their first row: only the rows of the nsub angles listed in subset
+//  are then read, and the contiguous path is only taken for row0 = 0;
+//  -1 is returned when the buffer of the blocks
+//  cannot be allocated, 0 otherwise
+int plan_pd_execute_strided( Plan_pd *plan , char *data , long sz , long sr , long sc ,
+                             int dtype , int nslices , int oper , int row0 , int *subset ,
+                             int nsub , int num_cores , float *out )
+{
+    int npix, nrows, nbuf, z0, nz;
+    long nin, nout;
+    float *buf;
+
+    npix  = plan->npix;
+    nrows = ( oper == 0 ) ? npix : plan->nang;
+    nin   = (long)nrows * npix;
+    nout  = ( oper == 0 ) ? (long)plan->nang * npix : (long)npix * npix;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( dtype == 0 && row0 == 0 && sc == sizeof( float ) && sr == npix * sizeof( float ) &&
+        ( nslices == 1 || sz == nin * sizeof( float ) ) ){
+        if( oper == 0 )
+            plan_pd_execute( plan , ( float * )data , nslices , 0 , subset , nsub , num_cores ,
+                             out );
+        else
+            plan_pd_execute( plan , out , nslices , 1 , subset , nsub , num_cores ,
+                             ( float * )data );
+        return 0;
+    }
+
+    nbuf = ( nslices < SLICE_BLOCK ) ? nslices : SLICE_BLOCK;
+    buf  = ( float * )malloc( nbuf * nin * sizeof( float ) );
+
+    if( buf == NULL )
+        return -1;
+
+    for( z0=0 ; z0<nslices ; z0+=SLICE_BLOCK ){
+        nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+
+        if( oper == 0 )
+            gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , 0 , NULL , 0 ,
+                           num_cores , buf );
+        else
+            gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , row0 , subset ,
+                           nsub , num_cores , buf );
+
+        if( oper == 0 )
+            plan_pd_execute( plan , buf , nz , 0 , subset , nsub , num_cores , out + z0 * nout );
+        else
+            plan_pd_execute( plan , out + z0 * nout , nz , 1 , subset , nsub , num_cores , buf );
+    }
+
+    free( buf );
+
+    return 0;
+}
+
+
+
+
+//  Same as above for a single call, with a plan used once; -1 is returned
+//  when the plan cannot be allocated, 0 otherwise
+int radon_pd( float* image , int nslices , int npix , float *angles , int nang , int oper ,
+              int method , int num_cores , float *sino )
+{
+    Plan_pd *plan = plan_pd_create( npix , angles , nang , method );
+
+    if( plan == NULL )
+        return -1;
+
+    plan_pd_execute( plan , image , nslices , oper , NULL , 0 , num_cores , sino );
+    plan_pd_destroy( plan );
+
+    return 0;
+}
@@ -1,61 +1,363 @@
 import cython
 
 import numpy as np
+import scipy.sparse as sp
+import multiprocessing as mproc
 cimport numpy as np
+cimport openmp
 
 
-cdef extern void radon_rd( float* image , int npix , float* angles , int nang ,
-                           int oper , float* sino )
+cdef extern void* plan_rd_create( int npix , float* angles , int nang ) nogil
 
+cdef extern void plan_rd_destroy( void* plan ) nogil
 
-                    
+cdef extern int plan_rd_execute_strided( void* plan , char* data , long sz , long sr , long sc ,
+                                         int dtype , int nslices , int oper , int row0 ,
+                                         int* subset , int nsub , int num_cores ,
+                                         float* out ) nogil
 
-@cython.boundscheck( False )
-@cython.wraparound( False )
-def forwproj( np.ndarray[ float , ndim=2 , mode="c" ] image not None ,
-              np.ndarray[ float , ndim=1 , mode="c" ] angles not None ):
+cdef extern int matrix_rd( int npix , float* angles , int nang , int num_cores ,
+                           long* count , int* rows , int* cols , float* vals ) nogil
 
-    cdef int nang , npix , oper
 
-    npix = image.shape[0]
-    nang = len( angles )
-    myfloat = image.dtype
 
-    oper = 0
+##  OpenMP schedules accepted by the keyword "schedule" of the projectors,
+##  given as in the environment variable OMP_SCHEDULE, e.g. 'dynamic,4'
+omp_schedules = { 'static'  : openmp.omp_sched_static ,
+                  'dynamic' : openmp.omp_sched_dynamic ,
+                  'guided'  : openmp.omp_sched_guided ,
+                  'auto'    : openmp.omp_sched_auto }
+
+
+##  Set the schedule of the OpenMP loops run by the calling thread and
+##  return the number of threads; num_threads=None uses all the cores, an
+##  unknown schedule raises ValueError
+cdef int parallel_setup( num_threads , schedule ) except -1:
+    cdef int chunk = 0
+
+    if num_threads is None:
+        num_threads = mproc.cpu_count()
+
+    if schedule is None:
+        schedule = 'static'
+
+    fields = schedule.replace( ' ' , '' ).split( ',' )
+
+    if fields[0] not in omp_schedules:
+        raise ValueError( 'OpenMP schedule "' + schedule + '" not supported !!' )
+
+    if len( fields ) > 1:
+        chunk = int( fields[1] )
+
+    openmp.omp_set_schedule( <openmp.omp_sched_t> omp_schedules[ fields[0] ] , chunk )
+
+    return max( int( num_threads ) , 1 )
+
+
+
+
+##  Angles in radians, as expected by the native code, computed on a copy
+##  so that the array of the caller is never modified
+def convert_angles( angles ):
+    angles = np.array( angles , dtype=np.float32 )
 
     if np.max( angles ) > 2 * np.pi:
         angles *= np.pi / 180.0
 
-    sino = np.zeros( ( nang , npix ) , dtype=myfloat, order='C' )
-    
-    cdef float [:,::1] csino = sino
+    return np.ascontiguousarray( angles )
+
+
+
+
+##  Subset of the angles given as distinct rows of the sinogram, checked
+##  and converted to a C-contiguous int32 array; rows out of range or
+##  repeated raise ValueError
+def convert_indices( angle_indices , nang ):
+    rows = np.array( angle_indices , dtype=np.int32 ).reshape( -1 )
+
+    if np.any( rows < 0 ) or np.any( rows >= nang ) or len( np.unique( rows ) ) != len( rows ):
+        raise ValueError( 'angle_indices must be distinct rows of the sinogram between 0 and ' +
+                          str( nang - 1 ) + ' !!' )
+
+    return np.ascontiguousarray( rows )
+
+
+
+
+##  Plan of the ray-driven projectors, built once for the geometry ( npix ,
+##  angles ): the angles are converted and the trigonometric
+##  tables and the sub-ray end points are computed only at creation;
+##  forward and adjoint can then be applied any number of times to images
+##  ( npix x npix ) and sinograms ( nang x npix ), or to stacks of them;
+##  out is an optional C-contiguous float32 array receiving the result,
+##  overwritten or, with accumulate=True, summed to; angle_indices restricts
+##  the projection to some rows of the sinogram, the other rows of out are
+##  left untouched by forward and ignored by adjoint; adjoint also takes
+##  blocks of consecutive rows of the sinograms, the first one being the
+##  row row_offset, e.g. the chunks of a streaming filtered backprojection
+cdef class plan:
+    cdef void* cplan
+    cdef readonly int npix , nang
+    cdef readonly object angles
+
+    def __cinit__( self , int npix , angles ):
+        cdef float [::1] cangles
+        cdef float* pangles
+        cdef void* cplan
+        cdef int nang
+
+        self.npix   = npix
+        self.angles = convert_angles( angles )
+        self.nang   = len( self.angles )
+
+        cangles = self.angles
+        pangles = &cangles[0]
+        nang    = self.nang
+
+        with nogil:
+            cplan = plan_rd_create( npix , pangles , nang )
+
+        if cplan == NULL:
+            raise MemoryError()
+
+        self.cplan = cplan
+
+
+    def __dealloc__( self ):
+        if self.cplan != NULL:
+            plan_rd_destroy( self.cplan )
+
+
+    def forward( self , image , out=None , accumulate=False , num_threads=None , schedule=None ,
+                 angle_indices=None ):
+        return self.execute( image , out , accumulate , 0 , num_threads , schedule ,
+                             angle_indices , None )
+
+
+    def adjoint( self , sino , out=None , accumulate=False , num_threads=None , schedule=None ,
+                 angle_indices=None , row_offset=None ):
+        return self.execute( sino , out , accumulate , 1 , num_threads , schedule ,
+                             angle_indices , row_offset )
+
+
+    cdef execute( self , x , out , accumulate , int oper , num_threads , schedule ,
+                  angle_indices , row_offset ):
+        cdef int nslices , num_cores , dtype , err , row0 = 0 , nsub = 0
+        cdef long sz , sr , sc
+        cdef np.ndarray cx
+        cdef float [::1] cout
+        cdef int [::1] csubset
+        cdef void* cplan = self.cplan
+        cdef char* data
+        cdef float* pout
+        cdef int* psubset = NULL
+
+        if oper == 0:
+            shape_in , shape_out = ( self.npix , self.npix ) , ( self.nang , self.npix )
+        else:
+            shape_in , shape_out = ( self.nang , self.npix ) , ( self.npix , self.npix )
+
+        ##  float32 and float64 arrays of any strides are projected without
+        ##  copies; anything else is first converted to float32
+        x = np.asarray( x )
+
+        if x.dtype != np.float32 and x.dtype != np.float64:
+            x = x.astype( np.float32 )
+
+        ##  Block of consecutive rows of the sinograms, from the row row_offset
+        if row_offset is not None:
+            row0     = row_offset
+            shape_in = ( x.shape[-2] if x.ndim > 1 else 0 , self.npix )
+
+            if row0 < 0 or row0 + shape_in[0] > self.nang:
+                raise ValueError( 'block of ' + str( shape_in[0] ) + ' rows from the row ' +
+                                  str( row0 ) + ' does not fit in the sinogram !!' )
+
+        if ( x.ndim != 2 and x.ndim != 3 ) or x.shape[-2:] != shape_in:
+            raise ValueError( 'array of shape ' + str( x.shape ) + ' does not match the plan !!' )
+
+        nslices = 1 if x.ndim == 2 else x.shape[0]
+        shape   = x.shape[:-2] + shape_out
+
+        ##  Rows of the sinograms to project, all of them when rows is None
+        rows = None
+
+        if angle_indices is not None:
+            rows = convert_indices( angle_indices , self.nang )
+
+        ##  A block only reaches the angles of its rows
+        if row_offset is not None:
+            if rows is None:
+                rows = np.arange( row0 , row0 + shape_in[0] , dtype=np.int32 )
+            elif np.any( rows < row0 ) or np.any( rows >= row0 + shape_in[0] ):
+                raise ValueError( 'angle_indices must be rows of the block of the sinogram !!' )
 
-    radon_rd( &image[0,0] , npix , &angles[0] , nang , oper , &csino[0,0] )
-                                 
-    return sino
+        ##  Subset of the angles: the angle v of the plan is the sinogram row v
+        if rows is not None:
+            subset = rows
+            nsub   = len( subset )
+
+        if out is None:
+            out = np.zeros( shape , dtype=np.float32 )
+        elif out.shape != shape or out.dtype != np.float32 or not out.flags.c_contiguous:
+            raise ValueError( 'out must be a C-contiguous float32 array of shape ' +
+                              str( shape ) + ' !!' )
+        elif not accumulate:
+            if oper == 0 and angle_indices is not None:
+                out[...,rows,:] = 0
+            else:
+                out[...] = 0
+
+        ##  An empty stack has nothing to project
+        if nslices == 0:
+            return out
+
+        if rows is not None:
+            if nsub == 0:
+                return out
+            csubset = subset
+            psubset = &csubset[0]
+
+        num_cores = parallel_setup( num_threads , schedule )
+
+        ##  Strided view of the input, read by the native code as it is
+        cx    = x
+        dtype = 0 if x.dtype == np.float32 else 1
+        sz    = x.strides[0] if x.ndim == 3 else 0
+        sr    = x.strides[x.ndim-2]
+        sc    = x.strides[x.ndim-1]
+        cout  = out.reshape( -1 )
+        data  = <char*> np.PyArray_DATA( cx )
+        pout  = &cout[0]
+
+        ##  The native code touches no Python object nor shared state, so it
+        ##  runs without the GIL and concurrently with other Python threads
+        with nogil:
+            err = plan_rd_execute_strided( cplan , data , sz , sr , sc , dtype , nslices , oper ,
+                                           row0 , psubset , nsub , num_cores , pout )
+
+        if err != 0:
+            raise MemoryError()
+
+        return out
 
 
 
 
 @cython.boundscheck( False )
 @cython.wraparound( False )
-def backproj( np.ndarray[ float , ndim=2 , mode="c" ] sino not None ,
-              np.ndarray[ float , ndim=1 , mode="c" ] angles not None ):
+def forwproj( np.ndarray image not None ,
+              np.ndarray[ float , ndim=1 , mode="c" ] angles not None ,
+              out=None , accumulate=False ,
+              num_threads=None , schedule=None , angle_indices=None ):
 
-    cdef int nang , npix , oper
+    proj = plan( image.shape[1] , angles )
 
-    nang , npix = sino.shape[0] , sino.shape[1]
-    myfloat = sino.dtype
+    return proj.forward( image , out=out , accumulate=accumulate ,
+                         num_threads=num_threads , schedule=schedule ,
+                         angle_indices=angle_indices )
 
-    oper = 1
 
-    if np.max( angles ) > 2 * np.pi:
-        angles *= np.pi / 180.0  
 
-    image = np.zeros( ( npix , npix ) , dtype=myfloat, order='C' )
-    
-    cdef float [:,::1] cimage = image
 
-    radon_rd( &cimage[0,0] , npix , &angles[0] , nang , oper , &sino[0,0] )
-                                 
-    return image
+@cython.boundscheck( False )
+@cython.wraparound( False )
+def backproj( np.ndarray sino not None ,
+              np.ndarray[ float , ndim=1 , mode="c" ] angles not None ,
+              out=None , accumulate=False ,
+              num_threads=None , schedule=None , angle_indices=None ):
+
+    proj = plan( sino.shape[1] , angles )
+
+    return proj.adjoint( sino , out=out , accumulate=accumulate ,
+                         num_threads=num_threads , schedule=schedule ,
+                         angle_indices=angle_indices )
+
+
+
+
+##  Forward projection of a stack of images ( nslices x npix x npix ) into a
+##  stack of sinograms ( nslices x nang x npix ) in a single native call:
+##  the geometry of every angle is computed once for a block of slices
+@cython.boundscheck( False )
+@cython.wraparound( False )
+def forwproj_stack( np.ndarray image not None ,
+                    np.ndarray[ float , ndim=1 , mode="c" ] angles not None ,
+                    out=None , accumulate=False ,
+                    num_threads=None , schedule=None , angle_indices=None ):
+
+    proj = plan( image.shape[2] , angles )
+
+    return proj.forward( image , out=out , accumulate=accumulate ,
+                         num_threads=num_threads , schedule=schedule ,
+                         angle_indices=angle_indices )
+
+
+
+
+##  Backprojection of a stack of sinograms ( nslices x nang x npix ) into a
+##  stack of images ( nslices x npix x npix ) in a single native call
+@cython.boundscheck( False )
+@cython.wraparound( False )
+def backproj_stack( np.ndarray sino not None ,
+                    np.ndarray[ float , ndim=1 , mode="c" ] angles not None ,
+                    out=None , accumulate=False ,
+                    num_threads=None , schedule=None , angle_indices=None ):
+
+    proj = plan( sino.shape[2] , angles )
+
+    return proj.adjoint( sino , out=out , accumulate=accumulate ,
+                         num_threads=num_threads , schedule=schedule ,
+                         angle_indices=angle_indices )
+
+
+
+
+##  Sparse system matrix of the forward projector, in CSR format, with
+##  the rows ordered as the raveled sinogram and the columns as the
+##  raveled image; its transpose is the matrix of the backprojector
+@cython.boundscheck( False )
+@cython.wraparound( False )
+def matrix( int npix ,
+            np.ndarray[ float , ndim=1 , mode="c" ] angles not None ,
+            num_threads=None , schedule=None ):
+
+    cdef int nang , num_cores , err
+    cdef long nnz
+
+    nang = len( angles )
+
+    num_cores = parallel_setup( num_threads , schedule )
+
+    angles = convert_angles( angles )
+
+    count = np.zeros( nang , dtype=np.int_ )
+
+    cdef long [::1] ccount = count
+
+    with nogil:
+        err = matrix_rd( npix , &angles[0] , nang , num_cores , &ccount[0] , NULL , NULL , NULL )
+
+    if err != 0:
+        raise MemoryError()
+
+    nnz      = np.sum( count )
+    count[:] = np.cumsum( count ) - count
+
+    rows = np.zeros( max( nnz , 1 ) , dtype=np.int32 )
+    cols = np.zeros( max( nnz , 1 ) , dtype=np.int32 )
+    vals = np.zeros( max( nnz , 1 ) , dtype=np.float32 )
+
+    cdef int [::1] crows = rows
+    cdef int [::1] ccols = cols
+    cdef float [::1] cvals = vals
+
+    with nogil:
+        err = matrix_rd( npix , &angles[0] , nang , num_cores , &ccount[0] ,
+                         &crows[0] , &ccols[0] , &cvals[0] )
+
+    if err != 0:
+        raise MemoryError()
+
+    return sp.csr_matrix( ( vals[:nnz] , ( rows[:nnz] , cols[:nnz] ) ) ,
+                          shape=( nang * npix , npix * npix ) )
@@ -1,70 +1,191 @@
 /*
- *  IMPLEMENTATION OF THE PIXEL-DRIVEN TOMOGRAPHIC PROJECTORS 
+ *  IMPLEMENTATION OF THE RAY-DRIVEN TOMOGRAPHIC PROJECTORS
  */
 
 
 #include <math.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <omp.h>
 
 #define pi 3.141592653589793
 #define eps 1e-7
 
+//  Number of slices sharing the geometry computed for one angle
+#define SLICE_BLOCK 8
 
 
-void siddon( float *sino , float *image , float norm , int npix , float *p1 , float *p2 , int index , int oper ){
-    int ii, jj, i, j, nh;
-    float alpha_old, alpha_x, alpha_y, alpha, dx, dy;
-    float incr, l;
-    
+
+
+//  Triplets ( row , col , val ) of the system matrix; while row is NULL
+//  the triplets are only counted; r is the row of the ray being traced
+typedef struct{
+    int   *row, *col;
+    float *val;
+    long  n;
+    int   last_row, last_col;
+    int   r;
+} Triplets;
+
+
+
+
+static inline void add_triplet( Triplets *tr , int row , int col , float val )
+{
+    if( val == 0 )
+        return;
+
+    //  Consecutive contributions to the same element are merged
+    if( tr->n > 0 && row == tr->last_row && col == tr->last_col ){
+        if( tr->row != NULL )
+            tr->val[ tr->n - 1 ] += val;
+        return;
+    }
+
+    if( tr->row != NULL ){
+        tr->row[ tr->n ] = row;
+        tr->col[ tr->n ] = col;
+        tr->val[ tr->n ] = val;
+    }
+    tr->last_row = row;
+    tr->last_col = col;
+    tr->n++;
+}
+
+
+
+
+//  Siddon tracing of the ray going from (xa,ya) to (xb,yb), restricted
+//  to the image rows [r0,r1), for the nz slices of the stack that starts
+//  at image, with slice stride is:
+//  oper = 0  --->  adds to w[z] the line integral of the slice z
+//  oper = 1  --->  smears the value w[z] along the ray in the slice z
+//  oper = 2  --->  records the intersection lengths times w[0] in tr
+//
+//  When the ray starts outside the rows [r0,r1), the state of the tracing
+//  right before the step entering the rows is computed directly, so that
+//  the visited pixels and the intersection lengths are exactly the same
+//  ones of the tracing of the whole ray
+static void siddon( float *image , int nz , long is , int npix , float xa , float ya ,
+                    float xb , float yb , float *w , int oper , int r0 , int r1 , Triplets *tr )
+{
+    int ii, jj, i, j, z, di, dj, nh, lo, hi, ii_in, m;
+    float alpha_old, alpha_x, alpha_y, alpha, inv_x, inv_y, a_in, a_y, q;
+    float incr, l, dx, dy;
+
     nh = (int)( npix * 0.5 );
+    lo = r0 - nh;
+    hi = r1 - nh;
 
-    incr = sqrt( ( p2[0] - p1[0] ) * ( p2[0] - p1[0] ) + ( p2[1] - p1[1] ) * ( p2[1] - p1[1] ) );
+    incr = sqrt( ( xb - xa ) * ( xb - xa ) + ( yb - ya ) * ( yb - ya ) );
 
-    ii = (int)round( p1[0] );
-    jj = (int)round( p1[1] );
+    if( incr < eps )
+        return;
 
-    if( p2[0] > p1[0] )
-        dx = 1.0;
-    else
-        dx = -1.0;
+    inv_x = 1.0 / ( xb - xa );
+    inv_y = 1.0 / ( yb - ya );
 
-    if( p2[1] > p1[1] )
-        dy = 1.0;
-    else
-        dy = -1.0; 
+    ii = (int)round( xa );
+    jj = (int)round( ya );
 
+    if( xb > xa ){
+        dx = 1.0;  di = 1;
+    }
+    else{
+        dx = -1.0;  di = -1;
+    }
+
+    if( yb > ya ){
+        dy = 1.0;  dj = 1;
+    }
+    else{
+        dy = -1.0;  dj = -1;
+    }
 
     alpha_old = 0.0;
 
-    while( alpha <= 1 ){ 
-        alpha_y = ( jj + 0.5 * dy - p1[1] ) / ( p2[1] - p1[1] );
-        alpha_x = ( ii + 0.5 * dx - p1[0] ) / ( p2[0] - p1[0] );
-        
+
+    //  Jump to the step entering the rows [r0,r1)
+    if( ii < lo || ii >= hi ){
+        if( ( di > 0 && ii >= hi ) || ( di < 0 && ii < lo ) )
+            return;
+
+        ii_in = ( di > 0 ) ? lo : hi - 1;
+        a_in  = ( ii_in - di + 0.5 * dx - xa ) * inv_x;
+
+        if( ii_in - di != ii )
+            alpha_old = ( ii_in - 2 * di + 0.5 * dx - xa ) * inv_x;
+
+        //  Number of steps along y taken before entering the rows
+        q = ( a_in * ( yb - ya ) - ( jj + 0.5 * dy - ya ) ) * dy;
+        if( !( q > 0 ) )
+            m = 0;
+        else if( q > 2 * npix + 2 )
+            m = 2 * npix + 2;
+        else
+            m = (int)ceil( q );
+
+        while( m > 0 && ( jj + ( m - 1 ) * dj + 0.5 * dy - ya ) * inv_y >= a_in )
+            m--;
+
+        while( ( a_y = ( jj + m * dj + 0.5 * dy - ya ) * inv_y ) < a_in ){
+            if( a_y > 1 )
+                return;
+            m++;
+        }
+
+        if( m > 0 ){
+            a_y = ( jj + ( m - 1 ) * dj + 0.5 * dy - ya ) * inv_y;
+            if( a_y > alpha_old )
+                alpha_old = a_y;
+        }
+
+        if( alpha_old > 1 )
+            return;
+
+        ii  = ii_in - di;
+        jj += m * dj;
+    }
+
+    alpha = alpha_old;
+
+    while( alpha <= 1 ){
+        alpha_y = ( jj + 0.5 * dy - ya ) * inv_y;
+        alpha_x = ( ii + 0.5 * dx - xa ) * inv_x;
+
         if( alpha_x < alpha_y ){
             alpha = alpha_x;
-            ii += dx;
+            ii += di;
         }
         else if( alpha_x > alpha_y ){
             alpha = alpha_y;
-            jj += dy; 
+            jj += dj;
         }
         else if( alpha_x == alpha_y ){
             alpha = alpha_y;
-            ii += dx;
-            jj += dy;
+            ii += di;
+            jj += dj;
         }
+        else
+            break;
+
+        if( ii < lo || ii >= hi )
+            break;
 
         l = ( alpha - alpha_old ) * incr;
         i = ii + nh;
         j = jj + nh;
 
         if( i>0 && i<npix && j>0 && j<npix ){
-            if( oper == 0 ) 
-                sino[ index ] += 1/5.0 * l * image[ i * npix + j ];
+            if( oper == 0 )
+                for( z=0 ; z<nz ; z++ )
+                    w[z] += l * image[ z * is + i * npix + j ];
+            else if( oper == 1 )
+                for( z=0 ; z<nz ; z++ )
+                    image[ z * is + i * npix + j ] += w[z] * l;
             else
-                image[ i * npix + j ] += 1/5.0 * l * sino[ index ];
-        }                              
+                add_triplet( tr , tr->r , i * npix + j , w[0] * l );
+        }
 
         alpha_old = alpha;
     }
@@ -73,117 +194,586 @@ void siddon( float *sino , float *image , float norm , int npix , float *p1 , fl
 
 
 
-void radon_rd( float* image , int npix , float *angles , int nang , int oper , float *sino )
+//  Entry and exit points of all the 6*npix sub-rays of one angle,
+//  computed in a single branch-free pass over the sub-rays;
+//  ray[0:nr] = x1 , ray[nr:2nr] = y1 , ray[2nr:3nr] = x2 , ray[3nr:4nr] = y2
+static void ray_endpoints( float *ray , int npix , float theta , float s , float c )
+{
+    int i, nh, nr;
+    float t, ya, xa, yb, xb, sc, cs, ic, is;
+    float *x1, *y1, *x2, *y2;
+
+    nh = (int)( npix * 0.5 );
+    nr = 6 * npix;
+    x1 = ray;  y1 = ray + nr;  x2 = ray + 2*nr;  y2 = ray + 3*nr;
+
+    sc = s / c;  cs = c / s;  ic = 1.0 / c;  is = 1.0 / s;
+
+    if( theta < pi/2 ){
+        for( i=0 ; i<nr ; i++ ){
+            t = fabs( i/6.0 - nh );
+            t = ( i >= 3*npix ) ? -t : t;
+
+            ya = -nh * sc + t * ic;
+            xa = -nh * cs - t * is;
+            yb = nh * sc + t * ic;
+            xb = nh * cs - t * is;
+
+            x1[i] = ( ya >= -nh && ya <= nh ) ? -nh : xa;
+            y1[i] = ( ya >= -nh && ya <= nh ) ? ya : -nh;
+            x2[i] = ( yb >= -nh && yb <= nh ) ? nh : xb;
+            y2[i] = ( yb >= -nh && yb <= nh ) ? yb : nh;
+        }
+    }
+
+    else{
+        for( i=0 ; i<nr ; i++ ){
+            t = fabs( i/6.0 - nh );
+            t = ( i < 3*npix && theta > pi/2 ) ? -t : t;
+
+            ya = nh * sc - t * ic;
+            xa = -nh * cs + t * is;
+            yb = -nh * sc - t * ic;
+            xb = nh * cs + t * is;
+
+            x1[i] = ( ya >= -nh && ya <= nh ) ? nh : xa;
+            y1[i] = ( ya >= -nh && ya <= nh ) ? ya : -nh;
+            x2[i] = ( yb >= -nh && yb <= nh ) ? -nh : xb;
+            y2[i] = ( yb >= -nh && yb <= nh ) ? yb : nh;
+        }
+    }
+}
+
+
+
+
+//  Plan of the projectors for a given geometry: the trigonometric tables
+//  and, unless they take more than PLAN_MAX_RAYS floats, the sub-ray end
+//  points of all the angles are computed once and reused by every call
+#define PLAN_MAX_RAYS ( 1 << 25 )
+
+typedef struct{
+    int   npix, nang;
+    float *angles, *sin_tab, *cos_tab;
+    float *rays;
+} Plan_rd;
+
+
+
+
+void plan_rd_destroy( Plan_rd *plan );
+
+
+
+
+//  NULL is returned when the tables cannot be allocated; the sub-ray end
+//  points are only tabulated when they fit in PLAN_MAX_RAYS floats and
+//  the memory is available, otherwise the projectors compute them
+Plan_rd *plan_rd_create( int npix , float *angles , int nang )
 {
-    int v, i, j, nh;
-    float x1, y1, x2, y2, theta, s, c, t;
-    float *p1, *p2;
+    int v, nr;
+    Plan_rd *plan = ( Plan_rd * )malloc( sizeof( Plan_rd ) );
 
-    nh = ( int )( npix * 0.5 );
-    p1 = ( float * )malloc( 2 * sizeof( float ) );
-    p2 = ( float * )malloc( 2 * sizeof( float ) ); 
+    if( plan == NULL )
+        return NULL;
 
-    int index, flag=0;
-    float norm = 0.0;
+    nr = 6 * npix;
 
+    plan->npix    = npix;
+    plan->nang    = nang;
+    plan->angles  = ( float * )malloc( nang * sizeof( float ) );
+    plan->sin_tab = ( float * )malloc( nang * sizeof( float ) );
+    plan->cos_tab = ( float * )malloc( nang * sizeof( float ) );
+    plan->rays    = NULL;
+
+    if( plan->angles == NULL || plan->sin_tab == NULL || plan->cos_tab == NULL ){
+        plan_rd_destroy( plan );
+        return NULL;
+    }
 
     for( v=0 ; v<nang ; v++ ){
-        theta = angles[v];
-        s     = sin( theta );
-        c     = cos( theta );
+        plan->angles[v]  = angles[v];
+        plan->sin_tab[v] = sin( angles[v] );
+        plan->cos_tab[v] = cos( angles[v] );
+    }
 
-        
-        if( fabs( s ) < eps ){
-            for( i=1 ; i<npix ; i++ ){
-                for( j=0 ; j<npix ; j++ ){
-                    if( oper == 0 )
-                        sino[ v * npix + npix - 1 - i ] += image[ j * npix + i ];
-                    else
-                        image[ j * npix + i ] += sino[ v * npix + npix - 1 - i ];
-                }
-            }
+    if( (long)nang * 4 * nr <= PLAN_MAX_RAYS )
+        plan->rays = ( float * )malloc( (long)nang * 4 * nr * sizeof( float ) );
+
+    if( plan->rays != NULL ){
+        for( v=0 ; v<nang ; v++ )
+            if( fabs( plan->sin_tab[v] ) >= eps && fabs( plan->cos_tab[v] ) >= eps )
+                ray_endpoints( plan->rays + (long)v * 4 * nr , npix , angles[v] ,
+                               plan->sin_tab[v] , plan->cos_tab[v] );
+    }
+
+    return plan;
+}
+
+
+
+
+void plan_rd_destroy( Plan_rd *plan )
+{
+    free( plan->angles );
+    free( plan->sin_tab );
+    free( plan->cos_tab );
+    free( plan->rays );
+    free( plan );
+}
+
+
+
+
+//  Sub-ray end points of the angle v: taken from the plan when tabulated,
+//  otherwise computed in buf, unless buf already holds the angle v_buf = v
+static float *plan_rays( Plan_rd *plan , int v , float *buf , int *v_buf )
+{
+    if( plan->rays != NULL )
+        return plan->rays + (long)v * 4 * 6 * plan->npix;
+
+    if( *v_buf != v ){
+        ray_endpoints( buf , plan->npix , plan->angles[v] , plan->sin_tab[v] , plan->cos_tab[v] );
+        *v_buf = v;
+    }
+
+    return buf;
+}
+
+
+
+
+//  Forward projector: the (angle,slice block,detector-bin) triples are
+//  distributed among the threads; when the plan does not hold the sub-ray
+//  end points, each thread keeps those of the last angle it has visited in
+//  a private buffer; every sub-ray is traced once for all the slices of
+//  the block; subset lists the nsub angles of the plan to project, NULL
+//  for all of them, and the other sinogram rows are left untouched;
+//  -1 is returned when a private buffer cannot be allocated, 0 otherwise
+int forwproj_rd( Plan_rd *plan , float* image , int nslices , int *subset , int nsub ,
+                 int num_cores , float *sino )
+{
+    int failed = 0;
+    int npix = plan->npix , nang = plan->nang;
+    int nr = 6 * npix;
+    int nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+    long is = (long)npix * npix;
+    long ss = (long)nang * npix;
+
+    if( subset == NULL )
+        nsub = nang;
+
+    #pragma omp parallel num_threads( num_cores )
+    {
+        int r, v, b, i, j, z, z0, nz, v_buf = -1;
+        float s, c;
+        float sum[ SLICE_BLOCK ], line[ SLICE_BLOCK ];
+        float *ray;
+        float *buf = plan->rays != NULL ? NULL : ( float * )malloc( 4 * nr * sizeof( float ) );
+        int ok = plan->rays != NULL || buf != NULL;
+
+        //  A thread without its buffer still meets the loop, doing nothing
+        if( !ok ){
+            #pragma omp atomic write
+            failed = 1;
         }
 
+        #pragma omp for schedule( runtime )
+        for( r=0 ; r<nsub*nblocks*npix ; r++ ){
+            if( !ok )
+                continue;
+
+            v     = ( subset == NULL ) ? r / ( nblocks * npix ) : subset[ r / ( nblocks * npix ) ];
+            z0    = ( ( r / npix ) % nblocks ) * SLICE_BLOCK;
+            b     = r % npix;
+            nz    = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+            s     = plan->sin_tab[v];
+            c     = plan->cos_tab[v];
+
+            for( z=0 ; z<nz ; z++ )
+                sum[z] = 0.0;
+
+            if( fabs( s ) < eps ){
+                i = npix - 1 - b;
+                if( i >= 1 )
+                    for( z=0 ; z<nz ; z++ )
+                        for( j=0 ; j<npix ; j++ )
+                            sum[z] += image[ ( z0 + z ) * is + j * npix + i ];
+            }
 
-        else if( fabs( c ) < eps ){
-            for( i=0 ; i<npix ; i++ ){
-                for( j=0 ; j<npix ; j++ ){
-                    if( oper == 0 )
-                        sino[ v * npix + i ] += image[ i * npix + j ];
-                    else
-                        image[ i * npix + j ] += sino[ v * npix + i ];
+            else if( fabs( c ) < eps ){
+                for( z=0 ; z<nz ; z++ )
+                    for( j=0 ; j<npix ; j++ )
+                        sum[z] += image[ ( z0 + z ) * is + b * npix + j ];
+            }
+
+            else{
+                ray = plan_rays( plan , v , buf , &v_buf );
+
+                for( i=6*b+1 ; i<6*b+6 ; i++ ){
+                    for( z=0 ; z<nz ; z++ )
+                        line[z] = 0.0;
+
+                    siddon( image + z0 * is , nz , is , npix , ray[i] , ray[nr+i] ,
+                            ray[2*nr+i] , ray[3*nr+i] , line , 0 , 0 , npix , NULL );
+
+                    for( z=0 ; z<nz ; z++ )
+                        sum[z] += 1/5.0 * line[z];
                 }
-            } 
+            }
+
+            for( z=0 ; z<nz ; z++ )
+                sino[ ( z0 + z ) * ss + v * npix + b ] += sum[z];
         }
 
+        free( buf );
+    }
 
-        else{
-            index = v * npix;
-
-            for( i=0 ; i< 6 * npix ; i++ ){
-                if( i % 6 != 0 ){
-                    t = fabs( i/6.0 - nh );
-
-                    if( i >= 3*npix && theta < pi/2 )
-                        t = -t;
-                    if( i < 3*npix && theta > pi/2 )
-                        t = -t;  
-
-                    //  Compute entry and exit point
-                    if( theta < pi/2 ){
-                        y1 = -nh * s/c + t/c;
-                        x1 = -nh * c/s - t/s;
-                        y2 = nh * s/c + t/c;
-                        x2 = nh * c/s - t/s;
-
-                        if( y1 >= -nh && y1 <= nh ){
-                            p1[0] = -nh;
-                            p1[1] = y1;
-                        }
-                        else{
-                            p1[0] = x1;
-                            p1[1] = -nh;                         
-                        }
-                        if( y2 >= -nh && y2 <= nh ){
-                            p2[0] = nh;
-                            p2[1] = y2;
-                        }
-                        else{
-                            p2[0] = x2;
-                            p2[1] = nh;                         
-                        }                         
-                    }
+    return failed ? -1 : 0;
+}
+
+
+
+
+//  Backprojector: the image is split in tiles of contiguous rows and
+//  every (tile,slice block) pair is owned by a single thread, which traces
+//  all the rays restricted to its rows once for all the slices of the
+//  block and accumulates them directly in the image; the only extra
+//  memory is the per-thread buffer of the ray end points; only the sinogram
+//  rows of the nsub angles listed in subset are read, all of them when
+//  subset is NULL; -1 is returned when a private buffer cannot be
+//  allocated, 0 otherwise
+int backproj_rd( Plan_rd *plan , float* image , int nslices , int *subset , int nsub ,
+                 int num_cores , float *sino )
+{
+    int nr, ntiles, tile_rows, nblocks, failed = 0;
+    int npix = plan->npix , nang = plan->nang;
+    long is, ss;
 
-                    else{
-                        y1 = nh * s/c - t/c;
-                        x1 = -nh * c/s + t/s;
-                        y2 = -nh * s/c - t/c;
-                        x2 = nh * c/s + t/s;
+    nr      = 6 * npix;
+    nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+    is      = (long)npix * npix;
+    ss      = (long)nang * npix;
 
-                        if( y1 >= -nh && y1 <= nh ){
-                            p1[0] = nh;
-                            p1[1] = y1;
+    if( subset == NULL )
+        nsub = nang;
+
+    //  Enough work units to balance the threads, counting the slice blocks
+    if( num_cores == 1 )
+        ntiles = 1;
+    else
+        ntiles = ( 2 * num_cores + nblocks - 1 ) / nblocks;
+    if( ntiles > npix )
+        ntiles = npix;
+    tile_rows = ( npix + ntiles - 1 ) / ntiles;
+
+    #pragma omp parallel num_threads( num_cores )
+    {
+        int r, r0, r1, a, v, i, j, z, z0, nz, v_buf = -1;
+        float s, c;
+        float w[ SLICE_BLOCK ];
+        float *ray;
+        float *buf = plan->rays != NULL ? NULL : ( float * )malloc( 4 * nr * sizeof( float ) );
+        int ok = plan->rays != NULL || buf != NULL;
+
+        if( !ok ){
+            #pragma omp atomic write
+            failed = 1;
+        }
+
+        #pragma omp for schedule( runtime )
+        for( r=0 ; r<ntiles*nblocks ; r++ ){
+            if( !ok )
+                continue;
+
+            r0 = ( r / nblocks ) * tile_rows;
+            r1 = r0 + tile_rows;
+            if( r1 > npix )
+                r1 = npix;
+            z0 = ( r % nblocks ) * SLICE_BLOCK;
+            nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+
+            for( a=0 ; a<nsub ; a++ ){
+                v = ( subset == NULL ) ? a : subset[a];
+                s = plan->sin_tab[v];
+                c = plan->cos_tab[v];
+
+
+                if( fabs( s ) < eps ){
+                    for( z=z0 ; z<z0+nz ; z++ )
+                        for( j=r0 ; j<r1 ; j++ ){
+                            for( i=1 ; i<npix ; i++ )
+                                image[ z * is + j * npix + i ] += sino[ z * ss + v * npix + npix - 1 - i ];
                         }
-                        else{
-                            p1[0] = x1;
-                            p1[1] = -nh;                         
+                }
+
+
+                else if( fabs( c ) < eps ){
+                    for( z=z0 ; z<z0+nz ; z++ )
+                        for( i=r0 ; i<r1 ; i++ ){
+                            for( j=0 ; j<npix ; j++ )
+                                image[ z * is + i * npix + j ] += sino[ z * ss + v * npix + i ];
                         }
-                        if( y2 >= -nh && y2 <= nh ){
-                            p2[0] = -nh;
-                            p2[1] = y2;
+                }
+
+
+                else{
+                    ray = plan_rays( plan , v , buf , &v_buf );
+
+                    for( i=0 ; i<nr ; i++ ){
+                        if( i % 6 != 0 ){
+                            for( z=0 ; z<nz ; z++ )
+                                w[z] = 1/5.0 * sino[ ( z0 + z ) * ss + v * npix + i / 6 ];
+
+                            siddon( image + z0 * is , nz , is , npix , ray[i] , ray[nr+i] ,
+                                    ray[2*nr+i] , ray[3*nr+i] , w , 1 , r0 , r1 , NULL );
                         }
-                        else{
-                            p2[0] = x2;
-                            p2[1] = nh;                         
-                        }                         
                     }
-                    
-                    siddon( sino , image , norm , npix , p1 , p2 , index , oper );
                 }
-                
-                else if( i % 6 == 0 && i != 0 )
-                    index++;
             }
         }
+
+        free( buf );
     }
+
+    return failed ? -1 : 0;
+}
+
+
+
+
+//  Triplets of the sinogram row v, following forwproj_rd step by step;
+//  ray is a buffer for the sub-ray end points
+static void triplets_rd( int npix , float theta , int v , float *ray , Triplets *tr )
+{
+    int b, i, j, nr;
+    float s, c, w;
+
+    nr = 6 * npix;
+    w  = 1/5.0;
+    s  = sin( theta );
+    c  = cos( theta );
+
+    if( fabs( s ) >= eps && fabs( c ) >= eps )
+        ray_endpoints( ray , npix , theta , s , c );
+
+    for( b=0 ; b<npix ; b++ ){
+        tr->r = v * npix + b;
+
+        if( fabs( s ) < eps ){
+            i = npix - 1 - b;
+            if( i >= 1 )
+                for( j=0 ; j<npix ; j++ )
+                    add_triplet( tr , tr->r , j * npix + i , 1.0 );
+        }
+
+        else if( fabs( c ) < eps ){
+            for( j=0 ; j<npix ; j++ )
+                add_triplet( tr , tr->r , b * npix + j , 1.0 );
+        }
+
+        else{
+            for( i=6*b+1 ; i<6*b+6 ; i++ )
+                siddon( NULL , 1 , 0 , npix , ray[i] , ray[nr+i] , ray[2*nr+i] , ray[3*nr+i] ,
+                        &w , 2 , 0 , npix , tr );
+        }
+    }
+}
+
+
+
+
+//  System matrix of the forward projector in coordinate format, built
+//  angle by angle in parallel, in two calls:
+//  rows == NULL  --->  count[v] receives the number of triplets of angle v
+//  otherwise     --->  the triplets of angle v are written from the
+//                      offset count[v] of rows, cols and vals
+//  Repeated ( row , col ) pairs are meant to be summed; -1 is returned
+//  when a private buffer cannot be allocated, 0 otherwise
+int matrix_rd( int npix , float *angles , int nang , int num_cores ,
+               long *count , int *rows , int *cols , float *vals )
+{
+    int failed = 0;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    #pragma omp parallel num_threads( num_cores )
+    {
+        int v;
+        Triplets tr;
+        float *ray = ( float * )malloc( 4 * 6 * npix * sizeof( float ) );
+
+        if( ray == NULL ){
+            #pragma omp atomic write
+            failed = 1;
+        }
+
+        #pragma omp for schedule( runtime )
+        for( v=0 ; v<nang ; v++ ){
+            if( ray == NULL )
+                continue;
+
+            tr.n = 0;
+
+            if( rows == NULL ){
+                tr.row = NULL;  tr.col = NULL;  tr.val = NULL;
+                triplets_rd( npix , angles[v] , v , ray , &tr );
+                count[v] = tr.n;
+            }
+            else{
+                tr.row = rows + count[v];  tr.col = cols + count[v];  tr.val = vals + count[v];
+                triplets_rd( npix , angles[v] , v , ray , &tr );
+            }
+        }
+
+        free( ray );
+    }
+
+    return failed ? -1 : 0;
+}
+
+
+
+
+//  Copy of the slices [ z0 , z0 + nz ) of a strided input into the C-contiguous
+//  float32 buffer buf ( nz x nrows x ncols ); the element ( z , i , j ) of the
+//  input lies at the byte offset z * sz + ( i - row0 ) * sr + j * sc from data and
+//  is stored as float32 ( dtype 0 ) or float64 ( dtype 1 ); only the rows of
+//  the nsub angles listed in subset are copied, all the rows when subset is
+//  NULL, and the other rows of buf are left as they are
+static void gather_slices( char *data , long sz , long sr , long sc , int dtype , int z0 ,
+                           int nz , int nrows , int ncols , int row0 , int *subset , int nsub ,
+                           int num_cores , float *buf )
+{
+    long r;
+    int i, j;
+    char *row;
+    float *dst;
+
+    if( subset == NULL )
+        nsub = nrows;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) \
+                         private( i , j , row , dst )
+    for( r=0 ; r<(long)nz*nsub ; r++ ){
+        i   = ( subset == NULL ) ? r % nsub : subset[ r % nsub ];
+        row = data + ( z0 + r / nsub ) * sz + ( i - row0 ) * sr;
+        dst = buf + ( ( r / nsub ) * nrows + i ) * ncols;
+
+        if( dtype == 0 )
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = *( float * )( row + j * sc );
+        else
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = (float)*( double * )( row + j * sc );
+    }
+}
+
+
+
+
+//  Projectors of a stack of nslices images ( nslices x npix x npix ) and
+//  sinograms ( nslices x nang x npix ), both C-contiguous, with a plan;
+//  only the nsub angles listed in subset are projected, all of them when
+//  subset is NULL; -1 is returned when the memory of the projectors
+//  cannot be allocated, 0 otherwise
+int plan_rd_execute( Plan_rd *plan , float* image , int nslices , int oper , int *subset ,
+                     int nsub , int num_cores , float *sino )
+{
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( oper == 0 )
+        return forwproj_rd( plan , image , nslices , subset , nsub , num_cores , sino );
+    else
+        return backproj_rd( plan , image , nslices , subset , nsub , num_cores , sino );
+}
+
+
+
+
+//  Projectors of a stack of nslices inputs given as a strided view ( see
+//  gather_slices ) into a C-contiguous float32 output: a C-contiguous
+//  float32 input is projected in place, any other layout is converted on
+//  the fly by blocks of SLICE_BLOCK slices, without ever holding a copy
+//  of the whole stack.  The sinograms given to the adjoint ( oper 1 ) may
+//  also be blocks of consecutive rows, row0 being the sinogram row of
+//  their first row: only the rows of the nsub angles listed in subset
+//  are then read, and the contiguous path is only taken for row0 = 0;
+//  -1 is returned when the memory cannot be
+//  allocated, 0 otherwise
+int plan_rd_execute_strided( Plan_rd *plan , char *data , long sz , long sr , long sc ,
+                             int dtype , int nslices , int oper , int row0 , int *subset ,
+                             int nsub , int num_cores , float *out )
+{
+    int npix, nrows, nbuf, z0, nz, err = 0;
+    long nin, nout;
+    float *buf;
+
+    npix  = plan->npix;
+    nrows = ( oper == 0 ) ? npix : plan->nang;
+    nin   = (long)nrows * npix;
+    nout  = ( oper == 0 ) ? (long)plan->nang * npix : (long)npix * npix;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( dtype == 0 && row0 == 0 && sc == sizeof( float ) && sr == npix * sizeof( float ) &&
+        ( nslices == 1 || sz == nin * sizeof( float ) ) ){
+        if( oper == 0 )
+            return plan_rd_execute( plan , ( float * )data , nslices , 0 , subset , nsub ,
+                                    num_cores , out );
+        else
+            return plan_rd_execute( plan , out , nslices , 1 , subset , nsub , num_cores ,
+                                    ( float * )data );
+    }
+
+    nbuf = ( nslices < SLICE_BLOCK ) ? nslices : SLICE_BLOCK;
+    buf  = ( float * )malloc( nbuf * nin * sizeof( float ) );
+
+    if( buf == NULL )
+        return -1;
+
+    for( z0=0 ; z0<nslices && err==0 ; z0+=SLICE_BLOCK ){
+        nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+
+        if( oper == 0 )
+            gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , 0 , NULL , 0 ,
+                           num_cores , buf );
+        else
+            gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , row0 , subset ,
+                           nsub , num_cores , buf );
+
+        if( oper == 0 )
+            err = plan_rd_execute( plan , buf , nz , 0 , subset , nsub , num_cores ,
+                                   out + z0 * nout );
+        else
+            err = plan_rd_execute( plan , out + z0 * nout , nz , 1 , subset , nsub , num_cores ,
+                                   buf );
+    }
+
+    free( buf );
+
+    return err;
+}
+
+
+
+
+//  Same as above for a single call, with a plan used once; -1 is returned
+//  when the memory cannot be allocated, 0 otherwise
+int radon_rd( float* image , int nslices , int npix , float *angles , int nang , int oper ,
+              int num_cores , float *sino )
+{
+    int err;
+    Plan_rd *plan = plan_rd_create( npix , angles , nang );
+
+    if( plan == NULL )
+        return -1;
+
+    err = plan_rd_execute( plan , image , nslices , oper , NULL , 0 , num_cores , sino );
+    plan_rd_destroy( plan );
+
+    return err;
 }
@@ -1,196 +1,640 @@
 /*
- *  IMPLEMENTATION OF THE PIXEL-DRIVEN TOMOGRAPHIC PROJECTORS 
+ *  IMPLEMENTATION OF THE SLANT-STACKING TOMOGRAPHIC PROJECTORS
  */
 
 
 #include <math.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <omp.h>
 
 #define pi 3.141592653589793
 #define eps 1e-5
 #define s45 0.70710678118654757
 
+//  Number of slices sharing the geometry computed for one angle
+#define SLICE_BLOCK 8
+
+
+
+
+//  Geometry of one angle, computed once per call:
+//  for branch 0 ( |sin| <= sin(pi/4) ) the rays are sampled along y and
+//      x( t , y ) = t * ia - y * sl ,  ia = 1 / cos ,  sl = sin / cos
+//  for branch 1 the rays are sampled along x and
+//      y( t , x ) = t * ia - x * sl ,  ia = 1 / sin ,  sl = cos / sin
+//  ja , jl define in the same way the other coordinate, used for the
+//  limits of the ray inside the image
+typedef struct{
+    int   branch;
+    int   flat;
+    float w;
+    float ia, sl;
+    float ja, jl;
+} Angle;
+
+
+
+
+//  Triplets ( row , col , val ) of the system matrix; while row is NULL
+//  the triplets are only counted
+typedef struct{
+    int   *row, *col;
+    float *val;
+    long  n;
+    int   last_row, last_col;
+} Triplets;
+
 
 
-void quick_sort ( float *a , int n ) {
-    int i, j;
-    float p, t;
 
-    if ( n < 2 )
+static inline void add_triplet( Triplets *tr , int row , int col , float val )
+{
+    if( val == 0 )
         return;
 
-    p = a[ n / 2 ];
-    
-    for ( i = 0 , j = n - 1 ;; i++ , j-- ){
-        while ( a[i] < p )
-            i++;
-        while ( p < a[j] )
-            j--;
-        if ( i >= j )
-            break;
-        t = a[i];
-        a[i] = a[j];
-        a[j] = t;
+    //  Consecutive contributions to the same element are merged
+    if( tr->n > 0 && row == tr->last_row && col == tr->last_col ){
+        if( tr->row != NULL )
+            tr->val[ tr->n - 1 ] += val;
+        return;
     }
-    quick_sort( a , i );
-    quick_sort( a + i , n - i );
+
+    if( tr->row != NULL ){
+        tr->row[ tr->n ] = row;
+        tr->col[ tr->n ] = col;
+        tr->val[ tr->n ] = val;
+    }
+    tr->last_row = row;
+    tr->last_col = col;
+    tr->n++;
 }
 
 
 
 
-void ray_limits( float* lim, int t , float s , float c , int npix  ){
-    float x1, y1, x2, y2;
-    float x_min, x_max, y_min, y_max;
+void init_angle( Angle *ang , float theta )
+{
+    float s = sin( theta );
+    float c = cos( theta );
+
+    if( fabs( s ) <= s45 ){
+        ang->branch = 0;
+        ang->w      = 1.0 / fabs( c );
+        ang->ia     = 1.0 / c;
+        ang->sl     = s / c;
+        ang->flat   = fabs( s ) < eps;
+        ang->ja     = ang->flat ? 0.0 : 1.0 / s;
+        ang->jl     = ang->flat ? 0.0 : c / s;
+    }
+    else{
+        ang->branch = 1;
+        ang->w      = 1.0 / fabs( s );
+        ang->ia     = 1.0 / s;
+        ang->sl     = c / s;
+        ang->flat   = fabs( c ) < eps;
+        ang->ja     = ang->flat ? 0.0 : 1.0 / c;
+        ang->jl     = ang->flat ? 0.0 : s / c;
+    }
+}
 
-    int nh = (int)( npix * 0.5 );
 
-    
-    //  Theta = 0
-    if( fabs( s ) < eps ){
-        lim[0] = 0;
-        lim[1] = 0;
-        lim[2] = -nh;
-        lim[3] = nh-1;
+
+
+//  Range [lo,hi) of the sampling coordinate of the ray t inside the image,
+//  i.e. the two middle values of { u(-nh) , u(nh-1) , -nh , nh-1 }, where
+//  u is the sampling coordinate as a function of the other one; this is
+//  equivalent to sorting the four values, without the sort.  The detector
+//  bins are t = -nh , ... , nh-1: for odd npix the last sinogram column,
+//  t = nh, is no ray and gets an empty range, so that it stays zero
+static inline void ray_range( Angle *ang , int t , int nh , int *lo , int *hi )
+{
+    float u1, u2, p, q, a, b;
+
+    if( t > nh - 1 ){
+        *lo = 0;
+        *hi = 0;
+        return;
     }
 
+    if( ang->flat ){
+        *lo = -nh;
+        *hi = nh - 1;
+        return;
+    }
+
+    u1 = t * ang->ja + nh * ang->jl;
+    u2 = t * ang->ja - ( nh - 1 ) * ang->jl;
+
+    p = fminf( u1 , u2 );
+    q = fmaxf( u1 , u2 );
+    a = fmaxf( p , -nh );
+    b = fminf( q , nh - 1 );
+
+    *lo = (int)round( fminf( a , b ) );
+    *hi = (int)round( fmaxf( a , b ) );
+
+    if( *lo < -nh )
+        *lo = -nh;
+    if( *hi > nh - 1 )
+        *hi = nh - 1;
+}
+
+
+
+
+//  Plan of the projectors for a given geometry: the geometry of every angle
+//  and the ranges [lo,hi) of all the rays are computed once and reused by
+//  every call
+typedef struct{
+    int   npix, nang, method;
+    Angle *angs;
+    short *lo, *hi;
+} Plan_ss;
+
+
 
-    //  Theta = pi/2
-    else if( fabs( c ) < eps ){
-        lim[0] = -nh;
-        lim[1] = nh-1;
-        lim[2] = 0;
-        lim[3] = 0;      
-    
+
+void plan_ss_destroy( Plan_ss *plan );
+
+
+
+
+//  NULL is returned when the tables cannot be allocated
+Plan_ss *plan_ss_create( int npix , float *angles , int nang , int method )
+{
+    int r, nh, l, h;
+    Plan_ss *plan = ( Plan_ss * )malloc( sizeof( Plan_ss ) );
+
+    if( plan == NULL )
+        return NULL;
+
+    nh = (int)( npix * 0.5 );
+
+    plan->npix   = npix;
+    plan->nang   = nang;
+    plan->method = method;
+    plan->angs   = ( Angle * )malloc( nang * sizeof( Angle ) );
+    plan->lo     = ( short * )malloc( nang * npix * sizeof( short ) );
+    plan->hi     = ( short * )malloc( nang * npix * sizeof( short ) );
+
+    if( plan->angs == NULL || plan->lo == NULL || plan->hi == NULL ){
+        plan_ss_destroy( plan );
+        return NULL;
     }
 
+    for( r=0 ; r<nang ; r++ )
+        init_angle( plan->angs + r , angles[r] );
 
-    //  All other angles
-    else{
-        x1 = t/c + nh * s/c;
-        y1 = t/s + nh * c/s;
-        x2 = t/c - (nh-1) * s/c;
-        y2 = t/s - (nh-1) * c/s;
-
-        lim[0] = x1;  lim[1] = x2;  lim[2] = -nh;  lim[3] = nh-1;
-        quick_sort( lim , 4 );
-        x_min = lim[1];
-        x_max = lim[2];
-
-        lim[0] = y1;  lim[1] = y2;  lim[2] = -nh;  lim[3] = nh-1;
-        quick_sort( lim , 4 );
-        y_min = lim[1];
-        y_max = lim[2];
-
-        lim[0] = x_min;  lim[1] = x_max;  lim[2] = y_min;  lim[3] = y_max; 
+    for( r=0 ; r<nang*npix ; r++ ){
+        ray_range( plan->angs + r / npix , r % npix - nh , nh , &l , &h );
+        plan->lo[r] = l;
+        plan->hi[r] = h;
     }
+
+    return plan;
 }
 
 
 
 
-void radon_ss( float* image , int npix , float *angles , int nang , int oper , int method , float *sino )
+void plan_ss_destroy( Plan_ss *plan )
 {
-    int v, j, k, t, nh, x1, y1, x, y;
-    float theta, s, c, w, xf, yf;
-    
-    float *lim = ( float* )calloc( 4 , sizeof( int ) );
+    free( plan->angs );
+    free( plan->lo );
+    free( plan->hi );
+    free( plan );
+}
 
-    nh = (int)( npix * 0.5 );
 
 
-    for( v=0 ; v<nang ; v++ ){
-        theta = angles[v];
-        s     = sin( theta );
-        c     = cos( theta );
-            
-        
-        for( t=-nh ; t<nh ; t++ ){
-            //  Indeces for sinogram
-            j = nang - 1 - v;
-            k = t + nh;
-
-
-            //  Find ray limits
-            ray_limits( lim , t , s , c , npix );
-
-            
-            //  0 <= theta <= pi/4  U  3pi/4 < theta <= pi
-            if( fabs( s ) <= s45 ){
-                for( y=(int)round(lim[2]) ; y<(int)round(lim[3]) ; y++ ){
-                    //  Nearest neighbour interpolation
-                    if( method == 0){
-                        x1 = (int)round( t/c - y*s/c ) + nh;
-                        y1 = y + nh;
-
-                        if( oper == 0 )
-                            sino[ j * npix + k ] += 1.0/fabs(c)  * image[ y1 * npix + x1 ];
-                        else
-                            image[ y1 * npix + x1 ] += 1.0/fabs(c) * sino[ j * npix + k ];
-                    }
 
-                    //  Linear interpolation
-                    else{
-                        xf  = t/c - y*s/c;
-                        w  = xf - floor( xf );
-                        x1 = (int)floor( xf ) + nh;
-                        y1 = y + nh;
-
-                        if( oper == 0 ){
-                            if( x1 >= 0 && x1<= npix-1 )
-                                sino[ j * npix + k ] += 1.0/fabs(c) * ( 1 - w ) * image[ y1 * npix + x1 ];
-                            if( x1+1 >= 0 && x1+1<= npix-1 ) 
-                                sino[ j * npix + k ] += 1.0/fabs(c) * w * image[ y1 * npix + x1 + 1 ];
-                        }
-                        else{
-                            if( x1 >= 0 && x1<= npix-1 ) 
-                                image[ y1 * npix + x1 ] += 1.0/fabs(c) * ( 1 - w ) * sino[ j * npix + k ];
-                            if( x1+1 >= 0 && x1+1<= npix-1 ) 
-                                image[ y1 * npix + x1 + 1 ] += 1.0/fabs(c) * w * sino[ j * npix + k ];
-                        }
-                    }
-                }                                
+//  Forward projector: the (angle,slice block,detector-bin) triples are
+//  distributed among the threads, every triple writes a single sinogram
+//  element per slice; the interpolation weights along the ray are
+//  computed once for all the slices of the block; subset lists the nsub
+//  angles of the plan to project, NULL for all of them, and the other
+//  sinogram rows are left untouched
+void forwproj_ss( Plan_ss *plan , float* image , int nslices , int *subset , int nsub ,
+                  int num_cores , float *sino )
+{
+    int r, v, k, t, u, z, z0, nz, lo, hi, nh, i1, u1, p, nblocks;
+    int npix = plan->npix , nang = plan->nang , method = plan->method;
+    Angle *angs = plan->angs;
+    long is, ss;
+    float f, w, uf;
+    float sum[ SLICE_BLOCK ];
+    Angle *ang;
+
+    nh      = (int)( npix * 0.5 );
+    is      = (long)npix * npix;
+    ss      = (long)nang * npix;
+    nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+
+    if( subset == NULL )
+        nsub = nang;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) \
+                         private( v , k , t , u , z , z0 , nz , lo , hi , i1 , u1 , p , sum , \
+                                  f , w , uf , ang )
+    for( r=0 ; r<nsub*nblocks*npix ; r++ ){
+        v   = ( subset == NULL ) ? r / ( nblocks * npix ) : subset[ r / ( nblocks * npix ) ];
+        z0  = ( ( r / npix ) % nblocks ) * SLICE_BLOCK;
+        k   = r % npix;
+        nz  = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+        t   = k - nh;
+        ang = angs + v;
+
+        for( z=0 ; z<nz ; z++ )
+            sum[z] = 0.0;
+
+        lo = plan->lo[ v * npix + k ];
+        hi = plan->hi[ v * npix + k ];
+
+        for( u=lo ; u<hi ; u++ ){
+            uf = t * ang->ia - u * ang->sl;
+            u1 = u + nh;
+
+            //  Nearest neighbour interpolation
+            if( method == 0 ){
+                i1 = (int)round( uf ) + nh;
+                if( i1 < 0 || i1 > npix-1 )
+                    continue;
+
+                if( ang->branch == 0 )
+                    p = u1 * npix + i1;
+                else
+                    p = i1 * npix + u1;
+
+                for( z=0 ; z<nz ; z++ )
+                    sum[z] += image[ ( z0 + z ) * is + p ];
             }
 
-            
-            //  pi/4 < theta < 3pi/4
+            //  Linear interpolation
             else{
-                for( x=(int)round(lim[0]) ; x<(int)round(lim[1]) ; x++ ){
-                    //  Nearest neighbour interpolation
-                    if( method == 0){  
-                        y1 = (int)round( t/s - x*c/s ) + nh;
-                        x1 = x + nh;
-                    
-                        if( oper == 0 )
-                            sino[ j * npix + k ] += 1.0/fabs(s) * image[ y1 * npix + x1 ];
-                        else
-                            image[ y1 * npix + x1 ] += 1.0/fabs(s) * sino[ j * npix + k ]; 
-                    }
+                f  = floor( uf );
+                w  = uf - f;
+                i1 = (int)f + nh;
+
+                if( ang->branch == 0 ){
+                    if( i1 >= 0 && i1 <= npix-1 )
+                        for( z=0 ; z<nz ; z++ )
+                            sum[z] += ( 1 - w ) * image[ ( z0 + z ) * is + u1 * npix + i1 ];
+                    if( i1+1 >= 0 && i1+1 <= npix-1 )
+                        for( z=0 ; z<nz ; z++ )
+                            sum[z] += w * image[ ( z0 + z ) * is + u1 * npix + i1 + 1 ];
+                }
+                else{
+                    if( i1 >= 0 && i1 <= npix-1 )
+                        for( z=0 ; z<nz ; z++ )
+                            sum[z] += ( 1 - w ) * image[ ( z0 + z ) * is + i1 * npix + u1 ];
+                    if( i1+1 >= 0 && i1+1 <= npix-1 )
+                        for( z=0 ; z<nz ; z++ )
+                            sum[z] += w * image[ ( z0 + z ) * is + ( i1 + 1 ) * npix + u1 ];
+                }
+            }
+        }
 
-                    //  Linear interpolation
-                    else{
-                        yf = t/s - x*c/s;
-                        w  = yf - floor( yf );
-                        y1 = (int)floor( yf ) + nh;
-                        x1 = x + nh; 
-
-                        if( oper == 0 ){
-                            if( y1 >= 0 && y1<= npix-1 )
-                                sino[ j * npix + k ] += 1.0/fabs(s) * ( 1 - w ) * image[ y1 * npix + x1 ];
-                            if( y1+1 >= 0 && y1+1<= npix-1 )
-                                sino[ j * npix + k ] += 1.0/fabs(s) * w * image[ ( y1 + 1 ) * npix + x1 ];
+        for( z=0 ; z<nz ; z++ )
+            sino[ ( z0 + z ) * ss + ( nang - 1 - v ) * npix + k ] += ang->w * sum[z];
+    }
+}
+
+
+
+
+//  Backprojector: a ray of branch 0 writes the image row u + nh when
+//  sampled at u, a ray of branch 1 the image column u + nh; the image is
+//  backprojected in two passes, first distributing the (row,slice block)
+//  pairs among the threads for the angles of branch 0 and then the
+//  (column,slice block) pairs for the angles of branch 1, so that no pixel
+//  is written by two threads; the ranges of the rays come from the plan;
+//  only the sinogram rows of the nsub angles listed in subset are read, all
+//  of them when subset is NULL
+void backproj_ss( Plan_ss *plan , float* image , int nslices , int *subset , int nsub ,
+                  int num_cores , float *sino )
+{
+    int npix = plan->npix , nang = plan->nang , method = plan->method;
+    int nblocks = ( nslices + SLICE_BLOCK - 1 ) / SLICE_BLOCK;
+    long is = (long)npix * npix;
+    long ss = (long)nang * npix;
+    Angle *angs = plan->angs;
+    short *lo = plan->lo , *hi = plan->hi;
+
+    if( subset == NULL )
+        nsub = nang;
+
+    #pragma omp parallel num_threads( num_cores )
+    {
+        int r, a, v, k, t, u, z, z0, nz, nh, i1, u1, p, branch;
+        float f, w, uf, aw;
+        float *sino_row, *img;
+        short *lo_row, *hi_row;
+        Angle *ang;
+
+        nh = (int)( npix * 0.5 );
+
+        for( branch=0 ; branch<2 ; branch++ ){
+            #pragma omp for schedule( runtime )
+            for( r=0 ; r<npix*nblocks ; r++ ){
+                u   = r / nblocks - nh;
+                z0  = ( r % nblocks ) * SLICE_BLOCK;
+                nz  = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+                u1  = u + nh;
+                img = image + z0 * is;
+
+                for( a=0 ; a<nsub ; a++ ){
+                    v   = ( subset == NULL ) ? a : subset[a];
+                    ang = angs + v;
+                    if( ang->branch != branch )
+                        continue;
+
+                    sino_row = sino + z0 * ss + ( nang - 1 - v ) * npix;
+                    lo_row   = lo + v * npix;
+                    hi_row   = hi + v * npix;
+
+                    for( k=0 ; k<npix ; k++ ){
+                        if( u < lo_row[k] || u >= hi_row[k] )
+                            continue;
+
+                        t  = k - nh;
+                        uf = t * ang->ia - u * ang->sl;
+
+                        //  Nearest neighbour interpolation
+                        if( method == 0 ){
+                            i1 = (int)round( uf ) + nh;
+                            if( i1 < 0 || i1 > npix-1 )
+                                continue;
+
+                            if( branch == 0 )
+                                p = u1 * npix + i1;
+                            else
+                                p = i1 * npix + u1;
+
+                            for( z=0 ; z<nz ; z++ )
+                                img[ z * is + p ] += ang->w * sino_row[ z * ss + k ];
                         }
+
+                        //  Linear interpolation
                         else{
-                            if( y1 >= 0 && y1<= npix-1 )
-                                image[ y1 * npix + x1 ] += 1.0/fabs(s) * ( 1 - w ) * sino[ j * npix + k ];
-                            if( y1+1 >= 0 && y1+1<= npix-1 )
-                                image[ ( y1 + 1 ) * npix + x1 ] += 1.0/fabs(s) * w * sino[ j * npix + k ];
-                        }                        
+                            f  = floor( uf );
+                            w  = uf - f;
+                            i1 = (int)f + nh;
+
+                            for( z=0 ; z<nz ; z++ ){
+                                aw = ang->w * sino_row[ z * ss + k ];
+
+                                if( branch == 0 ){
+                                    if( i1 >= 0 && i1 <= npix-1 )
+                                        img[ z * is + u1 * npix + i1 ] += ( 1 - w ) * aw;
+                                    if( i1+1 >= 0 && i1+1 <= npix-1 )
+                                        img[ z * is + u1 * npix + i1 + 1 ] += w * aw;
+                                }
+                                else{
+                                    if( i1 >= 0 && i1 <= npix-1 )
+                                        img[ z * is + i1 * npix + u1 ] += ( 1 - w ) * aw;
+                                    if( i1+1 >= 0 && i1+1 <= npix-1 )
+                                        img[ z * is + ( i1 + 1 ) * npix + u1 ] += w * aw;
+                                }
+                            }
+                        }
                     }
                 }
             }
         }
     }
-    free( lim );
+}
+
+
+
+
+//  Triplets of the sinogram row v, following forwproj_ss step by step
+static void triplets_ss( int npix , Angle *ang , int v , int nang , int method , Triplets *tr )
+{
+    int k, t, u, lo, hi, nh, i1, u1, row;
+    float f, w, uf;
+
+    nh = (int)( npix * 0.5 );
+
+    for( k=0 ; k<npix ; k++ ){
+        t   = k - nh;
+        row = ( nang - 1 - v ) * npix + k;
+
+        ray_range( ang , t , nh , &lo , &hi );
+
+        for( u=lo ; u<hi ; u++ ){
+            uf = t * ang->ia - u * ang->sl;
+            u1 = u + nh;
+
+            //  Nearest neighbour interpolation
+            if( method == 0 ){
+                i1 = (int)round( uf ) + nh;
+                if( i1 < 0 || i1 > npix-1 )
+                    continue;
+
+                if( ang->branch == 0 )
+                    add_triplet( tr , row , u1 * npix + i1 , ang->w );
+                else
+                    add_triplet( tr , row , i1 * npix + u1 , ang->w );
+            }
+
+            //  Linear interpolation
+            else{
+                f  = floor( uf );
+                w  = uf - f;
+                i1 = (int)f + nh;
+
+                if( ang->branch == 0 ){
+                    if( i1 >= 0 && i1 <= npix-1 )
+                        add_triplet( tr , row , u1 * npix + i1 , ang->w * ( 1 - w ) );
+                    if( i1+1 >= 0 && i1+1 <= npix-1 )
+                        add_triplet( tr , row , u1 * npix + i1 + 1 , ang->w * w );
+                }
+                else{
+                    if( i1 >= 0 && i1 <= npix-1 )
+                        add_triplet( tr , row , i1 * npix + u1 , ang->w * ( 1 - w ) );
+                    if( i1+1 >= 0 && i1+1 <= npix-1 )
+                        add_triplet( tr , row , ( i1 + 1 ) * npix + u1 , ang->w * w );
+                }
+            }
+        }
+    }
+}
+
+
+
+
+//  System matrix of the forward projector in coordinate format, built
+//  angle by angle in parallel, in two calls:
+//  rows == NULL  --->  count[v] receives the number of triplets of angle v
+//  otherwise     --->  the triplets of angle v are written from the
+//                      offset count[v] of rows, cols and vals
+//  Repeated ( row , col ) pairs are meant to be summed
+void matrix_ss( int npix , float *angles , int nang , int method , int num_cores ,
+                long *count , int *rows , int *cols , float *vals )
+{
+    int v;
+    Triplets tr;
+    Angle ang;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) private( tr , ang )
+    for( v=0 ; v<nang ; v++ ){
+        init_angle( &ang , angles[v] );
+        tr.n = 0;
+
+        if( rows == NULL ){
+            tr.row = NULL;  tr.col = NULL;  tr.val = NULL;
+            triplets_ss( npix , &ang , v , nang , method , &tr );
+            count[v] = tr.n;
+        }
+        else{
+            tr.row = rows + count[v];  tr.col = cols + count[v];  tr.val = vals + count[v];
+            triplets_ss( npix , &ang , v , nang , method , &tr );
+        }
+    }
+}
+
+
+
+
+//  Copy of the slices [ z0 , z0 + nz ) of a strided input into the C-contiguous
+//  float32 buffer buf ( nz x nrows x ncols ); the element ( z , i , j ) of the
+//  input lies at the byte offset z * sz + ( i - row0 ) * sr + j * sc from data and
+//  is stored as float32 ( dtype 0 ) or float64 ( dtype 1 ); only the rows
+//  nrows - 1 - v of the nsub angles v listed in subset are copied, all the
+//  rows when subset is NULL, and the other rows of buf are left as they are
+static void gather_slices( char *data , long sz , long sr , long sc , int dtype , int z0 ,
+                           int nz , int nrows , int ncols , int row0 , int *subset , int nsub ,
+                           int num_cores , float *buf )
+{
+    long r;
+    int i, j;
+    char *row;
+    float *dst;
+
+    if( subset == NULL )
+        nsub = nrows;
+
+    #pragma omp parallel for num_threads( num_cores ) schedule( runtime ) \
+                         private( i , j , row , dst )
+    for( r=0 ; r<(long)nz*nsub ; r++ ){
+        i   = ( subset == NULL ) ? r % nsub : nrows - 1 - subset[ r % nsub ];
+        row = data + ( z0 + r / nsub ) * sz + ( i - row0 ) * sr;
+        dst = buf + ( ( r / nsub ) * nrows + i ) * ncols;
+
+        if( dtype == 0 )
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = *( float * )( row + j * sc );
+        else
+            for( j=0 ; j<ncols ; j++ )
+                dst[j] = (float)*( double * )( row + j * sc );
+    }
+}
+
+
+
+
+//  Projectors of a stack of nslices images ( nslices x npix x npix ) and
+//  sinograms ( nslices x nang x npix ), both C-contiguous, with a plan;
+//  only the nsub angles listed in subset are projected, all of them when
+//  subset is NULL
+void plan_ss_execute( Plan_ss *plan , float* image , int nslices , int oper , int *subset ,
+                      int nsub , int num_cores , float *sino )
+{
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( oper == 0 )
+        forwproj_ss( plan , image , nslices , subset , nsub , num_cores , sino );
+    else
+        backproj_ss( plan , image , nslices , subset , nsub , num_cores , sino );
+}
+
+
+
+
+//  Projectors of a stack of nslices inputs given as a strided view ( see
+//  gather_slices ) into a C-contiguous float32 output: a C-contiguous
+//  float32 input is projected in place, any other layout is converted on
+//  the fly by blocks of SLICE_BLOCK slices, without ever holding a copy
+//  of the whole stack.  The sinograms given to the adjoint ( oper 1 ) may
+//  also be blocks of consecutive rows, row0 being the sinogram row of
+//  their first row: only the rows of the nsub angles listed in subset
+//  are then read, and the contiguous path is only taken for row0 = 0;
+//  -1 is returned when the buffer of the blocks
+//  cannot be allocated, 0 otherwise
+int plan_ss_execute_strided( Plan_ss *plan , char *data , long sz , long sr , long sc ,
+                             int dtype , int nslices , int oper , int row0 , int *subset ,
+                             int nsub , int num_cores , float *out )
+{
+    int npix, nrows, nbuf, z0, nz;
+    long nin, nout;
+    float *buf;
+
+    npix  = plan->npix;
+    nrows = ( oper == 0 ) ? npix : plan->nang;
+    nin   = (long)nrows * npix;
+    nout  = ( oper == 0 ) ? (long)plan->nang * npix : (long)npix * npix;
+
+    if( num_cores < 1 )
+        num_cores = 1;
+
+    if( dtype == 0 && row0 == 0 && sc == sizeof( float ) && sr == npix * sizeof( float ) &&
+        ( nslices == 1 || sz == nin * sizeof( float ) ) ){
+        if( oper == 0 )
+            plan_ss_execute( plan , ( float * )data , nslices , 0 , subset , nsub , num_cores ,
+                             out );
+        else
+            plan_ss_execute( plan , out , nslices , 1 , subset , nsub , num_cores ,
+                             ( float * )data );
+        return 0;
+    }
+
+    nbuf = ( nslices < SLICE_BLOCK ) ? nslices : SLICE_BLOCK;
+    buf  = ( float * )malloc( nbuf * nin * sizeof( float ) );
+
+    if( buf == NULL )
+        return -1;
+
+    for( z0=0 ; z0<nslices ; z0+=SLICE_BLOCK ){
+        nz = ( nslices - z0 < SLICE_BLOCK ) ? nslices - z0 : SLICE_BLOCK;
+
+        if( oper == 0 )
+            gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , 0 , NULL , 0 ,
+                           num_cores , buf );
+        else
+            gather_slices( data , sz , sr , sc , dtype , z0 , nz , nrows , npix , row0 , subset ,
+                           nsub , num_cores , buf );
+
+        if( oper == 0 )
+            plan_ss_execute( plan , buf , nz , 0 , subset , nsub , num_cores , out + z0 * nout );
+        else
+            plan_ss_execute( plan , out + z0 * nout , nz , 1 , subset , nsub , num_cores , buf );
+    }
+
+    free( buf );
+
+    return 0;
+}
+
+
+
+
+//  Same as above for a single call, with a plan used once; -1 is returned
+//  when the plan cannot be allocated, 0 otherwise
+int radon_ss( float* image , int nslices , int npix , float *angles , int nang , int oper ,
+              int method , int num_cores , float *sino )
+{
+    Plan_ss *plan = plan_ss_create( npix , angles , nang , method );
+
+    if( plan == NULL )
+        return -1;
+
+    plan_ss_execute( plan , image , nslices , oper , NULL , 0 , num_cores , sino );
+    plan_ss_destroy( plan );
+
+    return 0;
 }
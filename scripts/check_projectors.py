@@ -0,0 +1,276 @@
+###########################################################
+###########################################################
+####                                                   ####
+####             NON-INTERACTIVE CHECK ROUTINE         ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Checks, for every projector, the properties the native code is
+##  meant to guarantee, printing PASSED or FAILED for each of them and
+##  exiting with status 1 if any fails:
+##  1) adjointness, < A x , y > = < x , A^T y >
+##  2) the same result with 1 thread and with several threads
+##  3) a stack of slices projected at once as slice by slice
+##  4) angle_indices leaving the other rows of the sinogram untouched
+##     by A and ignored by A^T
+##  5) the sparse system matrix giving the same result as the native
+##     projectors
+##  The look-up-tables and the system matrices are computed in a
+##  temporary folder, removed at the end.
+##  Usage: python check_projectors.py [ npix [ nang ] ]
+
+
+
+
+####  PYTHON MODULES
+from __future__ import division , print_function
+import sys
+import shutil
+import tempfile
+import multiprocessing as mproc
+import numpy as np
+
+import class_projectors_radon as cpr
+import class_projectors_bspline as cpb
+
+
+
+
+####  MY VARIABLE FORMAT
+myfloat = np.float32
+
+
+
+
+####  ABBREVIATIONS FOR PROJECTORS
+####    dd  --->  distance-driven
+####    pd  --->  pixel-driven
+####    rd  --->  ray-driven
+####    ss  --->  slant-stacking
+####    bsp --->  bspline
+list_proj = [ 'dd' , 'pd' , 'rd' , 'ss' , 'bsp' ]
+
+
+
+
+####  TOLERANCES
+##  Relative tolerance of the checks computed in float32 with a
+##  different order of the sums: adjointness, angle_indices of A^T and
+##  matrix against native projectors; the other checks must be exact
+tol_adjoint = 1e-5
+tol_rows    = 1e-5
+tol_matrix  = 1e-4
+
+
+
+
+####  GEOMETRY OF THE CHECKS
+npix    = 64
+nang    = 60
+nslices = 5
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####                      UTILITIES                    ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  Projectors class of the abbreviation abbr, with the angles
+##  equispaced in [0,180) degrees; cache is the folder of the
+##  look-up-tables and of the system matrices
+
+def get_projectors( abbr , cache , num_threads=None , matrix=False ):
+    a = np.arange( nang ) * 180.0 / nang
+
+    if abbr != 'bsp':
+        return cpr.projectors( npix , a , oper=abbr , filt='ramp' , num_threads=num_threads ,
+                               matrix=matrix , matrix_cache=cache )
+    else:
+        a *= np.pi / 180.0
+        return cpb.projectors( npix , a , bspline_degree=3 , proj_support_y=4 ,
+                               nsamples_y=2048 , radon_degree=0 , filt='ramp' ,
+                               back=False , num_threads=num_threads , matrix=matrix ,
+                               matrix_cache=cache , lut_cache=cache )
+
+
+
+##  Maximum absolute difference of a and b relative to the maximum
+##  absolute value of b
+
+def rel_diff( a , b ):
+    return np.max( np.abs( a - b ) ) / np.max( np.abs( b ) )
+
+
+
+##  Print the outcome of a check and return it
+
+def report( name , passed , detail='' ):
+    if passed:
+        outcome = 'PASSED'
+    else:
+        outcome = 'FAILED'
+
+    print( '    ' + name.ljust( 40 , '.' ) + ' ' + outcome + detail )
+
+    return passed
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####                       CHECKS                      ####
+####                                                   ####
+###########################################################
+###########################################################
+
+##  1) < A x , y > = < x , A^T y >, the inner products computed in
+##  double precision
+
+def check_adjoint( tp , x , y ):
+    lhs = np.vdot( tp.A( x ).astype( np.float64 ) , y )
+    rhs = np.vdot( x.astype( np.float64 ) , tp.At( y ) )
+    err = np.abs( lhs - rhs ) / np.abs( rhs )
+
+    return report( 'adjoint' , err <= tol_adjoint , '  ( relative error %.1e )' % err )
+
+
+
+##  2) The work is split among the threads without changing the order
+##  of any sum, hence the results are identical
+
+def check_threads( abbr , cache , x , y ):
+    tp1 = get_projectors( abbr , cache , num_threads=1 )
+    tpn = get_projectors( abbr , cache , num_threads=max( mproc.cpu_count() , 4 ) )
+
+    passed = np.array_equal( tp1.A( x ) , tpn.A( x ) ) and \
+             np.array_equal( tp1.At( y ) , tpn.At( y ) )
+
+    return report( '1 thread vs several threads' , passed )
+
+
+
+##  3) A stack is projected by blocks of slices, each slice exactly as
+##  when projected alone
+
+def check_stack( tp , x , y ):
+    sino = np.array( [ tp.A( xs ) for xs in x ] )
+    reco = np.array( [ tp.At( ys ) for ys in y ] )
+
+    passed = np.array_equal( tp.A( x ) , sino ) and np.array_equal( tp.At( y ) , reco )
+
+    return report( 'stack vs slice by slice' , passed )
+
+
+
+##  4) A with angle_indices writes the rows angle_indices of out, as
+##  the full projection, and leaves the others untouched; A^T with
+##  angle_indices never reads the other rows, filled here with NaN
+
+def check_angle_indices( tp , x , y ):
+    rows  = np.arange( 1 , nang , 7 )
+    other = np.setdiff1d( np.arange( nang ) , rows )
+
+    out = np.full( y.shape , -1.0 , dtype=myfloat )
+    tp.A( x , out=out , angle_indices=rows )
+
+    passed = np.all( out[:,other,:] == -1.0 ) and \
+             np.array_equal( out[:,rows,:] , tp.A( x )[:,rows,:] )
+
+    y_nan = y.copy()
+    y_nan[:,other,:] = np.nan
+    y_zero = y.copy()
+    y_zero[:,other,:] = 0.0
+
+    reco = tp.At( y_nan , angle_indices=rows )
+
+    passed = passed and np.all( np.isfinite( reco ) ) and \
+             rel_diff( reco , tp.At( y_zero ) ) <= tol_rows
+
+    return report( 'angle_indices' , passed )
+
+
+
+##  5) The sparse system matrix against the native projectors
+
+def check_matrix( abbr , cache , tp , x , y ):
+    tpm = get_projectors( abbr , cache , matrix=True )
+
+    err = max( rel_diff( tpm.A( x ) , tp.A( x ) ) , rel_diff( tpm.At( y ) , tp.At( y ) ) )
+
+    return report( 'matrix vs native' , err <= tol_matrix , '  ( relative error %.1e )' % err )
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####                         MAIN                      ####
+####                                                   ####
+###########################################################
+###########################################################
+
+def main():
+    global npix , nang
+
+    if len( sys.argv ) > 1:
+        npix = int( sys.argv[1] )
+    if len( sys.argv ) > 2:
+        nang = int( sys.argv[2] )
+
+    print( '\nCheck of the projectors: npix = ' + str( npix ) + ' , nang = ' + str( nang ) +
+           ' , stacks of ' + str( nslices ) + ' slices' )
+
+    ##  Random stacks of images and of sinograms, the same for every run
+    rng = np.random.RandomState( 0 )
+    x   = rng.random_sample( ( nslices , npix , npix ) ).astype( myfloat )
+    y   = rng.random_sample( ( nslices , nang , npix ) ).astype( myfloat )
+
+    cache  = tempfile.mkdtemp()
+    failed = []
+
+    try:
+        for abbr in list_proj:
+            print( '\nProjector ' + abbr + ':' )
+
+            tp = get_projectors( abbr , cache )
+
+            passed = [ check_adjoint( tp , x[0] , y[0] ) ,
+                       check_threads( abbr , cache , x , y ) ,
+                       check_stack( tp , x , y ) ,
+                       check_angle_indices( tp , x , y ) ,
+                       check_matrix( abbr , cache , tp , x , y ) ]
+
+            if not all( passed ):
+                failed.append( abbr )
+
+    finally:
+        shutil.rmtree( cache , ignore_errors=True )
+
+    if failed:
+        print( '\nFAILED for: ' + ' , '.join( failed ) + '\n' )
+        sys.exit( 1 )
+    else:
+        print( '\nAll checks PASSED\n' )
+
+
+
+
+###########################################################
+###########################################################
+####                                                   ####
+####                    CALL TO MAIN                   ####
+####                                                   ####
+###########################################################
+###########################################################
+
+if __name__ == '__main__':
+    main()
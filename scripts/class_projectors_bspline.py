@@ -23,6 +23,7 @@ sys.path.append( '../projector_bspline/' )
 from projector_bspline import bspline_functions as bfun
 from pymodule_genradon import genradon as gr
 import filters as fil
+import system_matrix as sysm
 
 
 
@@ -37,11 +38,31 @@ myint = np.int
 ####  CLASS PROJECTORS
 class projectors:
 
+    ##  Process-wide defaults for the threads of the native projectors,
+    ##  overridden by the keywords of the same name of each instance:
+    ##  num_threads=None uses all the cores, schedule is an OpenMP
+    ##  schedule given as in OMP_SCHEDULE, e.g. 'static' or 'dynamic,4'
+    num_threads = None
+    schedule    = None
+
+    ##  Angles per block of the streaming filtered backprojection
+    fbp_chunk = 128
+
+
     ##  Init class projectors
     def __init__( self , npix , angles , ctr=0.0 , bspline_degree = 3 , proj_support_y=4 ,
-                  nsamples_y=2048 , radon_degree=0 , filt='ramp' , back='False' ):
+                  nsamples_y=2048 , radon_degree=0 , filt='ramp' , back='False' ,
+                  num_threads=None , schedule=None , matrix=False , matrix_cache=None ,
+                  lut_cache=None , compact_lut=False ):
     
-        ##  Compute regridding look-up-table and deapodizer
+        ##  Compute regridding look-up-table and deapodizer; the table is
+        ##  stored in the disk cache lut_cache ( None for the default folder
+        ##  of bspline_functions ) and memory-mapped from there afterwards.
+        ##  With compact_lut=True the symmetric angles share a row, only the
+        ##  positive half of each profile is stored and it is interpolated
+        ##  linearly: a few hundred samples, e.g. nsamples_y=256, are enough.
+        ##  The look-up-table is computed for the angles in radians, the
+        ##  native projectors take them in degrees
         nang      = len( angles )
         angles    = np.arange( nang )
         angles    = ( angles * 180.0 )/myfloat( nang )
@@ -49,15 +70,24 @@ class projectors:
             rd = radon_degree
         else:
             rd = 0
-        lut = bfun.init_lut_bspline( nsamples_y , angles , 
-                                     bspline_degree ,
-                                     rd , 
-                                     proj_support_y )
+        lut = bfun.get_lut_bspline( nsamples_y , angles * np.pi / 180.0 ,
+                                    bspline_degree ,
+                                    rd ,
+                                    proj_support_y ,
+                                    folder=lut_cache ,
+                                    compact=compact_lut )
+
+        if compact_lut is True:
+            lut , lut_rows = lut
+        else:
+            lut_rows = None
         
        
 
         ##  Assign parameters
-        self.lut            = lut.astype( myfloat )
+        self.lut            = np.asarray( lut , dtype=myfloat )
+        self.lut_rows       = lut_rows
+        self.lut_parity     = ( -1 )**rd
         self.angles         = angles.astype( myfloat )
         self.nang           = nang
         self.bspline_degree = bspline_degree
@@ -65,23 +95,154 @@ class projectors:
         self.filt           = filt
         self.radon_degree   = radon_degree
 
+        if num_threads is not None:
+            self.num_threads = num_threads
+        if schedule is not None:
+            self.schedule = schedule
+
+
+        ##  Plan of the native projectors, reused by every projection
+        self.npix = npix
+        self.plan = gr.plan( npix , self.angles , self.lut , self.param_spline ,
+                             self.lut_rows , self.lut_parity )
+
+
+        ##  Sparse system matrix: when enabled, A and At become sparse
+        ##  matrix-vector products; the matrix is stored in the disk cache
+        ##  matrix_cache ( None for the default folder of system_matrix )
+        self.matrix = None
+
+        if matrix is True:
+            self.matrix = self.get_matrix( matrix_cache )
+
+
+
+    ##  Keywords controlling the threads of the native projectors
+    def omp_kwargs( self ):
+        return { 'num_threads' : self.num_threads , 'schedule' : self.schedule }
+
 
 
     
-    ##  Forward projector
-    def A( self , x ):
-        return gr.forwproj( x.astype( myfloat ) , self.angles , self.lut , self.param_spline )
+    ##  Key identifying the geometry of the operator, shared by the disk
+    ##  caches of the system matrix and of the operator statistics
+    def geometry_key( self ):
+        extra = [ self.lut , self.param_spline ]
+        if self.lut_rows is not None:
+            extra += [ self.lut_rows ]
+
+        return sysm.matrix_key( 'bspline' , self.npix , self.angles , self.bspline_degree ,
+                                extra=extra )
+
+
+
+    ##  Build or read from the disk cache the sparse system matrix
+    def get_matrix( self , folder=None ):
+        build = lambda: gr.matrix( self.npix , self.angles , self.lut , self.param_spline ,
+                                   self.lut_rows , self.lut_parity , **self.omp_kwargs() )
+
+        return sysm.get_matrix( self.geometry_key() , build , folder )
+
+
+
+    ##  Native projectors: oper is 'forwproj' or 'backproj'; a 3D array is
+    ##  processed as a stack of slices in a single native call
+    def project( self , x , oper , out=None , accumulate=False , angle_indices=None ):
+        if oper == 'forwproj':
+            return self.plan.forward( x , out=out , accumulate=accumulate ,
+                                      angle_indices=angle_indices , **self.omp_kwargs() )
+        else:
+            return self.plan.adjoint( x , out=out , accumulate=accumulate ,
+                                      angle_indices=angle_indices , **self.omp_kwargs() )
+
+
+
+    ##  Rows of the sparse system matrix belonging to the sinogram rows rows
+    def matrix_rows( self , rows ):
+        return self.matrix[ ( rows[:,None] * self.npix + np.arange( self.npix ) ).ravel() ]
+
+
+
+    ##  Result of a sparse matrix product written into the optional
+    ##  buffer out, summed to its content when accumulate is True; when
+    ##  rows is given, res only holds those rows of the sinograms
+    def store( self , res , out , accumulate , rows=None ):
+        if rows is not None:
+            if out is None:
+                out = np.zeros( res.shape[:-2] + ( self.nang , self.npix ) , dtype=myfloat )
+
+            if accumulate is True:
+                out[...,rows,:] += res
+            else:
+                out[...,rows,:] = res
+
+            return out
+
+        if out is None:
+            return res
+        elif accumulate is True:
+            out += res
+        else:
+            out[...] = res
+
+        return out
+
+
+
+    ##  Forward projector of an image ( npix x npix ) or of a stack of
+    ##  images ( nslices x npix x npix ); the result can be written into a
+    ##  preallocated float32 array out, or summed to it with accumulate=True.
+    ##  angle_indices restricts the projection to some rows of the sinogram,
+    ##  e.g. a subset of an ordered-subsets method: only those rows of out
+    ##  are written, and their share of the work only is done
+    def A( self , x , out=None , accumulate=False , angle_indices=None ):
+        if self.matrix is not None:
+            x = np.asarray( x , dtype=myfloat )
+
+            if angle_indices is None:
+                rows , mat , nrows = None , self.matrix , self.nang
+            else:
+                rows  = np.asarray( angle_indices , dtype=int ).reshape( -1 )
+                mat   = self.matrix_rows( rows )
+                nrows = len( rows )
+
+            sino = mat.dot( x.reshape( -1 , self.npix**2 ).T ).T
+            sino = sino.reshape( x.shape[:-2] + ( nrows , self.npix ) )
+            return self.store( sino , out , accumulate , rows )
+        else:
+            return self.project( x , 'forwproj' , out , accumulate , angle_indices )
 
 
     
-    ##  Backprojector
-    def At( self , x ):
-        return gr.backproj( x.astype( myfloat ) , self.angles , self.lut , self.param_spline )
+    ##  Backprojector of a sinogram ( nang x npix ) or of a stack of
+    ##  sinograms ( nslices x nang x npix ); out , accumulate and
+    ##  angle_indices as in A, only the rows angle_indices of x are read
+    def At( self , x , out=None , accumulate=False , angle_indices=None ):
+        if self.matrix is not None:
+            x = np.asarray( x , dtype=myfloat )
+
+            if angle_indices is None:
+                mat , nrows = self.matrix , self.nang
+            else:
+                rows  = np.asarray( angle_indices , dtype=int ).reshape( -1 )
+                mat   = self.matrix_rows( rows )
+                nrows = len( rows )
+                x     = x[...,rows,:]
+
+            reco = mat.T.dot( x.reshape( -1 , nrows * self.npix ).T ).T
+            reco = reco.reshape( x.shape[:-2] + ( self.npix , self.npix ) )
+            return self.store( reco , out , accumulate )
+        else:
+            return self.project( x , 'backproj' , out , accumulate , angle_indices )
 
 
 
-    ##  Filtered backprojection
-    def fbp( self , x ):
+    ##  Filtered backprojection of a sinogram or of a stack of sinograms,
+    ##  which is not modified; with stream=True the sinogram is filtered by
+    ##  blocks of chunk_size angles ( default fbp_chunk ) on a second
+    ##  thread, while the blocks already filtered are backprojected and
+    ##  summed into the image, so that no full-size filtered copy is held
+    def fbp( self , x , stream=False , chunk_size=None ):
         ##  Option DPC
         if self.radon_degree == 0:
             dpc = False
@@ -89,12 +250,23 @@ class projectors:
             dpc = True
 
         
-        ##  Filtering projection
-        x[:] = fil.filter_proj( x , ftype=self.filt , dpc=dpc )
-    
-        
-        ##  Backprojection
-        reco = gr.backproj( x.astype( myfloat ) , self.angles , self.lut , self.param_spline )
+        if stream is False:
+            ##  Filtering projection
+            x = np.array( x , dtype=myfloat )
+            fil.filter_proj( x , ftype=self.filt , dpc=dpc , num_threads=self.num_threads )
+
+            ##  Backprojection
+            reco = self.project( x , 'backproj' )
+
+        else:
+            if chunk_size is None:
+                chunk_size = self.fbp_chunk
+
+            reco = np.zeros( x.shape[:-2] + ( self.npix , self.npix ) , dtype=myfloat )
+
+            for i0 , block in fil.filter_chunks( x , chunk_size , ftype=self.filt , dpc=dpc ):
+                self.plan.adjoint( block , out=reco , accumulate=True , row_offset=i0 ,
+                                   **self.omp_kwargs() )
 
 
         ##  Normalization
@@ -19,6 +19,7 @@ import numpy as np
 
 ####  MY MODULES
 import filters as fil
+import system_matrix as sysm
 
 sys.path.append( '..' )   
 from projector_pixel_driven import radon_pixel_driven as rpd
@@ -39,8 +40,20 @@ myint = np.int
 ####  CLASS PROJECTORS
 class projectors:
 
+    ##  Process-wide defaults for the threads of the native projectors,
+    ##  overridden by the keywords of the same name of each instance:
+    ##  num_threads=None uses all the cores, schedule is an OpenMP
+    ##  schedule given as in OMP_SCHEDULE, e.g. 'static' or 'dynamic,4'
+    num_threads = None
+    schedule    = None
+
+    ##  Angles per block of the streaming filtered backprojection
+    fbp_chunk = 128
+
+
     ##  Init class projectors
-    def __init__( self , npix , angles , oper='pd' , ctr=0.0 , filt='ramp' ):
+    def __init__( self , npix , angles , oper='pd' , ctr=0.0 , filt='ramp' ,
+                  num_threads=None , schedule=None , matrix=False , matrix_cache=None ):
         nang = len( angles )
         angles1 = angles * np.pi / 180.0
 
@@ -50,49 +63,188 @@ class projectors:
         self.angles       = angles1.astype( myfloat )
         self.oper         = oper
 
+        if num_threads is not None:
+            self.num_threads = num_threads
+        if schedule is not None:
+            self.schedule = schedule
+
+
+        ##  Plan of the native projectors: the geometry of the angles is
+        ##  computed once here and reused by every projection
+        self.npix = npix
+
+        if oper == 'pd':
+            self.plan = rpd.plan( npix , self.angles , 1 )
+        elif oper == 'rd':
+            self.plan = rrd.plan( npix , self.angles )
+        elif oper == 'dd':
+            self.plan = rdd.plan( npix , self.angles )
+        elif oper == 'ss':
+            self.plan = rss.plan( npix , self.angles , 1 )
+        else:
+            sys.exit( '\nERROR: projector "' + str( oper ) + '" not available !!' )
 
-    
-    ##  Forward projector
-    def A( self , x ):
-        if self.oper == 'pd':
-            return rpd.forwproj( x.astype( myfloat ) , self.angles , 1 )
-        elif self.oper == 'rd':
-            return rrd.forwproj( x.astype( myfloat ) , self.angles )
-        elif self.oper == 'dd':
-            return rdd.forwproj( x.astype( myfloat ) , self.angles )
-        elif self.oper == 'ss':
-            return rss.forwproj( x.astype( myfloat ) , self.angles , 1 ) 
+
+        ##  Sparse system matrix: when enabled, A and At become sparse
+        ##  matrix-vector products; the matrix is stored in the disk cache
+        ##  matrix_cache ( None for the default folder of system_matrix )
+        self.matrix = None
+
+        if matrix is True:
+            self.matrix = self.get_matrix( matrix_cache )
+
+
+
+    ##  Keywords controlling the threads of the native projectors
+    def omp_kwargs( self ):
+        return { 'num_threads' : self.num_threads , 'schedule' : self.schedule }
 
 
     
-    ##  Backprojector
-    def At( self , x ):
+    ##  Key identifying the geometry of the operator, shared by the disk
+    ##  caches of the system matrix and of the operator statistics
+    def geometry_key( self ):
+        if self.oper == 'pd' or self.oper == 'ss':
+            method = 1
+        else:
+            method = 0
+
+        return sysm.matrix_key( 'radon_' + self.oper , self.npix , self.angles , method )
+
+
+
+    ##  Build or read from the disk cache the sparse system matrix
+    def get_matrix( self , folder=None ):
         if self.oper == 'pd':
-            return rpd.backproj( x.astype( myfloat ) , self.angles , 1 )
+            build = lambda: rpd.matrix( self.npix , self.angles , 1 , **self.omp_kwargs() )
         elif self.oper == 'rd':
-            return rrd.backproj( x.astype( myfloat ) , self.angles )
+            build = lambda: rrd.matrix( self.npix , self.angles , **self.omp_kwargs() )
         elif self.oper == 'dd':
-            return rdd.backproj( x.astype( myfloat ) , self.angles )
+            build = lambda: rdd.matrix( self.npix , self.angles , **self.omp_kwargs() )
         elif self.oper == 'ss':
-            return rss.backproj( x.astype( myfloat ) , self.angles , 1 )  
+            build = lambda: rss.matrix( self.npix , self.angles , 1 , **self.omp_kwargs() )
+        else:
+            sys.exit( '\nERROR: projector "' + str( self.oper ) + '" not available !!' )
+
+        return sysm.get_matrix( self.geometry_key() , build , folder )
 
 
 
-    ##  Filtered backprojection
-    def fbp( self , x ):
-        ##  Filtering projection
-        x[:] = fil.filter_proj( x , ftype=self.filt )
+    ##  Native projectors: oper is 'forwproj' or 'backproj'; a 3D array is
+    ##  processed as a stack of slices in a single native call
+    def project( self , x , oper , out=None , accumulate=False , angle_indices=None ):
+        if oper == 'forwproj':
+            return self.plan.forward( x , out=out , accumulate=accumulate ,
+                                      angle_indices=angle_indices , **self.omp_kwargs() )
+        else:
+            return self.plan.adjoint( x , out=out , accumulate=accumulate ,
+                                      angle_indices=angle_indices , **self.omp_kwargs() )
+
+
+
+    ##  Rows of the sparse system matrix belonging to the sinogram rows rows
+    def matrix_rows( self , rows ):
+        return self.matrix[ ( rows[:,None] * self.npix + np.arange( self.npix ) ).ravel() ]
+
+
+
+    ##  Result of a sparse matrix product written into the optional
+    ##  buffer out, summed to its content when accumulate is True; when
+    ##  rows is given, res only holds those rows of the sinograms
+    def store( self , res , out , accumulate , rows=None ):
+        if rows is not None:
+            if out is None:
+                out = np.zeros( res.shape[:-2] + ( self.nang , self.npix ) , dtype=myfloat )
+
+            if accumulate is True:
+                out[...,rows,:] += res
+            else:
+                out[...,rows,:] = res
+
+            return out
+
+        if out is None:
+            return res
+        elif accumulate is True:
+            out += res
+        else:
+            out[...] = res
+
+        return out
+
+
+
+    ##  Forward projector of an image ( npix x npix ) or of a stack of
+    ##  images ( nslices x npix x npix ); the result can be written into a
+    ##  preallocated float32 array out, or summed to it with accumulate=True.
+    ##  angle_indices restricts the projection to some rows of the sinogram,
+    ##  e.g. a subset of an ordered-subsets method: only those rows of out
+    ##  are written, and their share of the work only is done
+    def A( self , x , out=None , accumulate=False , angle_indices=None ):
+        if self.matrix is not None:
+            x = np.asarray( x , dtype=myfloat )
+
+            if angle_indices is None:
+                rows , mat , nrows = None , self.matrix , self.nang
+            else:
+                rows  = np.asarray( angle_indices , dtype=int ).reshape( -1 )
+                mat   = self.matrix_rows( rows )
+                nrows = len( rows )
+
+            sino = mat.dot( x.reshape( -1 , self.npix**2 ).T ).T
+            sino = sino.reshape( x.shape[:-2] + ( nrows , self.npix ) )
+            return self.store( sino , out , accumulate , rows )
+        else:
+            return self.project( x , 'forwproj' , out , accumulate , angle_indices )
+
+
     
-        
-        ##  Backprojection
-        if self.oper == 'pd':
-            reco = rpd.backproj( x.astype( myfloat ) , self.angles , 1 )
-        elif self.oper == 'rd':
-            reco = rrd.backproj( x.astype( myfloat ) , self.angles )
-        elif self.oper == 'dd':
-            reco = rdd.backproj( x.astype( myfloat ) , self.angles )
-        elif self.oper == 'ss':
-            reco = rss.backproj( x.astype( myfloat ) , self.angles , 1 ) 
+    ##  Backprojector of a sinogram ( nang x npix ) or of a stack of
+    ##  sinograms ( nslices x nang x npix ); out , accumulate and
+    ##  angle_indices as in A, only the rows angle_indices of x are read
+    def At( self , x , out=None , accumulate=False , angle_indices=None ):
+        if self.matrix is not None:
+            x = np.asarray( x , dtype=myfloat )
+
+            if angle_indices is None:
+                mat , nrows = self.matrix , self.nang
+            else:
+                rows  = np.asarray( angle_indices , dtype=int ).reshape( -1 )
+                mat   = self.matrix_rows( rows )
+                nrows = len( rows )
+                x     = x[...,rows,:]
+
+            reco = mat.T.dot( x.reshape( -1 , nrows * self.npix ).T ).T
+            reco = reco.reshape( x.shape[:-2] + ( self.npix , self.npix ) )
+            return self.store( reco , out , accumulate )
+        else:
+            return self.project( x , 'backproj' , out , accumulate , angle_indices )
+
+
+
+    ##  Filtered backprojection of a sinogram or of a stack of sinograms,
+    ##  which is not modified; with stream=True the sinogram is filtered by
+    ##  blocks of chunk_size angles ( default fbp_chunk ) on a second
+    ##  thread, while the blocks already filtered are backprojected and
+    ##  summed into the image, so that no full-size filtered copy is held
+    def fbp( self , x , stream=False , chunk_size=None ):
+        if stream is False:
+            ##  Filtering projection
+            x = np.array( x , dtype=myfloat )
+            fil.filter_proj( x , ftype=self.filt , num_threads=self.num_threads )
+
+            ##  Backprojection
+            reco = self.project( x , 'backproj' )
+
+        else:
+            if chunk_size is None:
+                chunk_size = self.fbp_chunk
+
+            reco = np.zeros( x.shape[:-2] + ( self.npix , self.npix ) , dtype=myfloat )
+
+            for i0 , block in fil.filter_chunks( x , chunk_size , ftype=self.filt ):
+                self.plan.adjoint( block , out=reco , accumulate=True , row_offset=i0 ,
+                                   **self.omp_kwargs() )
 
 
         ##  Normalization
@@ -10,8 +10,12 @@
 
 
 ####  PYTHON MODULES
+import os
 import sys
+import queue
+import threading
 import numpy as np
+import scipy.fft as fft
 
 
 
@@ -24,6 +28,17 @@ mycomplex = np.complex64
 
 
 
+####  FILTERING PARAMETERS
+##  Filters already computed, by ( nfreq , ftype , dpc )
+filter_cache = {}
+
+##  Number of samples transformed at once: the projections are filtered
+##  by blocks of rows, so that the Fourier buffers stay small
+block_size = 2**22
+
+
+
+
 ##########################################################
 ##########################################################
 ####                                                  ####
@@ -33,20 +48,18 @@ mycomplex = np.complex64
 ##########################################################
 
 def ramp( n ):
-    nh = np.int( n * 0.5 )
+    nh = int( n * 0.5 )
+    c  = np.arange( n ) - ( nh - 1 )
+
     ramp = np.zeros( n )
+    ramp[c == 0] = 0.25
+
+    odd = c % 2 == 1
+    ramp[odd] = -1.0 / ( np.pi * c[odd] )**2
 
-    for i in range( n ):
-        c = i - ( nh - 1 )
-        if c == 0:
-            ramp[i] = 0.25
-        elif c % 2 == 0:
-            ramp[i] = 0.0
-        else:
-            ramp[i] = -1.0 / ( np.pi * c )**2
     return ramp
 
-            
+
 
 def hann( k ):
     return 0.5 * ( 1 + np.cos( np.pi * k / 0.5 ) )
@@ -74,33 +87,68 @@ def parz( k ):
 
 
 
-def calc_filter( n , ftype='ramp' , dpc=False ):
-    nh = np.int( n * 0.5 )   
-                                                                
-    if ftype is not None and dpc is False:
-        filt = np.abs( np.fft.fft( ramp( n ) ) )[:nh]
-        k    = np.arange( nh ) / myfloat( n )
-        
-        if ftype=='ramp' or ftype=='ram-lak' or ftype=='Ram-Lak':
-            wind = np.ones( len( k ) )
+def window( k , ftype ):
+    if ftype=='ramp' or ftype=='ram-lak' or ftype=='Ram-Lak':
+        return np.ones( len( k ) )
+
+    elif ftype=='hann' or ftype=='hanning' or ftype=='Hann' or ftype=='Hanning':
+        return hann( k )
+
+    elif ftype=='shlo' or ftype=='shepp-logan' or ftype=='Shepp-Logan':
+        return shlo( k )
+
+    elif ftype=='parz' or ftype=='parzen' or ftype=='Parzen':
+        return parz( k )
+
+    else:
+        sys.exit( '\nERROR: filter type ' + str( ftype ) + ' not available !!' )
 
-        elif ftype=='hann' or ftype=='hanning' or ftype=='Hann' or ftype=='Hanning':
-            wind = hann( k )
 
-        elif ftype=='shlo' or ftype=='shepp-logan' or ftype=='Shepp-Logan':
-            wind = shlo( k )
 
-        elif ftype=='parz' or ftype=='parzen' or ftype=='Parzen':   
-            wind = parz( k )
+##  Positive half of the filter, i.e. its values on the frequencies of a
+##  real FFT of length nfreq - 1; the filters are odd-length and even, so
+##  that the half determines them.  For differential phase-contrast data
+##  ( dpc=True ) the projections are derivatives and the ramp becomes the
+##  Hilbert filter -i sign(k) / ( 2 pi ).  The arrays are memoized and
+##  read-only, since they are shared among the calls
+def get_filter( nfreq , ftype='ramp' , dpc=False ):
+    key = ( nfreq , ftype , dpc )
 
-        filt *= wind
-        filt  = np.hstack( ( filt , filt[nh-1:0:-1] ) )
-        #print( filt )
+    if key in filter_cache:
+        return filter_cache[key]
 
-    elif ftype is None and dpc is False:
-        filt = np.ones( 2 * n )
+    nh = int( nfreq * 0.5 )
+    k  = np.arange( nh ) / myfloat( nfreq )
 
-    return filt      
+    if ftype is None and dpc is False:
+        filt = np.ones( nh , dtype=myfloat )
+
+    elif dpc is False:
+        filt = np.abs( np.fft.fft( ramp( nfreq ) ) )[:nh] * window( k , ftype )
+        filt = filt.astype( myfloat )
+
+    else:
+        filt = -1j * np.sign( k ) / ( 2.0 * np.pi )
+        if ftype is not None:
+            filt *= window( k , ftype )
+        filt = filt.astype( mycomplex )
+
+    filt.setflags( write=False )
+    filter_cache[key] = filt
+
+    return filt
+
+
+
+##  Whole filter, of length nfreq - 1, in the order of a complex FFT
+def calc_filter( n , ftype='ramp' , dpc=False ):
+    filt = get_filter( n , ftype=ftype , dpc=dpc )
+    nh   = len( filt )
+
+    if dpc is False:
+        return np.hstack( ( filt , filt[nh-1:0:-1] ) )
+    else:
+        return np.hstack( ( filt , np.conj( filt[nh-1:0:-1] ) ) )
 
 
 
@@ -113,33 +161,95 @@ def calc_filter( n , ftype='ramp' , dpc=False ):
 ##########################################################
 ##########################################################
 
-def filter_proj( sino , ftype='ramp' , dpc=False ):
+##  Filtering of a sinogram ( nang x npix ) or of a stack of sinograms
+##  ( nslices x nang x npix ), in place: the rows are zero-padded and
+##  filtered together with real FFTs in single precision, num_threads
+##  threads ( None for all the cores ) share each block of rows; nang is
+##  the number of angles of the whole scan, when sino is only a part of it
+def filter_proj( sino , ftype='ramp' , dpc=False , num_threads=None , nang=None ):
     ##  Compute oversamples array length
-    nang , npix = sino.shape
+    npix  = sino.shape[-1]
+    if nang is None:
+        nang = sino.shape[-2]
     norm  = np.pi / myfloat( nang )
     nfreq = 2 * int( 2**( int( np.ceil( np.log2( npix ) ) ) ) )
 
 
     ##  Compute filtering array
-    filtarr  = calc_filter( nfreq , ftype=ftype , dpc=dpc )
-    #print( 'filtarr:')
-    #for i in range( len( filtarr ) ):
-    #    print( 'i = ', i,'  filt = ' , filtarr[i] )
+    filtarr = get_filter( nfreq , ftype=ftype , dpc=dpc ) * norm
 
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
 
-    ##  Zero-pad projections
-    sino_filt = np.concatenate( ( sino , np.zeros( ( nang , nfreq - npix - 1 ) ) ) , axis=1 )
 
+    ##  Filtering in Fourier space, by blocks of rows; the real FFT
+    ##  zero-pads each row to nfreq - 1 samples
+    rows  = sino.reshape( -1 , npix )
+    nrows = rows.shape[0]
+    nb    = max( 1 , block_size // nfreq )
 
-    ##  Filtering in Fourier space
-    for i in range( nang ):
-        #sys.stdout.write( 'Filtering projection number %d\r' % ( i + 1 , ) )
-        #sys.stdout.flush()
-        sino_filt[i,:] = np.real( np.fft.ifft( np.fft.fft( sino_filt[i,:] ) * filtarr ) )
+    for i in range( 0 , nrows , nb ):
+        block = np.asarray( rows[i:i+nb] , dtype=myfloat )
+        proj  = fft.rfft( block , n=nfreq-1 , axis=1 , workers=num_threads )
+        proj *= filtarr
+        rows[i:i+nb] = fft.irfft( proj , n=nfreq-1 , axis=1 ,
+                                  workers=num_threads )[:,:npix]
 
 
-    ##  Replace values in the original array
-    sino[:,:] = norm * sino_filt[:,:npix]
+    ##  Replace values in the original array, if the rows were a copy
+    if not np.shares_memory( rows , sino ):
+        sino[:] = rows.reshape( sino.shape )
 
     return sino
 
+
+
+
+##  Pipelined filtering of a sinogram or of a stack of sinograms by blocks
+##  of chunk_size angles: a producer thread filters float32 copies of the
+##  blocks, while the caller consumes the ( first angle , block ) pairs
+##  yielded here, e.g. backprojecting them; at most depth filtered blocks
+##  wait in the queue, so that the memory stays bounded, and sino is never
+##  modified.  The FFTs release the GIL, so the producer runs concurrently
+##  with native code called by the consumer
+def filter_chunks( sino , chunk_size , ftype='ramp' , dpc=False , num_threads=1 , depth=2 ):
+    nang = sino.shape[-2]
+    pipe = queue.Queue( maxsize=depth )
+    stop = threading.Event()
+
+    def put( item ):
+        while not stop.is_set():
+            try:
+                pipe.put( item , timeout=0.1 )
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for i0 in range( 0 , nang , chunk_size ):
+                block = np.array( sino[...,i0:i0+chunk_size,:] , dtype=myfloat )
+                filter_proj( block , ftype=ftype , dpc=dpc , num_threads=num_threads ,
+                             nang=nang )
+                if not put( ( i0 , block ) ):
+                    return
+            put( None )
+        except BaseException as err:
+            put( err )
+
+    producer = threading.Thread( target=produce )
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item = pipe.get()
+            if item is None:
+                break
+            elif isinstance( item , BaseException ):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
@@ -0,0 +1,446 @@
+##########################################################
+##########################################################
+####                                                  ####
+####      ITERATIVE RECONSTRUCTION: SIRT, SART,       ####
+####               OS-SART AND FISTA-TV               ####
+####                                                  ####
+##########################################################
+##########################################################
+
+
+
+
+####  PYTHON MODULES
+import sys
+import time
+import numpy as np
+
+
+
+
+####  MY MODULES
+import operator_stats as ostats
+
+
+
+
+####  MY FORMAT VARIABLES
+myfloat = np.float32
+
+
+
+
+####  PARAMETERS
+##  Row and column sums below eps are treated as zero: the corresponding
+##  rays and pixels get a null weight instead of a huge one
+eps = 1e-6
+
+##  Fractional part of the golden ratio, for the golden-angle ordering
+golden = 0.5 * ( np.sqrt( 5.0 ) - 1.0 )
+
+
+
+
+##########################################################
+##########################################################
+####                                                  ####
+####                  ORDERED SUBSETS                 ####
+####                                                  ####
+##########################################################
+##########################################################
+
+##  Partition of the nang rows of the sinogram in nsubsets interleaved
+##  subsets, the subset k being the rows k , k + nsubsets , ... , so that
+##  every subset spans the whole angular range
+def make_subsets( nang , nsubsets ):
+    if nsubsets < 1 or nsubsets > nang:
+        sys.exit( '\nERROR: the number of subsets must lie between 1 and ' +
+                  str( nang ) + ' !!' )
+
+    return [ np.arange( k , nang , nsubsets ) for k in range( nsubsets ) ]
+
+
+
+##  Order in which the nsubsets subsets are visited:
+##  'sequential'  --->  0 , 1 , 2 , ...
+##  'golden'      --->  the k-th subset visited is the rank of the
+##                      fractional part of k times the golden ratio, so
+##                      that consecutive subsets lie far apart
+##  'random'      --->  a new random permutation at every call
+def subset_order( nsubsets , order='sequential' , rng=None ):
+    if order == 'sequential':
+        return np.arange( nsubsets )
+
+    elif order == 'golden':
+        frac = ( np.arange( nsubsets ) * golden ) % 1.0
+        return np.argsort( np.argsort( frac ) )
+
+    elif order == 'random':
+        if rng is None:
+            rng = np.random.default_rng()
+        return rng.permutation( nsubsets )
+
+    else:
+        sys.exit( '\nERROR: subset order ' + str( order ) + ' not available !!' )
+
+
+
+
+##########################################################
+##########################################################
+####                                                  ####
+####                 OS-SART ITERATIONS               ####
+####                                                  ####
+##########################################################
+##########################################################
+
+##  Ordered-subsets SART on top of any projectors class ( radon or B-spline )
+##  exposing A and At with angle_indices=:
+##    x  <--  x + relax * V_S * A_S^T ( W_S * ( b_S - A_S x ) )
+##  for every subset S, where W = 1 / A 1 are the inverse row sums and
+##  V_S = 1 / A_S^T 1 the inverse column sums of the subset.  The sums
+##  only depend on the geometry: they are taken from the cache of
+##  operator_stats ( folder stats_cache , None for its default ), so that
+##  they are computed once for all the jobs with the same projectors.
+##  nsubsets=1 gives SIRT, nsubsets=nang gives SART
+class os_sart:
+
+    def __init__( self , proj , nsubsets=1 , order='sequential' , relax=1.0 , nonneg=True ,
+                  seed=None , stats_cache=None ):
+        self.proj    = proj
+        self.npix    = proj.npix
+        self.nang    = proj.nang
+        self.order   = order
+        self.relax   = relax
+        self.nonneg  = nonneg
+        self.rng     = np.random.default_rng( seed )
+        self.subsets = make_subsets( self.nang , nsubsets )
+        self.times   = []
+
+
+        ##  Inverse row sums, for all the rows at once
+        self.row_weights = self.invert( ostats.row_sums( proj , stats_cache ) )
+
+
+        ##  Inverse column sums of every subset; with a single subset the
+        ##  projections run on the whole sinogram, without angle_indices
+        if nsubsets == 1:
+            self.col_weights = [ self.invert( ostats.col_sums( proj , folder=stats_cache ) ) ]
+        else:
+            self.col_weights = [ self.invert( ostats.col_sums( proj , s , stats_cache ) )
+                                 for s in self.subsets ]
+
+
+
+    ##  Inverse of the sums, with zero where the sum vanishes; the cached
+    ##  sums are read-only, so that a copy is inverted
+    def invert( self , arr ):
+        arr  = np.array( arr , dtype=myfloat )
+        mask = arr > eps
+        arr[~mask] = 0.0
+        np.divide( 1.0 , arr , out=arr , where=mask )
+        return arr
+
+
+
+    ##  Update of x with the subset k; res and upd are work buffers of the
+    ##  shape of the sinograms and of the images
+    def update( self , x , sino , k , res , upd ):
+        proj = self.proj
+
+        if len( self.subsets ) == 1:
+            proj.A( x , out=res )
+            np.subtract( sino , res , out=res )
+            res *= self.row_weights
+            proj.At( res , out=upd )
+
+        else:
+            s = self.subsets[k]
+            proj.A( x , out=res , angle_indices=s )
+            res[...,s,:] = ( sino[...,s,:] - res[...,s,:] ) * self.row_weights[s]
+            proj.At( res , out=upd , angle_indices=s )
+
+        upd *= self.col_weights[k]
+        if self.relax != 1.0:
+            upd *= self.relax
+        x += upd
+
+        if self.nonneg is True:
+            np.maximum( x , 0.0 , out=x )
+
+
+
+    ##  Reconstruction of a sinogram ( nang x npix ) or of a stack of
+    ##  sinograms ( nslices x nang x npix ) with niter iterations, i.e.
+    ##  niter sweeps over all the subsets, starting from x0 ( zero by
+    ##  default ); the wall time of every iteration is stored in
+    ##  self.times, and printed with verbose=True
+    def run( self , sino , niter , x0=None , verbose=False ):
+        sino  = np.asarray( sino , dtype=myfloat )
+        shape = sino.shape[:-2] + ( self.npix , self.npix )
+
+        if sino.ndim not in ( 2 , 3 ) or sino.shape[-2:] != ( self.nang , self.npix ):
+            sys.exit( '\nERROR: sinogram of shape ' + str( sino.shape ) +
+                      ' does not match the projectors !!' )
+
+        if x0 is None:
+            x = np.zeros( shape , dtype=myfloat )
+        else:
+            x = np.array( x0 , dtype=myfloat ).reshape( shape )
+
+        res = np.zeros( sino.shape , dtype=myfloat )
+        upd = np.zeros( shape , dtype=myfloat )
+
+        self.times = []
+
+        for it in range( niter ):
+            t0 = time.time()
+
+            for k in subset_order( len( self.subsets ) , self.order , self.rng ):
+                self.update( x , sino , k , res , upd )
+
+            self.times.append( time.time() - t0 )
+
+            if verbose is True:
+                print( 'Iteration %d/%d: %.3f s' % ( it + 1 , niter , self.times[-1] ) )
+
+        return x
+
+
+
+
+##########################################################
+##########################################################
+####                                                  ####
+####                  SIRT AND SART                   ####
+####                                                  ####
+##########################################################
+##########################################################
+
+##  SIRT: a single subset, all the rays update the image together
+def sirt( proj , sino , niter , x0=None , relax=1.0 , nonneg=True , verbose=False ,
+          stats_cache=None ):
+    solver = os_sart( proj , nsubsets=1 , relax=relax , nonneg=nonneg ,
+                      stats_cache=stats_cache )
+    return solver.run( sino , niter , x0=x0 , verbose=verbose )
+
+
+
+##  SART: one subset per angle, visited in the given order
+def sart( proj , sino , niter , x0=None , order='golden' , relax=1.0 , nonneg=True ,
+          seed=None , verbose=False , stats_cache=None ):
+    solver = os_sart( proj , nsubsets=proj.nang , order=order , relax=relax ,
+                      nonneg=nonneg , seed=seed , stats_cache=stats_cache )
+    return solver.run( sino , niter , x0=x0 , verbose=verbose )
+
+
+
+
+##########################################################
+##########################################################
+####                                                  ####
+####            TOTAL VARIATION: FISTA-TV             ####
+####                                                  ####
+##########################################################
+##########################################################
+
+##  Forward differences of x along its last two axes, written into gx and
+##  gy; the last row of gx and the last column of gy are zero
+def grad_tv( x , gx , gy ):
+    np.subtract( x[...,1:,:] , x[...,:-1,:] , out=gx[...,:-1,:] )
+    gx[...,-1,:] = 0.0
+    np.subtract( x[...,:,1:] , x[...,:,:-1] , out=gy[...,:,:-1] )
+    gy[...,:,-1] = 0.0
+
+
+
+##  Divergence, i.e. minus the adjoint of grad_tv, written into out; px
+##  and py must vanish where grad_tv sets them to zero
+def div_tv( px , py , out ):
+    np.copyto( out , px )
+    out[...,1:,:] -= px[...,:-1,:]
+    out += py
+    out[...,:,1:] -= py[...,:,:-1]
+
+
+
+##  FISTA for  min_x  0.5 || A x - b ||^2 + lam TV( x ) , with TV the
+##  isotropic total variation of every slice; the gradient step uses the
+##  operator norm of operator_stats, the proximal step of the TV is solved
+##  by the fast gradient projection of Beck and Teboulle on the dual, with
+##  niter_tv inner iterations warm-started from the previous dual variables.
+##  With nonneg=True the image is also constrained to be non-negative.
+##  All the iterations work in place on buffers allocated once per run
+class fista_tv:
+
+    def __init__( self , proj , lam , niter_tv=10 , nonneg=True , stats_cache=None ):
+        self.proj     = proj
+        self.npix     = proj.npix
+        self.nang     = proj.nang
+        self.lam      = lam
+        self.niter_tv = niter_tv
+        self.nonneg   = nonneg
+        self.times    = []
+        self.niter    = 0
+
+
+        ##  Lipschitz constant of the gradient of the data term
+        self.lip = ostats.op_norm( proj , stats_cache )**2
+
+        if self.lip <= eps:
+            sys.exit( '\nERROR: the projectors have a null norm !!' )
+
+
+
+    ##  Proximal step of w TV on z, written into out; the buffers of the
+    ##  dual variables are those of self.work
+    def prox_tv( self , z , w , out ):
+        px , py , qx , qy , rx , ry , gx , gy , nrm = self.work
+        t = 1.0
+
+        np.copyto( rx , px )
+        np.copyto( ry , py )
+
+        for it in range( self.niter_tv ):
+            ##  Primal image of the extrapolated dual variables
+            div_tv( rx , ry , out )
+            out *= w
+            out += z
+            if self.nonneg is True:
+                np.maximum( out , 0.0 , out=out )
+
+            ##  Projected gradient step on the dual variables
+            grad_tv( out , gx , gy )
+            px , qx = qx , px
+            py , qy = qy , py
+
+            np.multiply( gx , 1.0 / ( 8.0 * w ) , out=px )
+            px += rx
+            np.multiply( gy , 1.0 / ( 8.0 * w ) , out=py )
+            py += ry
+
+            np.hypot( px , py , out=nrm )
+            np.maximum( nrm , 1.0 , out=nrm )
+            px /= nrm
+            py /= nrm
+
+            ##  Extrapolation
+            t_new = 0.5 * ( 1.0 + np.sqrt( 1.0 + 4.0 * t**2 ) )
+            np.subtract( px , qx , out=rx )
+            rx *= ( t - 1.0 ) / t_new
+            rx += px
+            np.subtract( py , qy , out=ry )
+            ry *= ( t - 1.0 ) / t_new
+            ry += py
+            t = t_new
+
+        self.work = [ px , py , qx , qy , rx , ry , gx , gy , nrm ]
+
+        div_tv( px , py , out )
+        out *= w
+        out += z
+        if self.nonneg is True:
+            np.maximum( out , 0.0 , out=out )
+
+        return out
+
+
+
+    ##  Filtered backprojection of sino as starting image; fbp is exact up
+    ##  to a global factor, so that it is scaled by the least-squares factor
+    ##  < A f , b > / < A f , A f > matching its projection to the data
+    def warm_start( self , sino ):
+        x  = np.asarray( self.proj.fbp( sino ) , dtype=myfloat )
+        ax = self.proj.A( x )
+        nn = np.vdot( ax , ax )
+
+        if nn > eps:
+            x *= np.vdot( ax , sino ) / nn
+
+        if self.nonneg is True:
+            np.maximum( x , 0.0 , out=x )
+
+        return x
+
+
+
+    ##  Reconstruction of a sinogram ( nang x npix ) or of a stack of
+    ##  sinograms ( nslices x nang x npix ) with at most niter iterations,
+    ##  starting from x0: None for zero, an image, or 'fbp' for the filtered
+    ##  backprojection of sino.  The iterations stop when the relative
+    ##  change of the image || x_k - x_k-1 || / || x_k || falls below tol;
+    ##  the number of iterations done is stored in self.niter, the wall time
+    ##  of each of them in self.times, printed with verbose=True
+    def run( self , sino , niter , x0=None , tol=1e-3 , verbose=False ):
+        proj  = self.proj
+        sino  = np.asarray( sino , dtype=myfloat )
+        shape = sino.shape[:-2] + ( self.npix , self.npix )
+
+        if sino.ndim not in ( 2 , 3 ) or sino.shape[-2:] != ( self.nang , self.npix ):
+            sys.exit( '\nERROR: sinogram of shape ' + str( sino.shape ) +
+                      ' does not match the projectors !!' )
+
+        if x0 is None:
+            x = np.zeros( shape , dtype=myfloat )
+        elif isinstance( x0 , str ) and x0 == 'fbp':
+            x = self.warm_start( sino ).reshape( shape )
+        else:
+            x = np.array( x0 , dtype=myfloat ).reshape( shape )
+
+
+        ##  Work buffers
+        x_old = np.zeros( shape , dtype=myfloat )
+        y     = x.copy()
+        z     = np.zeros( shape , dtype=myfloat )
+        res   = np.zeros( sino.shape , dtype=myfloat )
+
+        self.work = [ np.zeros( shape , dtype=myfloat ) for i in range( 9 ) ]
+
+        w = self.lam / self.lip
+        t = 1.0
+
+        self.times = []
+        self.niter = 0
+
+        for it in range( niter ):
+            t0 = time.time()
+
+            ##  Gradient step on the data term from y
+            proj.A( y , out=res )
+            res -= sino
+            proj.At( res , out=z )
+            z *= -1.0 / self.lip
+            z += y
+
+            ##  Proximal step of the TV
+            x , x_old = x_old , x
+            self.prox_tv( z , w , x )
+
+            ##  Extrapolation and relative change
+            t_new = 0.5 * ( 1.0 + np.sqrt( 1.0 + 4.0 * t**2 ) )
+            np.subtract( x , x_old , out=y )
+            change = np.linalg.norm( y ) / max( np.linalg.norm( x ) , eps )
+            y *= ( t - 1.0 ) / t_new
+            y += x
+            t = t_new
+
+            self.times.append( time.time() - t0 )
+            self.niter = it + 1
+
+            if verbose is True:
+                print( 'Iteration %d/%d: %.3f s , relative change %.3e' %
+                       ( it + 1 , niter , self.times[-1] , change ) )
+
+            if change < tol:
+                break
+
+        return x
+
+
+
+##  FISTA-TV warm-started by default from the filtered backprojection
+def fista( proj , sino , lam , niter , x0='fbp' , tol=1e-3 , niter_tv=10 , nonneg=True ,
+           verbose=False , stats_cache=None ):
+    solver = fista_tv( proj , lam , niter_tv=niter_tv , nonneg=nonneg ,
+                       stats_cache=stats_cache )
+    return solver.run( sino , niter , x0=x0 , tol=tol , verbose=verbose )
@@ -0,0 +1,75 @@
+##########################################################
+##########################################################
+####                                                  ####
+####     SCIPY LINEAR OPERATOR OF THE PROJECTORS      ####
+####                                                  ####
+##########################################################
+##########################################################
+
+
+
+
+####  PYTHON MODULES
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+
+
+
+####  MY FORMAT VARIABLES
+myfloat = np.float32
+
+
+
+
+####  CLASS PROJECTORS OPERATOR
+##  The projectors classes ( radon or B-spline ) seen as a linear operator
+##  of shape ( nang * npix ) x ( npix * npix ), mapping a flattened image to
+##  its flattened sinogram, e.g. for scipy.sparse.linalg.lsqr or cgs.
+##  The vectors are reshaped into images and sinograms as views, never
+##  copied: the native projectors read float32 and float64 arrays of any
+##  strides.  matmat and rmatmat see the k columns of X as a stack of k
+##  slices, projected together in a single native call
+class projectors_operator( LinearOperator ):
+
+    def __init__( self , proj ):
+        self.proj = proj
+        self.npix = proj.npix
+        self.nang = proj.nang
+
+        super().__init__( dtype=myfloat ,
+                          shape=( self.nang * self.npix , self.npix * self.npix ) )
+
+
+
+    def _matvec( self , x ):
+        return self.proj.A( x.reshape( self.npix , self.npix ) ).reshape( -1 )
+
+
+
+    def _rmatvec( self , y ):
+        return self.proj.At( y.reshape( self.nang , self.npix ) ).reshape( -1 )
+
+
+
+    ##  The columns of X ( npix * npix x k ) are the slices of a stack
+    ##  ( k x npix x npix ), whose sinograms ( k x nang x npix ) are
+    ##  returned transposed as the columns of the result
+    def _matmat( self , X ):
+        k    = X.shape[1]
+        sino = self.proj.A( X.T.reshape( k , self.npix , self.npix ) )
+        return sino.reshape( k , -1 ).T
+
+
+
+    def _rmatmat( self , Y ):
+        k    = Y.shape[1]
+        reco = self.proj.At( Y.T.reshape( k , self.nang , self.npix ) )
+        return reco.reshape( k , -1 ).T
+
+
+
+
+####  LINEAR OPERATOR OF A PROJECTORS INSTANCE
+def aslinearoperator( proj ):
+    return projectors_operator( proj )
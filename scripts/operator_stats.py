@@ -0,0 +1,167 @@
+##########################################################
+##########################################################
+####                                                  ####
+####        CACHE OF THE OPERATOR STATISTICS:         ####
+####     ROW SUMS, COLUMN SUMS AND OPERATOR NORM      ####
+####                                                  ####
+##########################################################
+##########################################################
+
+
+
+
+####  PYTHON MODULES
+import os
+import hashlib
+import numpy as np
+
+
+
+
+####  MY FORMAT VARIABLES
+myfloat = np.float32
+
+
+
+
+####  DEFAULT CACHE FOLDER
+##  It can be changed with the environment variable TOMO_STATS_CACHE
+cache_dir = os.environ.get( 'TOMO_STATS_CACHE' ,
+                            os.path.join( os.path.expanduser( '~' ) , '.cache' ,
+                                          'tomographic_projectors' ) )
+
+
+
+
+####  MEMORY CACHE
+##  Statistics already loaded or computed in this process, by file name
+##  ( key of the geometry and name of the statistic ); the arrays are
+##  read-only, since they are shared among the callers
+stats_cache = {}
+
+
+
+
+####  POWER ITERATION PARAMETERS
+##  Maximum number of iterations and relative change of the estimate of
+##  the norm below which the iterations stop
+norm_niter = 100
+norm_tol   = 1e-5
+
+
+
+
+####  GET A STATISTIC
+##  The statistic name of the geometry key is taken from the memory
+##  cache, or read from the cache folder, or else computed by calling
+##  build() and saved; as in system_matrix, the file is first written
+##  under a temporary name, so that concurrent processes never read a
+##  partially written file
+def get_stat( key , name , build , folder=None ):
+    if folder is None:
+        folder = cache_dir
+
+    name     = key + '_' + name
+    filename = os.path.join( folder , name + '.npy' )
+
+    if name in stats_cache:
+        return stats_cache[name]
+
+    if os.path.isfile( filename ):
+        arr = np.load( filename )
+
+    else:
+        arr = np.asarray( build() )
+
+        if not os.path.isdir( folder ):
+            try:
+                os.makedirs( folder )
+            except OSError:
+                if not os.path.isdir( folder ):
+                    raise
+
+        filetmp = os.path.join( folder , name + '.' + str( os.getpid() ) + '.tmp.npy' )
+        with open( filetmp , 'wb' ) as fp:
+            np.save( fp , arr )
+        os.rename( filetmp , filename )
+
+    arr.setflags( write=False )
+    stats_cache[name] = arr
+
+    return arr
+
+
+
+
+####  ROW SUMS
+##  A 1, i.e. the forward projection of an image of ones, one value per
+##  ray ( nang x npix ); proj is any projectors class
+def row_sums( proj , folder=None ):
+    build = lambda: proj.A( np.ones( ( proj.npix , proj.npix ) , dtype=myfloat ) )
+
+    return get_stat( proj.geometry_key() , 'rowsum' , build , folder )
+
+
+
+
+####  COLUMN SUMS
+##  A^T 1, i.e. the backprojection of a sinogram of ones, one value per
+##  pixel ( npix x npix ); with angle_indices only the rows of those
+##  angles are summed, e.g. for a subset of an ordered-subsets method
+def col_sums( proj , angle_indices=None , folder=None ):
+    ones = np.ones( ( proj.nang , proj.npix ) , dtype=myfloat )
+
+    if angle_indices is None:
+        name  = 'colsum'
+        build = lambda: proj.At( ones )
+    else:
+        rows   = np.asarray( angle_indices , dtype=int ).reshape( -1 )
+        digest = hashlib.sha1( np.ascontiguousarray( rows , dtype=np.int64 ).tobytes() )
+        name   = 'colsum_' + digest.hexdigest()
+        build  = lambda: proj.At( ones , angle_indices=rows )
+
+    return get_stat( proj.geometry_key() , name , build , folder )
+
+
+
+
+####  OPERATOR NORM
+##  Largest singular value of A, i.e. the square root of the largest
+##  eigenvalue of A^T A, estimated by power iteration from a fixed random
+##  image, so that every process computes the same value
+def power_iteration( proj , niter=None , tol=None ):
+    if niter is None:
+        niter = norm_niter
+    if tol is None:
+        tol = norm_tol
+
+    rng  = np.random.default_rng( 0 )
+    x    = rng.random( ( proj.npix , proj.npix ) ).astype( myfloat )
+    x   /= np.linalg.norm( x )
+    sino = np.zeros( ( proj.nang , proj.npix ) , dtype=myfloat )
+    y    = np.zeros( ( proj.npix , proj.npix ) , dtype=myfloat )
+    lam  = 0.0
+
+    for it in range( niter ):
+        proj.A( x , out=sino )
+        proj.At( sino , out=y )
+
+        lam_old = lam
+        lam     = np.linalg.norm( y )
+
+        if lam == 0.0:
+            break
+
+        np.divide( y , lam , out=x )
+
+        if np.abs( lam - lam_old ) <= tol * lam:
+            break
+
+    return np.sqrt( lam )
+
+
+
+def op_norm( proj , folder=None ):
+    build = lambda: np.array( power_iteration( proj ) , dtype=np.float64 )
+
+    return float( get_stat( proj.geometry_key() , 'norm' , build , folder ) )
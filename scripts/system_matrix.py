@@ -0,0 +1,78 @@
+##########################################################
+##########################################################
+####                                                  ####
+####        DISK CACHE OF THE SPARSE SYSTEM           ####
+####            MATRICES OF THE PROJECTORS            ####
+####                                                  ####
+##########################################################
+##########################################################
+
+
+
+
+####  PYTHON MODULES
+import os
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+
+
+
+
+####  DEFAULT CACHE FOLDER
+##  It can be changed with the environment variable TOMO_MATRIX_CACHE
+cache_dir = os.environ.get( 'TOMO_MATRIX_CACHE' ,
+                            os.path.join( os.path.expanduser( '~' ) , '.cache' ,
+                                          'tomographic_projectors' ) )
+
+
+
+
+####  KEY OF A SYSTEM MATRIX
+##  The geometry is identified by the projector, the number of pixels,
+##  the interpolation method and a hash of the angles; extra is any
+##  further array the matrix depends on, e.g. the B-spline look-up-table
+def matrix_key( projector , npix , angles , method=None , extra=None ):
+    if method is None:
+        method = 0
+
+    digest = hashlib.sha1()
+    digest.update( np.ascontiguousarray( angles , dtype=np.float32 ).tobytes() )
+
+    if extra is not None:
+        for arr in extra:
+            digest.update( np.ascontiguousarray( arr , dtype=np.float32 ).tobytes() )
+
+    return '%s_npix%d_method%d_%s' % ( projector , npix , method , digest.hexdigest() )
+
+
+
+
+####  GET A SYSTEM MATRIX
+##  The matrix is read from the cache folder if already there, otherwise
+##  it is built by calling build() and saved; the file is first written
+##  under a temporary name, so that concurrent processes never read a
+##  partially written matrix
+def get_matrix( key , build , folder=None ):
+    if folder is None:
+        folder = cache_dir
+
+    filename = os.path.join( folder , key + '.npz' )
+
+    if os.path.isfile( filename ):
+        return sp.load_npz( filename ).tocsr()
+
+    mat = build()
+
+    if not os.path.isdir( folder ):
+        try:
+            os.makedirs( folder )
+        except OSError:
+            if not os.path.isdir( folder ):
+                raise
+
+    filetmp = os.path.join( folder , key + '.' + str( os.getpid() ) + '.tmp.npz' )
+    sp.save_npz( filetmp , mat , compressed=False )
+    os.rename( filetmp , filename )
+
+    return mat